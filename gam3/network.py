@@ -4,14 +4,196 @@
 Network functionality of Gam3.
 """
 
+from collections import OrderedDict
+
 from twisted.internet.protocol import ServerFactory
+from twisted.internet.task import LoopingCall
 from twisted.internet import reactor
-from twisted.protocols.amp import AMP
+from twisted.protocols.amp import AMP, AmpBox
 
 from game.terrain import CHUNK_GRANULARITY
 from game.network import (
-    Introduce, SetDirectionOf, NewPlayer, SetMyDirection, RemovePlayer,
-    GetTerrain, SetTerrain)
+    Introduce, SetDirectionOf, SetDirectionsOf, NewPlayer, SetMyDirection,
+    RemovePlayer, GetTerrain, SetTerrain, GetTerrainChunks, SetTerrainChunks,
+    TerrainChunks, TERRAIN_COMPRESSION, PROTOCOL_FEATURES, UNANSWERED_UPDATES,
+    BATCHED_UPDATES, batches, encodeTerrain)
+
+
+
+class TerrainCache(object):
+    """
+    A cache of encoded chunks of terrain, shared by all connections so that a
+    chunk many clients ask for is encoded only once.  Chunks are forgotten
+    when the terrain they cover changes, and least recently used first when
+    their data takes up more than C{budget} bytes.
+
+    @ivar terrain: The L{Terrain} the chunks come from.
+
+    @ivar budget: The largest number of bytes of encoded data to keep.
+
+    @ivar size: The number of bytes of encoded data being kept.
+
+    @ivar hits: The number of chunks which were found in the cache.
+
+    @ivar misses: The number of chunks which had to be encoded.
+
+    @ivar _entries: An L{OrderedDict} mapping four-tuples of a chunk's
+        coordinates and the name of its compression to L{EncodedTerrain}
+        instances, least recently used first.
+    """
+    budget = 2 ** 24
+
+    def __init__(self, terrain):
+        self.terrain = terrain
+        self.size = self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        terrain.addObserver(self.terrainChanged)
+
+
+    def __len__(self):
+        """
+        Return the number of encoded chunks being kept.
+        """
+        return len(self._entries)
+
+
+    def stop(self):
+        """
+        Stop watching C{terrain} for changes and forget every encoded chunk.
+        """
+        self.terrain.removeObserver(self.terrainChanged)
+        self._entries.clear()
+        self.size = 0
+
+
+    def get(self, x, y, z, compression):
+        """
+        Return the chunk of terrain at the given coordinates, clipped to the
+        extent of the known terrain and encoded with C{compression}.
+
+        @rtype: L{EncodedTerrain}
+        """
+        key = (x, y, z, compression)
+        encoded = self._entries.pop(key, None)
+        if encoded is None:
+            self.misses += 1
+            encoded = encodeTerrain(self._voxels(x, y, z), compression)
+            self.size += len(encoded.data)
+        else:
+            self.hits += 1
+        self._entries[key] = encoded
+        while self.size > self.budget:
+            key, forgotten = self._entries.popitem(last=False)
+            self.size -= len(forgotten.data)
+        return encoded
+
+
+    def _voxels(self, x, y, z):
+        """
+        Return the voxels of the chunk of terrain at the given coordinates,
+        clipped to the extent of the known terrain.
+        """
+        terrain = self.terrain
+        g = CHUNK_GRANULARITY
+        # Don't send anything beyond the extent of the known terrain.
+        shape = [
+            max(0, min(int(size), extent - start))
+            for (size, extent, start)
+            in zip((g.x, g.y, g.z), terrain.shape, (x, y, z))]
+        return terrain.get(x, y, z, shape)
+
+
+    def terrainChanged(self, position, shape):
+        """
+        Terrain observer which forgets every chunk overlapping the region which
+        changed.  A chunk clipped to the old extent of the terrain overlaps
+        changes anywhere within its full size.
+        """
+        g = CHUNK_GRANULARITY
+        low = (position.x, position.y, position.z)
+        high = (
+            position.x + shape.x, position.y + shape.y, position.z + shape.z)
+        for key in self._entries.keys():
+            if all(start < h and l < start + size
+                   for (start, size, l, h)
+                   in zip(key, (g.x, g.y, g.z), low, high)):
+                self.size -= len(self._entries.pop(key).data)
+
+
+class BoxCache(object):
+    """
+    The serialized arguments of the most recently sent commands, shared by
+    all connections so that an update sent to many clients -- as each of
+    their protocols does when observing the same event -- is serialized only
+    once.  Each connection writes the same bytes, after its own C{_command}
+    key and its own C{_ask} tag if it asks for an answer.
+
+    @ivar size: The largest number of commands to keep the arguments of.
+
+    @ivar hits: The number of commands whose arguments were found already
+        serialized.
+
+    @ivar misses: The number of commands whose arguments had to be
+        serialized.
+
+    @ivar _boxes: An L{OrderedDict} mapping tuples of a command and the values
+        of its arguments, in the order of its schema, to the serialized
+        L{AmpBox} made by L{Command.makeArguments}, least recently used first.
+    """
+    size = 16
+
+    def __init__(self):
+        self.hits = self.misses = 0
+        self._boxes = OrderedDict()
+
+
+    def serialize(self, command, arguments):
+        """
+        Return the wire form of the L{AmpBox} of the arguments of C{command},
+        as made by L{Command.makeArguments}, ending with the empty key which
+        ends a box.
+
+        @param command: A L{Command} subclass whose arguments need no protocol
+            to be converted.
+        @param arguments: A C{dict} of the arguments to the command, which must
+            all be hashable.
+        """
+        key = (command,) + tuple(
+            arguments.get(name) for (name, argument) in command.arguments)
+        data = self._boxes.pop(key, None)
+        if data is None:
+            self.misses += 1
+            data = command.makeArguments(arguments, None).serialize()
+            if len(self._boxes) >= self.size:
+                self._boxes.popitem(last=False)
+        else:
+            self.hits += 1
+        self._boxes[key] = data
+        return data
+
+
+
+class _SerializedBox(AmpBox):
+    """
+    An L{AmpBox} holding only the keys L{AMP} adds to a command, which is
+    written followed by the arguments of the command as serialized by
+    L{BoxCache.serialize}.
+
+    @ivar arguments: The serialized arguments.
+    """
+
+    def __init__(self, arguments):
+        AmpBox.__init__(self)
+        self.arguments = arguments
+
+
+    def serialize(self):
+        """
+        Return the wire form of this box: its own keys, without the empty key
+        which would end it, followed by the serialized arguments.
+        """
+        return AmpBox.serialize(self)[:-2] + self.arguments
+
 
 
 class Gam3Server(AMP):
@@ -24,38 +206,176 @@ class Gam3Server(AMP):
     @ivar clock: An L{IReactorTime} provider.
     @ivar player: The L{Player} of the client that this protocol
         instance is communicating to.
+    @ivar terrainCompression: The name of the L{TERRAIN_COMPRESSION} method
+        used for terrain sent to the client, or C{None} to send it as is.
+    @ivar features: The C{frozenset} of L{PROTOCOL_FEATURES} agreed on with
+        the client in L{Introduce}.
+    @ivar terrainCache: The L{TerrainCache} terrain is sent from.  One is
+        created if none is given, and stopped when the connection is lost;
+        one which is given is left for its owner, like L{Gam3Factory}, to
+        stop.
+    @ivar boxCache: The L{BoxCache} the arguments of broadcast commands are
+        serialized with.
+    @ivar broadcastCommands: The commands sent through C{boxCache}.
+
+    @ivar interestRadius: The distance from the client's L{Player} within which
+        other L{Player}s are sent to the client, or C{None} to send all of
+        them.  A L{Player} which comes within the radius is sent with a
+        L{NewPlayer} command and one which leaves it is taken away with a
+        L{RemovePlayer} command.
+
+    @ivar interestCheckInterval: The number of seconds between checks for
+        L{Player}s which have crossed C{interestRadius} without changing
+        direction.
+
+    @ivar batchUpdates: If C{False}, a L{SetDirectionOf} command is sent as
+        soon as a L{Player} changes direction.  If C{True}, and the client
+        agreed to L{BATCHED_UPDATES}, the L{Player}s which changed direction
+        during one tick of the L{World} are sent together in a
+        L{SetDirectionsOf} command at the start of the next, each only once
+        and as it is then.
+
+    @ivar _visible: The C{set} of L{Player}s the client has been sent.
+
+    @ivar _pendingUpdates: An L{OrderedDict} whose keys are the L{Player}s
+        waiting to be sent with the next L{SetDirectionsOf} command.
+
+    @ivar _sendUpdates: The delayed call of L{sendUpdates} on the L{World}, or
+        C{None} if none is pending.
+
+    @ivar _observing: Whether this protocol observes the L{World} and the
+        other L{Player}s in it, which it does from L{sendExistingPlayers}
+        until the connection is lost.
     """
 
-    def __init__(self, world, clock=reactor):
+    terrainCompression = None
+    features = frozenset()
+    interestRadius = 64
+    interestCheckInterval = 1
+    _existingState = _interestCheck = _sendUpdates = None
+    _observing = False
+    broadcastCommands = (NewPlayer, SetDirectionOf, RemovePlayer)
+
+    def __init__(self, world, clock=reactor, terrainCache=None, boxCache=None,
+                 batchUpdates=False):
         self.world = world
         self.clock = clock
         self.players = {}
         self.player = None
+        self.batchUpdates = batchUpdates
+        self._visible = set()
+        self._pendingUpdates = OrderedDict()
+        self._ownsTerrainCache = terrainCache is None
+        if terrainCache is None:
+            terrainCache = TerrainCache(world.terrain)
+        self.terrainCache = terrainCache
+        if boxCache is None:
+            boxCache = BoxCache()
+        self.boxCache = boxCache
+
+
+    def callRemote(self, command, **kw):
+        """
+        Send a command to the client.  The commands in C{broadcastCommands}
+        describe the world the same way to every client, so their arguments
+        are serialized through C{boxCache} and written as they are, with only
+        this connection's own keys put in front of them.  They ask for no
+        answer if the client agreed to L{UNANSWERED_UPDATES}.
+        """
+        if command in self.broadcastCommands:
+            return self._sendBoxCommand(
+                command.commandName,
+                _SerializedBox(self.boxCache.serialize(command, kw)),
+                UNANSWERED_UPDATES not in self.features)
+        return AMP.callRemote(self, command, **kw)
 
 
     def playerCreated(self, player):
         """
-        Send data about the new player to the client that this
-        protocol is connected to with a L{NewPlayer} command.
+        Send data about the new player to the client that this protocol is
+        connected to with a L{NewPlayer} command, if it is near enough to the
+        client's player.
 
         @param player: The L{Player} that was created.
         """
-        self.notifyPlayerCreated(player)
         player.addObserver(self)
+        self._updateInterest(player)
 
 
     def playerRemoved(self, player):
         """
-        Send data about the removed player to the client that this
-        protocol is connected to with a L{RemovePlayer} command.
+        Send data about the removed player to the client that this protocol is
+        connected to with a L{RemovePlayer} command, if the client knows about
+        it.
 
         @param player: The L{Player} that was removed.
         """
         identifier = self.identifierForPlayer(player)
-        self.callRemote(RemovePlayer, identifier=identifier)
+        if player in self._visible:
+            self._forget(player)
         del self.players[identifier]
 
 
+    def _interesting(self, player):
+        """
+        Return whether C{player} is within C{interestRadius} of the client's
+        L{Player}.
+        """
+        if self.interestRadius is None or self.player is None:
+            return True
+        here = self.player.getPosition()
+        there = player.getPosition()
+        return ((here.x - there.x) ** 2 + (here.y - there.y) ** 2 +
+                (here.z - there.z) ** 2) <= self.interestRadius ** 2
+
+
+    def _updateInterest(self, player):
+        """
+        Tell the client about C{player} if it has come within
+        C{interestRadius}, sending its direction too if it is moving, or
+        tell the client to forget it if it has gone out of range.
+
+        @return: C{True} if the client knows about C{player} now, C{False}
+            otherwise.
+        """
+        interesting = self._interesting(player)
+        if interesting and player not in self._visible:
+            self._visible.add(player)
+            self.notifyPlayerCreated(player)
+            if player.direction is not None:
+                self.sendDirectionOf(player)
+        elif not interesting and player in self._visible:
+            self._forget(player)
+        return interesting
+
+
+    def _forget(self, player):
+        """
+        Tell the client to forget C{player} with a L{RemovePlayer} command,
+        dropping any update to it which has not been sent yet.
+        """
+        self._visible.remove(player)
+        self._pendingUpdates.pop(player, None)
+        self.callRemote(
+            RemovePlayer, identifier=self.identifierForPlayer(player))
+
+
+    def checkInterest(self):
+        """
+        Bring the client up to date on which L{Player}s are within
+        C{interestRadius} of its own.  Only the players the client knows about
+        and those the L{World} finds near its player are looked at.
+        """
+        if self.interestRadius is None or self.player is None:
+            players = list(self.world.getPlayers())
+        else:
+            players = self._visible.union(self.world.playersNear(
+                    self.player.getPosition(), self.interestRadius))
+        for player in players:
+            if player is not self.player:
+                self._updateInterest(player)
+
+
     def notifyPlayerCreated(self, player):
         """
         Notify the client that a new L{Player} has been created.
@@ -66,60 +386,120 @@ class Gam3Server(AMP):
                         x=v.x, y=v.y, z=v.z, speed=player.speed)
 
 
-    def introduce(self):
+    def introduce(self, compression=None, features=None):
         """
         Return L{game.environment.Environment} and new
         L{game.player.Player} data, and start watching for new player
         creation.
+
+        @param compression: The names of the ways the client can decompress
+            terrain, most preferred first.  The first one which is also in
+            L{TERRAIN_COMPRESSION} is used from now on.
+
+        @param features: The names of the optional parts of the protocol the
+            client supports.  Those which are also in L{PROTOCOL_FEATURES} are
+            used from now on.
         """
+        for name in compression or []:
+            if name in TERRAIN_COMPRESSION:
+                self.terrainCompression = name
+                break
+        self.features = PROTOCOL_FEATURES.intersection(features or [])
         player = self.world.createPlayer()
         identifier = self.identifierForPlayer(player)
         v = player.getPosition()
         # XXX FIXME BUG: Instead, we should do what twisted:#2671 wants.
-        self.clock.callLater(0, self.sendExistingState)
+        self._existingState = self.clock.callLater(0, self.sendExistingState)
         self.player = player
         return {"granularity": self.world.granularity,
                 "identifier": identifier,
                 "speed": player.speed,
                 "x": v.x,
                 "y": v.y,
-                "z": v.z}
+                "z": v.z,
+                "compression": self.terrainCompression,
+                "features": sorted(self.features) or None}
     Introduce.responder(introduce)
 
 
     def sendExistingState(self):
         """
-        Send information about connected players.
+        Send information about connected players, and start checking for
+        players moving into and out of range every C{interestCheckInterval}
+        seconds.
         """
         self.sendExistingPlayers()
+        self._interestCheck = LoopingCall(self.checkInterest)
+        self._interestCheck.clock = self.clock
+        self._interestCheck.start(self.interestCheckInterval, now=False)
 
 
     def sendExistingPlayers(self):
         """
         Send L{NewPlayer} commands to this client for each existing L{Player} in
-        the L{World}.
+        the L{World} within C{interestRadius} of its own.
         """
         for player in self.world.getPlayers():
             if player is not self.player:
-                self.notifyPlayerCreated(player)
                 player.addObserver(self)
+                self._updateInterest(player)
         self.world.addObserver(self)
+        self._observing = True
 
 
     # IPlayerObserver
     def directionChanged(self, player):
         """
-        A L{Player}'s direction has changed: Send it to the client.
+        A L{Player}'s direction has changed: Send it to the client if the
+        player is within C{interestRadius}, or tell the client about it or to
+        forget it if it has crossed the radius since the last check.
+        """
+        known = player in self._visible
+        if self._updateInterest(player) and known:
+            self.sendDirectionOf(player)
+
+
+    def sendDirectionOf(self, player):
+        """
+        Send the direction, position and orientation of C{player} to the client
+        with a L{SetDirectionOf} command, or if C{batchUpdates} is set and the
+        client agreed to L{BATCHED_UPDATES}, with the next L{SetDirectionsOf}
+        command.
+        """
+        if self.batchUpdates and BATCHED_UPDATES in self.features:
+            self._pendingUpdates[player] = None
+            if self._sendUpdates is None:
+                self._sendUpdates = self.world.callLater(0, self.sendUpdates)
+        else:
+            self.callRemote(SetDirectionOf, **self._directionOf(player))
+
+
+    def sendUpdates(self):
+        """
+        Send the direction, position and orientation of each L{Player} waiting
+        in C{_pendingUpdates} to the client, in as few L{SetDirectionsOf}
+        commands as will hold them.
+        """
+        self._sendUpdates = None
+        updates = [self._directionOf(player) for player in self._pendingUpdates]
+        self._pendingUpdates.clear()
+        for batch in batches(updates, lambda u: SetDirectionsOf.updateSize):
+            self.callRemote(SetDirectionsOf, updates=batch)
+
+
+    def _directionOf(self, player):
+        """
+        Return the arguments of a L{SetDirectionOf} command for C{player}.
         """
         v = player.getPosition()
-        self.callRemote(SetDirectionOf,
-                        identifier=self.identifierForPlayer(player),
-                        direction=player.direction,
-                        x=v.x, y=v.y, z=v.z,
-                        orientation=player.orientation.y)
+        return dict(identifier=self.identifierForPlayer(player),
+                    direction=player.direction,
+                    x=v.x, y=v.y, z=v.z,
+                    orientation=player.orientation.y)
+
 
     # AMP responders
-    def setMyDirection(self, direction, y):
+    def setMyDirection(self, direction, y, sequence=None):
         """
         Set the direction of the player of the client connected to this
         protocol.
@@ -129,11 +509,14 @@ class Gam3Server(AMP):
 
         @param y: The direction of forward, in degrees offset from movement
             along the z axis.
+
+        @param sequence: The client's number for this command, given back to
+            it with the player's position.
         """
         self.player.orientation.y = y
         self.player.setDirection(direction)
         v = self.player.getPosition()
-        return {'x': v.x, 'y': v.y, 'z': v.z}
+        return {'x': v.x, 'y': v.y, 'z': v.z, 'sequence': sequence}
     SetMyDirection.responder(setMyDirection)
 
 
@@ -143,17 +526,28 @@ class Gam3Server(AMP):
         """
         if x < 0 or y < 0 or z < 0:
             return {}
-        voxels = self.world.terrain.voxels[
-            x:x + CHUNK_GRANULARITY.x,
-            y:y + CHUNK_GRANULARITY.y,
-            z:z + CHUNK_GRANULARITY.z]
         self.callRemote(
             SetTerrain, x=x, y=y, z=z,
-            voxels=voxels)
+            voxels=self.terrainCache.get(x, y, z, self.terrainCompression))
         return {}
     GetTerrain.responder(getTerrain)
 
 
+    def getTerrainChunks(self, positions):
+        """
+        The client would like terrain data for several chunks.  Send it in as
+        few L{SetTerrainChunks} commands as will hold it.
+        """
+        chunks = [
+            (x, y, z, self.terrainCache.get(x, y, z, self.terrainCompression))
+            for (x, y, z) in positions
+            if x >= 0 and y >= 0 and z >= 0]
+        for batch in batches(chunks, TerrainChunks.size):
+            self.callRemote(SetTerrainChunks, chunks=batch)
+        return {}
+    GetTerrainChunks.responder(getTerrainChunks)
+
+
     def identifierForPlayer(self, player):
         """
         Return an identifier for the given L{Player}. If the given
@@ -174,8 +568,26 @@ class Gam3Server(AMP):
 
     def connectionLost(self, reason):
         """
-        Remove this connection's L{Player} from the L{World}.
+        Stop observing the L{World} and its L{Player}s, remove this
+        connection's L{Player} from the L{World} and stop checking which
+        players are in range or sending updates.  A L{TerrainCache} created
+        for this connection alone is stopped.
         """
+        if self._observing:
+            self.world.removeObserver(self)
+            for player in self.world.getPlayers():
+                if player is not self.player:
+                    player.removeObserver(self)
+            self._observing = False
+        if self._ownsTerrainCache:
+            self.terrainCache.stop()
+        if self._existingState is not None and self._existingState.active():
+            self._existingState.cancel()
+        if self._sendUpdates is not None:
+            self._sendUpdates.cancel()
+            self._sendUpdates = None
+        if self._interestCheck is not None:
+            self._interestCheck.stop()
         self.world.removePlayer(self.player)
 
 
@@ -186,13 +598,30 @@ class Gam3Factory(ServerFactory):
 
     @ivar world: The L{World} which will be served by protocols created by this
     factory.
+
+    @ivar terrainCache: The L{TerrainCache} shared by those protocols, created
+        along with the first of them.
+
+    @ivar boxCache: The L{BoxCache} shared by those protocols.
+
+    @ivar batchUpdates: Whether those protocols send the L{Player}s which
+        changed direction once per tick.  See L{Gam3Server.batchUpdates}.
     """
-    def __init__(self, world):
+    terrainCache = None
+
+    def __init__(self, world, batchUpdates=False):
         self.world = world
+        self.batchUpdates = batchUpdates
+        self.boxCache = BoxCache()
 
 
     def buildProtocol(self, ignored):
         """
-        Instantiate a L{Gam3Server} with a L{World}.
+        Instantiate a L{Gam3Server} with a L{World} and the shared
+        L{TerrainCache} and L{BoxCache}.
         """
-        return Gam3Server(self.world)
+        if self.terrainCache is None:
+            self.terrainCache = TerrainCache(self.world.terrain)
+        return Gam3Server(
+            self.world, terrainCache=self.terrainCache,
+            boxCache=self.boxCache, batchUpdates=self.batchUpdates)
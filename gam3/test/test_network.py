@@ -2,25 +2,31 @@
 Tests for the networking functionality of Gam3.
 """
 
+import numpy
+
 from zope.interface.verify import verifyObject
 
 from twisted.trial.unittest import TestCase
 from twisted.internet.interfaces import IProtocolFactory
 from twisted.internet.task import Clock
 from twisted.test.proto_helpers import StringTransport
-from twisted.protocols.amp import _objectsToStrings, _stringsToObjects
+from twisted.protocols.amp import (
+    MAX_VALUE_LENGTH, ASK, COMMAND, AmpBox, parseString, _objectsToStrings,
+    _stringsToObjects)
 
 from game.vector import Vector
 from game.network import (
-    Introduce, SetMyDirection, SetDirectionOf, GetTerrain,
-    Direction, NewPlayer, RemovePlayer, SetTerrain)
+    Introduce, SetMyDirection, SetDirectionOf, SetDirectionsOf, GetTerrain,
+    Direction, NewPlayer, RemovePlayer, SetTerrain, GetTerrainChunks,
+    SetTerrainChunks, TerrainChunks, EncodedTerrain, TERRAIN_CHUNKS,
+    UNANSWERED_UPDATES, BATCHED_UPDATES, encodeTerrain)
 from game.player import Player
 from game.direction import LEFT, RIGHT
 from game.terrain import Terrain, loadTerrainFromString
 from game.test.util import ArrayMixin
 
 from gam3.world import World
-from gam3.network import Gam3Factory, Gam3Server
+from gam3.network import Gam3Factory, Gam3Server, TerrainCache, BoxCache
 
 
 
@@ -66,6 +72,17 @@ class FakeWorld(object):
         return self.players
 
 
+    def playersNear(self, position, radius):
+        """
+        Return the players within C{radius} of C{position}.
+        """
+        return [
+            player for player in self.players
+            if ((player.getPosition().x - position.x) ** 2 +
+                (player.getPosition().y - position.y) ** 2 +
+                (player.getPosition().z - position.z) ** 2) <= radius ** 2]
+
+
 
 class NetworkTests(TestCase, ArrayMixin):
     """
@@ -135,6 +152,52 @@ class NetworkTests(TestCase, ArrayMixin):
         return d
 
 
+    def test_negotiateCompression(self):
+        """
+        The server compresses terrain with the first method listed in the
+        L{Introduce} command which it supports, and says which in its response.
+        """
+        world = FakeWorld()
+        protocol = Gam3Server(world, clock=Clock())
+        box = protocol.introduce(compression=['bogus', 'zlib'])
+        self.assertEquals(box['compression'], 'zlib')
+        self.assertEquals(protocol.terrainCompression, 'zlib')
+
+
+    def test_noCompression(self):
+        """
+        If the client supports no compression the server does, terrain is sent
+        uncompressed.
+        """
+        protocol = Gam3Server(FakeWorld(), clock=Clock())
+        box = protocol.introduce(compression=['bogus'])
+        self.assertIdentical(box['compression'], None)
+        self.assertIdentical(protocol.terrainCompression, None)
+
+
+    def test_negotiateFeatures(self):
+        """
+        The server uses the optional parts of the protocol named in the
+        L{Introduce} command which it supports, and says which in its
+        response.
+        """
+        protocol = Gam3Server(FakeWorld(), clock=Clock())
+        box = protocol.introduce(features=['bogus', TERRAIN_CHUNKS])
+        self.assertEquals(box['features'], [TERRAIN_CHUNKS])
+        self.assertEquals(protocol.features, frozenset([TERRAIN_CHUNKS]))
+
+
+    def test_noFeatures(self):
+        """
+        A client which names no optional parts of the protocol, like one
+        which predates them, gets none.
+        """
+        protocol = Gam3Server(FakeWorld(), clock=Clock())
+        box = protocol.introduce()
+        self.assertIdentical(box['features'], None)
+        self.assertEquals(protocol.features, frozenset())
+
+
     def test_createMorePlayers(self):
         """
         When a player is created, all existing clients must be notified of it.
@@ -164,7 +227,7 @@ class NetworkTests(TestCase, ArrayMixin):
         sent.
         """
         world = World()
-        protocol = Gam3Server(world)
+        protocol = Gam3Server(world, clock=Clock())
         protocol.callRemote = self.callRemote
         protocol.introduce()
         self.assertEqual(self.calls, [])
@@ -309,6 +372,209 @@ class NetworkTests(TestCase, ArrayMixin):
         self.assertRaises(KeyError, protocol.playerForIdentifier, identifier)
 
 
+    def introduced(self, features=None):
+        """
+        Create a L{World} and a L{Gam3Server} with an
+        L{Gam3Server.interestRadius} of 10 which has been introduced and has
+        sent the existing state.  The client's player is put at the origin.
+
+        @param features: The names of the features the client introduces
+            itself with.
+
+        @return: A three-tuple of the world, the protocol and its clock.
+        """
+        clock = Clock()
+        world = World()
+        protocol = Gam3Server(world, clock=clock)
+        protocol.interestRadius = 10
+        protocol.callRemote = self.callRemote
+        protocol.introduce(features=features)
+        protocol.player.setPosition(Vector(0, 1, 0))
+        clock.advance(0)
+        return world, protocol, clock
+
+
+    def test_distantPlayerCreated(self):
+        """
+        No L{NewPlayer} command is sent for a player created further than
+        L{Gam3Server.interestRadius} from the client's player, and neither are
+        its direction changes.
+        """
+        world, protocol, clock = self.introduced()
+        player = Player(Vector(20, 1, 0), 2, world.seconds)
+        world.addObserver(protocol)
+        protocol.playerCreated(player)
+        player.setDirection(LEFT)
+        self.assertEqual(self.calls, [])
+
+
+    def test_playerEnters(self):
+        """
+        When a player comes within L{Gam3Server.interestRadius} of the client's
+        player, a L{NewPlayer} command is sent for it at the next check,
+        followed by a L{SetDirectionOf} command if it is moving.
+        """
+        world, protocol, clock = self.introduced()
+        player = world.createPlayer()
+        player.setPosition(Vector(20, 1, 0))
+        player.setDirection(LEFT)
+        self.calls = []
+
+        world.advance(6)
+        clock.advance(protocol.interestCheckInterval)
+        v = player.getPosition()
+        self.assertEqual(v.x, 8)
+        identifier = protocol.identifierForPlayer(player)
+        self.assertEqual(
+            self.calls,
+            [(NewPlayer, {'identifier': identifier,
+                          'x': v.x, 'y': v.y, 'z': v.z,
+                          'speed': player.speed}),
+             (SetDirectionOf, {'identifier': identifier,
+                               'direction': LEFT,
+                               'x': v.x, 'y': v.y, 'z': v.z,
+                               'orientation': 0.0})])
+
+
+    def test_playerLeaves(self):
+        """
+        When a player the client knows about moves further than
+        L{Gam3Server.interestRadius} from the client's player, a
+        L{RemovePlayer} command is sent for it instead of its direction, and
+        it is not sent again when it is removed from the world.
+        """
+        world, protocol, clock = self.introduced()
+        player = world.createPlayer()
+        player.setPosition(Vector(0, 1, 0))
+        identifier = protocol.identifierForPlayer(player)
+        self.calls = []
+
+        player.setPosition(Vector(0, 1, 20))
+        player.setDirection(RIGHT)
+        world.removePlayer(player)
+        self.assertEqual(
+            self.calls, [(RemovePlayer, {'identifier': identifier})])
+
+
+    def test_noInterestRadius(self):
+        """
+        If L{Gam3Server.interestRadius} is C{None}, every player is sent.
+        """
+        world, protocol, clock = self.introduced()
+        protocol.interestRadius = None
+        player = world.createPlayer()
+        player.setPosition(Vector(1000, 1, 0))
+        player.setDirection(RIGHT)
+        self.assertEqual(
+            [command for (command, kw) in self.calls],
+            [NewPlayer, SetDirectionOf])
+
+
+    def test_batchUpdates(self):
+        """
+        If L{Gam3Server.batchUpdates} is set and the client agreed to
+        L{BATCHED_UPDATES}, the players which changed direction are sent
+        together in one L{SetDirectionsOf} command at the next tick of the
+        L{World}, each once with its latest state.
+        """
+        world, protocol, clock = self.introduced([BATCHED_UPDATES])
+        protocol.batchUpdates = True
+        first = world.createPlayer()
+        second = world.createPlayer()
+        for player in [first, second]:
+            player.setPosition(Vector(1, 1, 0))
+        self.calls = []
+
+        first.setDirection(LEFT)
+        second.setDirection(RIGHT)
+        first.setDirection(RIGHT)
+        first.turn(0, 90)
+        self.assertEqual(self.calls, [])
+
+        world.advance(0.5)
+        updates = [protocol._directionOf(player) for player in [first, second]]
+        self.assertEqual(updates[0]['direction'], RIGHT)
+        self.assertEqual(updates[0]['orientation'], 90)
+        self.assertEqual(self.calls, [(SetDirectionsOf, {'updates': updates})])
+
+        world.advance(0.5)
+        self.assertEqual(len(self.calls), 1)
+
+
+    def test_batchUpdatesOldClient(self):
+        """
+        A client which did not agree to L{BATCHED_UPDATES} is sent a
+        L{SetDirectionOf} command for each change of direction at once, even
+        if L{Gam3Server.batchUpdates} is set.
+        """
+        world, protocol, clock = self.introduced()
+        protocol.batchUpdates = True
+        player = world.createPlayer()
+        player.setPosition(Vector(1, 1, 0))
+        self.calls = []
+        player.setDirection(LEFT)
+        self.assertEqual(
+            self.calls, [(SetDirectionOf, protocol._directionOf(player))])
+        world.advance(0)
+        self.assertEqual(len(self.calls), 1)
+
+
+    def test_batchUpdatesSplit(self):
+        """
+        Updates which do not fit in one AMP value are sent in several
+        L{SetDirectionsOf} commands.
+        """
+        world, protocol, clock = self.introduced([BATCHED_UPDATES])
+        protocol.batchUpdates = True
+        protocol.interestRadius = None
+        count = MAX_VALUE_LENGTH // SetDirectionsOf.updateSize + 1
+        players = [world.createPlayer() for i in range(count)]
+        self.calls = []
+        for player in players:
+            player.setDirection(LEFT)
+        world.advance(0)
+        updates = self.getCommands(SetDirectionsOf)
+        self.assertEqual([len(kw['updates']) for kw in updates], [count - 1, 1])
+
+
+    def test_batchedPlayerRemoved(self):
+        """
+        A batched update to a player which is removed before it is sent is
+        dropped.
+        """
+        world, protocol, clock = self.introduced([BATCHED_UPDATES])
+        protocol.batchUpdates = True
+        player = world.createPlayer()
+        player.setPosition(Vector(1, 1, 0))
+        player.setDirection(LEFT)
+        world.removePlayer(player)
+        self.calls = []
+        world.advance(0)
+        self.assertEqual(self.calls, [])
+
+
+    def test_connectionLostStopsBatchedUpdates(self):
+        """
+        L{Gam3Server.connectionLost} cancels sending the batched updates.
+        """
+        world, protocol, clock = self.introduced([BATCHED_UPDATES])
+        protocol.batchUpdates = True
+        player = world.createPlayer()
+        player.setPosition(Vector(1, 1, 0))
+        player.setDirection(LEFT)
+        protocol.connectionLost(None)
+        self.assertEqual(world.getDelayedCalls(), [])
+
+
+    def test_connectionLostStopsInterestCheck(self):
+        """
+        L{Gam3Server.connectionLost} stops checking which players are in range.
+        """
+        world, protocol, clock = self.introduced()
+        protocol.connectionLost(None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
     def test_connectionLost(self):
         """
         The L{Gam3Server} should remove its L{Player} from the
@@ -323,6 +589,86 @@ class NetworkTests(TestCase, ArrayMixin):
         self.assertFalse(player in world.players)
 
 
+    def test_connectionLostStopsObserving(self):
+        """
+        A L{Gam3Server} whose connection is lost no longer observes the
+        L{World} or the other L{Player}s, so it sends nothing more when they
+        are created or change direction.
+        """
+        world, protocol, clock = self.introduced()
+        player = world.createPlayer()
+        player.setPosition(Vector(1, 1, 0))
+        protocol.connectionLost(None)
+        self.calls = []
+        player.setDirection(LEFT)
+        world.createPlayer()
+        world.removePlayer(player)
+        self.assertEqual(self.calls, [])
+        self.assertNotIn(protocol, world.observers)
+
+
+    def test_otherConnectionsAfterConnectionLost(self):
+        """
+        After one client disconnects, the other clients' players can still
+        move and new clients can still be introduced.
+        """
+        world = World()
+        protocols = []
+        for i in range(2):
+            protocol = Gam3Server(world, clock=Clock())
+            protocol.makeConnection(StringTransport())
+            protocol.introduce()
+            protocol.clock.advance(0)
+            protocols.append(protocol)
+        first, second = protocols
+        first.connectionLost(None)
+        second.player.setDirection(LEFT)
+        third = Gam3Server(world, clock=Clock())
+        third.makeConnection(StringTransport())
+        third.introduce()
+        self.assertEqual(
+            set(world.getPlayers()), set([second.player, third.player]))
+
+
+    def test_connectionLostStopsTerrainCache(self):
+        """
+        A L{Gam3Server} created without a L{TerrainCache} stops watching the
+        terrain when its connection is lost, so connecting and disconnecting
+        repeatedly leaves no observers behind.
+        """
+        world = World()
+        observers = len(world.terrain._observers)
+        for i in range(3):
+            protocol = Gam3Server(world, clock=Clock())
+            protocol.makeConnection(StringTransport())
+            protocol.introduce()
+            protocol.connectionLost(None)
+        self.assertEquals(len(world.terrain._observers), observers)
+
+
+    def test_connectionLostKeepsSharedTerrainCache(self):
+        """
+        A L{TerrainCache} given to a L{Gam3Server} is still watching the
+        terrain after the connection is lost, for the other connections
+        sharing it.
+        """
+        world = World()
+        observers = len(world.terrain._observers)
+        factory = Gam3Factory(world)
+        for i in range(3):
+            protocol = factory.buildProtocol(None)
+            protocol.clock = Clock()
+            protocol.makeConnection(StringTransport())
+            protocol.introduce()
+            protocol.connectionLost(None)
+        world.terrain.set(0, 0, 0, loadTerrainFromString("G"))
+        factory.terrainCache.get(0, 0, 0, None)
+        world.terrain.set(0, 0, 0, loadTerrainFromString("W"))
+        self.assertEquals(len(factory.terrainCache), 0)
+        self.assertEquals(
+            len(world.terrain._observers), observers + 1)
+
+
     def test_setMyDirection(self):
         """
         The server should respond to L{SetMyDirection} commands and
@@ -344,6 +690,20 @@ class NetworkTests(TestCase, ArrayMixin):
         return d
 
 
+    def test_setMyDirectionSequence(self):
+        """
+        The server answers a L{SetMyDirection} command with the sequence number
+        it was sent with.
+        """
+        protocol = Gam3Server(FakeWorld(), clock=Clock())
+        protocol.introduce()
+        responder = protocol.lookupFunction(SetMyDirection.commandName)
+        d = responder({"direction": Direction().toString(RIGHT), 'y': '1.5',
+                       'sequence': '12'})
+        d.addCallback(lambda box: self.assertEquals(box['sequence'], '12'))
+        return d
+
+
     def test_identifierForPlayer(self):
         """
         L{Gam3Server} should provide an identifier producing function
@@ -396,6 +756,247 @@ class NetworkTests(TestCase, ArrayMixin):
 
 
 
+    def test_getTerrainChunks(self):
+        """
+        L{Gam3Server} responds to L{GetTerrainChunks} commands by sending out a
+        L{SetTerrainChunks} command containing the terrain of each requested
+        chunk.
+        """
+        world = FakeWorld()
+        world.terrain.set(0, 0, 0, loadTerrainFromString("G"))
+        world.terrain.set(8, 0, 0, loadTerrainFromString("W"))
+        protocol = Gam3Server(world, clock=Clock())
+        protocol.callRemote = self.callRemote
+        protocol.introduce()
+        responder = protocol.lookupFunction(GetTerrainChunks.commandName)
+        d = responder(GetTerrainChunks.makeArguments(
+                {'positions': [(8, 0, 0), (0, 0, 0)]}, None))
+        d.addCallback(self.assertEquals, {})
+
+        [args] = self.getCommands(SetTerrainChunks)
+        [(x1, y1, z1, voxels1), (x2, y2, z2, voxels2)] = args['chunks']
+        self.assertEquals((x1, y1, z1, x2, y2, z2), (8, 0, 0, 0, 0, 0))
+        self.assertArraysEqual(voxels1, loadTerrainFromString("W"))
+        self.assertArraysEqual(voxels2, world.terrain.get(0, 0, 0, (8, 1, 1)))
+        return d
+
+
+    def test_getTerrainChunksSplit(self):
+        """
+        If the requested chunks do not fit in one AMP value, L{Gam3Server}
+        sends them in several L{SetTerrainChunks} commands.
+        """
+        world = FakeWorld()
+        world.terrain.set(0, 0, 0, numpy.zeros((8, 2, 8 * 600), 'b'))
+        protocol = Gam3Server(world, clock=Clock())
+        protocol.callRemote = self.callRemote
+        protocol.introduce()
+        positions = [(0, 0, z) for z in range(0, 8 * 600, 8)]
+        protocol.getTerrainChunks(positions)
+
+        commands = self.getCommands(SetTerrainChunks)
+        self.assertTrue(len(commands) > 1)
+        received = []
+        for args in commands:
+            self.assertTrue(
+                len(TerrainChunks().toString(args['chunks']))
+                <= MAX_VALUE_LENGTH)
+            received.extend((x, y, z) for (x, y, z, v) in args['chunks'])
+        self.assertEquals(received, positions)
+
+
+
+class TerrainCacheTests(TestCase, ArrayMixin):
+    """
+    Tests for L{TerrainCache}.
+    """
+    def setUp(self):
+        self.terrain = Terrain()
+        self.terrain.set(0, 0, 0, loadTerrainFromString("GD\nMW\nDG"))
+        self.cache = TerrainCache(self.terrain)
+
+
+    def test_get(self):
+        """
+        L{TerrainCache.get} returns the chunk at the given coordinates, clipped
+        to the extent of the terrain and encoded with the given compression.
+        """
+        encoded = self.cache.get(0, 0, 0, None)
+        self.assertIsInstance(encoded, EncodedTerrain)
+        expected = encodeTerrain(self.terrain.get(0, 0, 0, (2, 1, 3)), None)
+        self.assertEquals(
+            (encoded.shape, encoded.type, encoded.data, encoded.compression),
+            (expected.shape, expected.type, expected.data, None))
+
+        compressed = self.cache.get(0, 0, 0, 'zlib')
+        self.assertEquals(compressed.compression, 'zlib')
+        self.assertEquals(len(self.cache), 2)
+
+
+    def test_hit(self):
+        """
+        A chunk asked for again is not encoded again.  L{TerrainCache} counts
+        the chunks it found and the ones it had to encode.
+        """
+        first = self.cache.get(0, 0, 0, None)
+        self.assertIdentical(self.cache.get(0, 0, 0, None), first)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+
+    def test_invalidate(self):
+        """
+        A chunk is encoded again once the terrain it covers changes, even if
+        the change is beyond the extent it was clipped to.
+        """
+        self.cache.get(0, 0, 0, None)
+        self.cache.get(8, 0, 0, None)
+        self.terrain.set(0, 0, 5, loadTerrainFromString("W"))
+        self.assertEquals(len(self.cache), 1)
+
+        encoded = self.cache.get(0, 0, 0, None)
+        self.assertEquals(self.cache.misses, 3)
+        self.assertEquals(encoded.shape, (2, 1, 6))
+
+
+    def test_budget(self):
+        """
+        When the encoded data takes up more than L{TerrainCache.budget} bytes,
+        the least recently used chunks are forgotten.
+        """
+        self.terrain.set(0, 0, 0, numpy.zeros((24, 2, 8), 'b'))
+        self.cache.budget = 128 * 2
+        self.cache.get(0, 0, 0, None)
+        self.cache.get(8, 0, 0, None)
+        self.cache.get(0, 0, 0, None)
+        self.cache.get(16, 0, 0, None)
+        self.assertEquals(len(self.cache), 2)
+        self.assertEquals(self.cache.size, 128 * 2)
+
+        self.cache.get(0, 0, 0, None)
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 3))
+
+
+
+class BoxCacheTests(TestCase):
+    """
+    Tests for L{BoxCache} and its use by L{Gam3Server}.
+    """
+    arguments = {'identifier': 3, 'x': 1.5, 'y': 0.0, 'z': -2.5, 'speed': 10}
+
+    def setUp(self):
+        self.cache = BoxCache()
+
+
+    def test_serialize(self):
+        """
+        L{BoxCache.serialize} returns the wire form of the box of arguments
+        made by L{Command.makeArguments}.
+        """
+        self.assertEquals(
+            self.cache.serialize(NewPlayer, self.arguments),
+            NewPlayer.makeArguments(self.arguments, None).serialize())
+
+
+    def test_hit(self):
+        """
+        A command sent again with the same arguments does not have them
+        serialized again.  L{BoxCache} counts the commands it found and the
+        ones it serialized.
+        """
+        first = self.cache.serialize(NewPlayer, self.arguments)
+        self.assertIdentical(
+            self.cache.serialize(NewPlayer, self.arguments.copy()), first)
+        self.cache.serialize(RemovePlayer, {'identifier': 3})
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 2))
+
+
+    def test_size(self):
+        """
+        Only the L{BoxCache.size} most recently used commands are kept.
+        """
+        self.cache.size = 2
+        self.cache.serialize(RemovePlayer, {'identifier': 1})
+        self.cache.serialize(RemovePlayer, {'identifier': 2})
+        self.cache.serialize(RemovePlayer, {'identifier': 1})
+        self.cache.serialize(RemovePlayer, {'identifier': 3})
+        self.cache.serialize(RemovePlayer, {'identifier': 1})
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 3))
+        self.cache.serialize(RemovePlayer, {'identifier': 2})
+        self.assertEquals(self.cache.misses, 4)
+
+
+    def connect(self, features):
+        """
+        Create a L{Gam3Server} using C{self.cache} and connect it to a
+        L{StringTransport}, as though the client had agreed to C{features} in
+        L{Introduce}.
+        """
+        protocol = Gam3Server(FakeWorld(), boxCache=self.cache)
+        protocol.makeConnection(StringTransport())
+        protocol.features = frozenset(features)
+        return protocol
+
+
+    def sent(self, protocol):
+        """
+        Parse the boxes C{protocol} has written to its transport.
+        """
+        return parseString(protocol.transport.value())
+
+
+    def test_broadcast(self):
+        """
+        L{Gam3Server} protocols sharing a L{BoxCache} serialize the arguments
+        of a broadcast command only once.  Without L{UNANSWERED_UPDATES}, each
+        asks for an answer with its own tag.
+        """
+        protocols = [self.connect([]) for i in range(3)]
+        results = [
+            protocol.callRemote(NewPlayer, **self.arguments)
+            for protocol in protocols]
+        self.assertEquals(self.cache.misses, 1)
+        for protocol, result in zip(protocols, results):
+            self.assertNotIdentical(result, None)
+            [box] = self.sent(protocol)
+            self.assertEquals(box.pop(ASK), '1')
+            self.assertEquals(box.pop(COMMAND), NewPlayer.commandName)
+            self.assertEquals(
+                box, NewPlayer.makeArguments(self.arguments, None))
+
+
+    def test_unansweredBroadcast(self):
+        """
+        A broadcast command sent to a client which agreed to
+        L{UNANSWERED_UPDATES} asks for no answer.  Its bytes are the
+        C{_command} key followed by the serialized arguments from the
+        L{BoxCache}.
+        """
+        protocol = self.connect([UNANSWERED_UPDATES])
+        self.assertIdentical(
+            protocol.callRemote(NewPlayer, **self.arguments), None)
+        [box] = self.sent(protocol)
+        self.assertNotIn(ASK, box)
+        self.assertEquals(box[COMMAND], NewPlayer.commandName)
+        self.assertEquals(
+            protocol.transport.value(),
+            AmpBox({COMMAND: NewPlayer.commandName}).serialize()[:-2] +
+            self.cache.serialize(NewPlayer, self.arguments))
+
+
+    def test_otherCommands(self):
+        """
+        Commands not in L{Gam3Server.broadcastCommands} are sent by
+        L{AMP.callRemote}, each with its own tag.
+        """
+        protocol = self.connect([UNANSWERED_UPDATES])
+        d = protocol.callRemote(
+            SetTerrain, x=0, y=0, z=0, voxels=numpy.zeros((1, 1, 1), 'b'))
+        self.assertNotIdentical(d, None)
+        self.assertIn(ASK, self.sent(protocol)[0])
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 0))
+
+
+
 class FactoryTests(TestCase):
     """
     Tests for L{Gam3Factory}.
@@ -416,3 +1017,39 @@ class FactoryTests(TestCase):
         L{Gam3Factory} should be a Twisted Protocol Server Factory.
         """
         verifyObject(IProtocolFactory, Gam3Factory(None))
+
+
+    def test_sharedTerrainCache(self):
+        """
+        The protocols built by a L{Gam3Factory} share one L{TerrainCache} for
+        the terrain of the factory's L{World}.
+        """
+        world = FakeWorld()
+        factory = Gam3Factory(world)
+        first = factory.buildProtocol(None)
+        second = factory.buildProtocol(None)
+        self.assertIsInstance(first.terrainCache, TerrainCache)
+        self.assertIdentical(first.terrainCache.terrain, world.terrain)
+        self.assertIdentical(first.terrainCache, second.terrainCache)
+
+
+    def test_sharedBoxCache(self):
+        """
+        The protocols built by a L{Gam3Factory} share one L{BoxCache}.
+        """
+        factory = Gam3Factory(FakeWorld())
+        first = factory.buildProtocol(None)
+        second = factory.buildProtocol(None)
+        self.assertIsInstance(first.boxCache, BoxCache)
+        self.assertIdentical(first.boxCache, second.boxCache)
+
+
+    def test_batchUpdates(self):
+        """
+        L{Gam3Factory} builds protocols which batch updates if it is created
+        with C{batchUpdates} set.
+        """
+        self.assertFalse(
+            Gam3Factory(FakeWorld()).buildProtocol(None).batchUpdates)
+        factory = Gam3Factory(FakeWorld(), batchUpdates=True)
+        self.assertTrue(factory.buildProtocol(None).batchUpdates)
@@ -78,6 +78,20 @@ class TwistdPluginTests(TestCase, ArrayMixin):
             join(logDirectory, 'gam3'))
 
 
+    def test_batchUpdates(self):
+        """
+        The I{batch-updates} flag makes the factory's protocols send player
+        updates once per tick.
+        """
+        options = gam3plugin.options()
+        options.parseOptions([])
+        self.assertFalse(options['batch-updates'])
+        options.parseOptions(['--batch-updates'])
+        service = gam3plugin.makeService(options)
+        portNumber, factory = service.getServiceNamed(TCP_SERVICE_NAME).args
+        self.assertTrue(factory.batchUpdates)
+
+
     def test_imports(self):
         """
         Verify that the plugin module does not import gam3 at import time.
@@ -11,9 +11,11 @@ from twisted.application.service import IService
 
 from epsilon.structlike import record
 
-from gam3.world import Gam3Service, World, point
+from gam3.world import Gam3Service, World, SpatialIndex, point
 
 from game.vector import Vector
+from game.player import Player
+from game.direction import FORWARD
 from game.terrain import Terrain
 from game.test.test_environment import SimulationTimeTestsMixin
 from game.test.util import ArrayMixin, PlayerVisibilityObserver
@@ -79,6 +81,18 @@ class WorldTests(TestCase, ArrayMixin):
         self.assertEqual(observer.removedPlayers, [player])
 
 
+    def test_playerTable(self):
+        """
+        The players made by L{World.createPlayer} are kept in its
+        L{PlayerTable} until they are removed.
+        """
+        world = World()
+        player = world.createPlayer()
+        self.assertEqual(world.playerTable.players, [player])
+        world.removePlayer(player)
+        self.assertEqual(len(world.playerTable), 0)
+
+
     def test_removePlayerCallsObserversAfterRemovingPlayer(self):
         """
         In a C{playerRemoved} observer, the L{Player} who is being
@@ -101,6 +115,25 @@ class WorldTests(TestCase, ArrayMixin):
         self.assertEqual(existentPlayers, [False])
 
 
+    def test_removeObserver(self):
+        """
+        An observer removed with L{World.removeObserver} is no longer told
+        about players being created.
+        """
+        world = World()
+        created = []
+
+        class Observer(object):
+            def playerCreated(self, player):
+                created.append(player)
+
+        observer = Observer()
+        world.addObserver(observer)
+        world.removeObserver(observer)
+        world.createPlayer()
+        self.assertEqual(created, [])
+
+
     def test_createdPlayerIsTemporallyAligned(self):
         """
         L{World.createPlayer} should create a player in the same time continuum
@@ -147,6 +180,131 @@ class WorldTests(TestCase, ArrayMixin):
         self.assertEqual(list(world.getPlayers()), [player1, player2])
 
 
+    def test_playersNear(self):
+        """
+        L{World.playersNear} returns the players within a radius of a point.
+        """
+        world = World()
+        near = world.createPlayer()
+        far = world.createPlayer()
+        far.setPosition(Vector(100, 1, 100))
+        world.directionChanged(far)
+        self.assertEqual(
+            list(world.playersNear(near.getPosition(), 10)), [near])
+        self.assertEqual(
+            list(world.playersInBox(Vector(90, 0, 90), Vector(110, 2, 110))),
+            [far])
+
+
+    def test_movingPlayersReindexed(self):
+        """
+        Moving players are found where they are after simulation time
+        advances.
+        """
+        world = World()
+        player = world.createPlayer()
+        player.setPosition(Vector(0, 1, 0))
+        player.setDirection(FORWARD)
+        world.advance(50)
+        self.assertEqual(list(world.playersNear(Vector(0, 1, 0), 10)), [])
+        self.assertEqual(
+            list(world.playersNear(Vector(0, 1, -100), 10)), [player])
+
+        player.setDirection(None)
+        world.advance(50)
+        self.assertEqual(
+            list(world.playersNear(Vector(0, 1, -100), 10)), [player])
+
+
+    def test_removedPlayerNotIndexed(self):
+        """
+        A player removed from the world is no longer found by
+        L{World.playersNear}.
+        """
+        world = World()
+        player = world.createPlayer()
+        position = player.getPosition()
+        world.removePlayer(player)
+        self.assertEqual(list(world.playersNear(position, 10)), [])
+        self.assertNotIn(player, world.playerIndex)
+
+
+
+class SpatialIndexTests(TestCase):
+    """
+    Tests for L{SpatialIndex}.
+    """
+    def setUp(self):
+        self.index = SpatialIndex(10)
+        self.time = 0
+
+
+    def player(self, x, y, z):
+        """
+        Create a L{Player} at the given position and add it to the index.
+        """
+        player = Player(Vector(x, y, z), 1, lambda: self.time)
+        self.index.add(player)
+        return player
+
+
+    def test_inRadius(self):
+        """
+        L{SpatialIndex.inRadius} generates the players within a distance of a
+        point, including ones in other cells.
+        """
+        inside = self.player(1, 0, 1)
+        across = self.player(-3, 0, -4)
+        corner = self.player(8, 0, 8)
+        self.assertEqual(
+            set(self.index.inRadius(Vector(0, 0, 0), 5)), set([inside, across]))
+        self.assertEqual(
+            set(self.index.inRadius(Vector(0, 0, 0), 12)),
+            set([inside, across, corner]))
+
+
+    def test_inBox(self):
+        """
+        L{SpatialIndex.inBox} generates the players within an axis-aligned
+        box, whether it covers more or fewer cells than are occupied.
+        """
+        players = [self.player(x, 0, 0) for x in range(0, 100, 5)]
+        self.assertEqual(
+            set(self.index.inBox(Vector(12, -1, -1), Vector(27, 1, 1))),
+            set(players[3:6]))
+        self.assertEqual(
+            set(self.index.inBox(Vector(-1e6, -1, -1), Vector(1e6, 1, 1))),
+            set(players))
+
+
+    def test_update(self):
+        """
+        L{SpatialIndex.update} moves a player to the cell containing its
+        current position.
+        """
+        player = self.player(0, 0, 0)
+        player.setPosition(Vector(50, 0, 0))
+        self.assertEqual(list(self.index.inRadius(Vector(50, 0, 0), 1)), [])
+        self.index.update(player)
+        self.assertEqual(
+            list(self.index.inRadius(Vector(50, 0, 0), 1)), [player])
+        self.assertEqual(list(self.index.inRadius(Vector(0, 0, 0), 1)), [])
+
+
+    def test_remove(self):
+        """
+        L{SpatialIndex.remove} takes a player out of the index, and forgets
+        its cell if it was the only one there.
+        """
+        player = self.player(0, 0, 0)
+        self.index.remove(player)
+        self.assertNotIn(player, self.index)
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index._cells, {})
+        self.assertRaises(KeyError, self.index.remove, player)
+
+
+
 class WorldTimeTests(SimulationTimeTestsMixin, TestCase):
     """
     Tests for the time-simulating aspecst of L{World}.
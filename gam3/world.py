@@ -10,6 +10,8 @@ r"""
 """
 
 import random
+from collections import OrderedDict
+from math import floor
 
 from twisted.application.service import Service
 
@@ -26,6 +28,135 @@ GAM3_SERVICE_NAME = 'gam3-service-name'
 
 point = record('x y')
 
+
+
+class SpatialIndex(object):
+    """
+    A uniform grid over space in which each L{Player} is filed under the cell
+    containing its position, so that the players near a point can be found
+    without looking at all of them.  Positions are only read when a player is
+    added or L{update}d, so the index must be told about players which move.
+
+    @ivar cellSize: The length of the edges of the cubic cells.
+
+    @ivar _cells: A C{dict} mapping three-tuples of cell coordinates to
+        non-empty C{set}s of the players filed under those cells.
+
+    @ivar _cellOf: A C{dict} mapping players to the coordinates of the cells
+        they are filed under.
+    """
+    def __init__(self, cellSize):
+        self.cellSize = cellSize
+        self._cells = {}
+        self._cellOf = {}
+
+
+    def __len__(self):
+        """
+        Return the number of players in the index.
+        """
+        return len(self._cellOf)
+
+
+    def __contains__(self, player):
+        """
+        Return whether C{player} is in the index.
+        """
+        return player in self._cellOf
+
+
+    def _cell(self, position):
+        """
+        Return the coordinates of the cell containing the L{Vector}
+        C{position}.
+        """
+        size = self.cellSize
+        return (int(floor(position.x / size)),
+                int(floor(position.y / size)),
+                int(floor(position.z / size)))
+
+
+    def add(self, player):
+        """
+        File C{player} under the cell containing its current position.
+        """
+        self.update(player)
+
+
+    def update(self, player):
+        """
+        Move C{player} to the cell containing its current position, if it is
+        not there already.
+        """
+        cell = self._cell(player.getPosition())
+        old = self._cellOf.get(player)
+        if old != cell:
+            if old is not None:
+                self._discard(player, old)
+            self._cells.setdefault(cell, set()).add(player)
+            self._cellOf[player] = cell
+
+
+    def remove(self, player):
+        """
+        Take C{player} out of the index.
+
+        @raise KeyError: If C{player} is not in the index.
+        """
+        self._discard(player, self._cellOf.pop(player))
+
+
+    def _discard(self, player, cell):
+        players = self._cells[cell]
+        players.discard(player)
+        if not players:
+            del self._cells[cell]
+
+
+    def inBox(self, low, high):
+        """
+        Generate the players whose positions lie within an axis-aligned box.
+
+        @param low: A L{Vector} giving the corner of the box with the lowest
+            coordinates.
+        @param high: A L{Vector} giving the opposite corner.
+        """
+        lx, ly, lz = self._cell(low)
+        hx, hy, hz = self._cell(high)
+        volume = (hx - lx + 1) * (hy - ly + 1) * (hz - lz + 1)
+        if volume > len(self._cells):
+            # Fewer cells are occupied than the box covers, so look at those.
+            cells = [
+                (x, y, z) for (x, y, z) in self._cells
+                if lx <= x <= hx and ly <= y <= hy and lz <= z <= hz]
+        else:
+            cells = [
+                (x, y, z)
+                for x in xrange(lx, hx + 1)
+                for y in xrange(ly, hy + 1)
+                for z in xrange(lz, hz + 1)]
+        for cell in cells:
+            for player in self._cells.get(cell, ()):
+                v = player.getPosition()
+                if (low.x <= v.x <= high.x and low.y <= v.y <= high.y and
+                    low.z <= v.z <= high.z):
+                    yield player
+
+
+    def inRadius(self, center, radius):
+        """
+        Generate the players whose positions are within C{radius} of the
+        L{Vector} C{center}.
+        """
+        corner = Vector(radius, radius, radius)
+        for player in self.inBox(center + corner * -1, center + corner):
+            v = player.getPosition()
+            if ((v.x - center.x) ** 2 + (v.y - center.y) ** 2 +
+                (v.z - center.z) ** 2) <= radius ** 2:
+                yield player
+
+
+
 class World(SimulationTime):
     """
     All-encompassing model object for the state of a Gam3 game (until we get
@@ -40,7 +171,14 @@ class World(SimulationTime):
     @ivar observers: A C{list} of objects notified about state changes of this
         object.
 
-    @ivar players: A C{list} of L{Player}s in this world.
+    @ivar players: An L{OrderedDict} whose keys are the L{Player}s in this
+        world, in the order they were created.
+
+    @ivar playerIndex: A L{SpatialIndex} of the L{Player}s in this world.  The
+        positions of moving players are brought up to date each time
+        simulation time advances.
+
+    @ivar _moving: The C{set} of L{Player}s in this world with a direction.
 
     @ivar terrain: A C{dict} mapping x, y coordinate tuples to a terrain type
         for that location.
@@ -53,7 +191,9 @@ class World(SimulationTime):
         self.random = random
         self.playerCreationRectangle = playerCreationRectangle
         self.observers = []
-        self.players = []
+        self.players = OrderedDict()
+        self.playerIndex = SpatialIndex(16)
+        self._moving = set()
         self.terrain = Terrain()
 
 
@@ -65,10 +205,12 @@ class World(SimulationTime):
         x = self.random.randrange(sw.x, ne.x)
         y = 1.0
         z = self.random.randrange(sw.y, ne.y)
-        player = Player(Vector(x, y, z), 2, self.seconds)
+        player = Player(Vector(x, y, z), 2, self.seconds, self.playerTable)
         for observer in self.observers:
             observer.playerCreated(player)
-        self.players.append(player)
+        self.players[player] = None
+        self.playerIndex.add(player)
+        player.addObserver(self)
         return player
 
 
@@ -77,7 +219,10 @@ class World(SimulationTime):
         Stop tracking the given L{Player} and notify observers via the
         C{playerRemoved} method.
         """
-        self.players.remove(player)
+        del self.players[player]
+        self.playerTable.remove(player)
+        self.playerIndex.remove(player)
+        self._moving.discard(player)
         for observer in self.observers:
             observer.playerRemoved(player)
 
@@ -90,6 +235,14 @@ class World(SimulationTime):
         self.observers.append(observer)
 
 
+    def removeObserver(self, observer):
+        """
+        Stop notifying C{observer}, which was added with L{addObserver}, of
+        state changes in this world.
+        """
+        self.observers.remove(observer)
+
+
     def getPlayers(self):
         """
         Return an iterator of all L{Player}s in this L{World}.
@@ -97,6 +250,45 @@ class World(SimulationTime):
         return iter(self.players)
 
 
+    def playersNear(self, position, radius):
+        """
+        Return an iterator of the L{Player}s in this L{World} within C{radius}
+        of the L{Vector} C{position}.
+        """
+        return self.playerIndex.inRadius(position, radius)
+
+
+    def playersInBox(self, low, high):
+        """
+        Return an iterator of the L{Player}s in this L{World} within the
+        axis-aligned box with corners at the L{Vector}s C{low} and C{high}.
+        """
+        return self.playerIndex.inBox(low, high)
+
+
+    def directionChanged(self, player):
+        """
+        Re-index a L{Player} of this world which has changed direction, and
+        remember whether it is moving.
+        """
+        if player not in self.players:
+            return
+        self.playerIndex.update(player)
+        if player.direction is None:
+            self._moving.discard(player)
+        else:
+            self._moving.add(player)
+
+
+    def advance(self, amount):
+        """
+        Advance simulation time and re-index the players which are moving.
+        """
+        SimulationTime.advance(self, amount)
+        for player in self._moving:
+            self.playerIndex.update(player)
+
+
 
 class Gam3Service(Service):
     """
@@ -6,7 +6,7 @@ Model code for the substrate the game world inhabits.
 
 from twisted.internet.task import LoopingCall, Clock
 
-from game.player import Player
+from game.player import Player, PlayerTable
 from game.terrain import Terrain
 
 
@@ -33,6 +33,10 @@ class SimulationTime(Clock):
     @ivar terrain: A C{dict} mapping two-tuples of (x, y) model
         coordinates to terrain types.
 
+    @ivar playerTable: The L{PlayerTable} holding the state of the players
+        in the simulation, all of which are moved along each time it
+        advances.
+
     @ivar _call: The result of the latest call to C{scheduler}.
     """
     _call = None
@@ -42,6 +46,15 @@ class SimulationTime(Clock):
         self.granularity = granularity
         self.platformClock = platformClock
         self.terrain = Terrain()
+        self.playerTable = PlayerTable(self.seconds)
+
+
+    def advance(self, amount):
+        """
+        Advance the simulation time and move every player along to it.
+        """
+        Clock.advance(self, amount)
+        self.playerTable.advance()
 
 
     def _update(self, frames):
@@ -124,7 +137,7 @@ class Environment(SimulationTime):
 
         @return: The new L{Player}
         """
-        player = Player(position, speed, self.seconds)
+        player = Player(position, speed, self.seconds, self.playerTable)
         for observer in self.observers:
             observer.playerCreated(player)
         return player
@@ -134,6 +147,7 @@ class Environment(SimulationTime):
         """
         Broadcast the removal of the given player to all registered observers.
         """
+        self.playerTable.remove(player)
         for observer in self.observers:
             observer.playerRemoved(player)
 
@@ -5,13 +5,18 @@ Network support for Game.
 """
 
 import numpy
-from struct import pack, unpack
+from struct import calcsize, pack, unpack
+from zlib import compress, decompress
 
 from twisted.protocols.amp import (
-    AMP, Command, Integer, Float, Argument)
+    AMP, Command, Integer, Float, String, ListOf, AmpList, Argument,
+    MAX_VALUE_LENGTH)
+
+from epsilon.structlike import record
 
 from game.environment import Environment
 from game.vector import Vector
+from game.player import heading
 
 class Direction(Argument):
     """
@@ -43,28 +48,123 @@ class Direction(Argument):
 class Introduce(Command):
     """
     Client greeting message used to retrieve initial model state.
+
+    @param compression: The names of the L{TERRAIN_COMPRESSION} methods the
+        client can decode, most preferred first.  The server answers with the
+        C{compression} it will use for terrain data, if any.
+
+    @param features: The names of the L{PROTOCOL_FEATURES} the client
+        supports.  The server answers with the C{features} it supports too,
+        and only those are used by either side.
     """
+    arguments = [('compression', ListOf(String(), optional=True)),
+                 ('features', ListOf(String(), optional=True))]
+
     response = [('identifier', Integer()),
                 ('granularity', Integer()),
                 ('speed', Integer()),
                 ('x', Float()),
                 ('y', Float()),
-                ('z', Float())]
+                ('z', Float()),
+                ('compression', String(optional=True)),
+                ('features', ListOf(String(), optional=True))]
+
+
+
+# Optional parts of the protocol, which a peer that does not know about them
+# must never be sent.  TERRAIN_CHUNKS allows the L{GetTerrainChunks} and
+# L{SetTerrainChunks} commands.  UNANSWERED_UPDATES allows the server to send
+# L{NewPlayer}, L{RemovePlayer} and L{SetDirectionOf} without asking for an
+# answer.  BATCHED_UPDATES allows the server to send L{SetDirectionsOf}.
+TERRAIN_CHUNKS = "terrain-chunks"
+UNANSWERED_UPDATES = "unanswered-updates"
+BATCHED_UPDATES = "batched-updates"
+PROTOCOL_FEATURES = frozenset(
+    [TERRAIN_CHUNKS, UNANSWERED_UPDATES, BATCHED_UPDATES])
+
+
+
+# Ways terrain data may be compressed on the wire, mapping names to two-tuples
+# of functions to compress and decompress a string or buffer.  Terrain is
+# mostly long runs of the same few values, so even the fastest zlib level
+# shrinks it severalfold.
+TERRAIN_COMPRESSION = {
+    "zlib": (lambda data: compress(data, 1), decompress)}
+
+
+
+class EncodedTerrain(record('shape type data compression')):
+    """
+    Voxels already encoded for L{Terrain} or L{TerrainChunks}, so that terrain
+    which is sent many times need only be encoded once.
+
+    @ivar shape: A three-tuple giving the shape of the voxel array.
+    @ivar type: The name of the element type of the voxel array.
+    @ivar data: The raw bytes of the voxel array, compressed with
+        C{compression}.
+    @ivar compression: The name of a method in L{TERRAIN_COMPRESSION}, or
+        C{None} if C{data} is not compressed.
+    """
+
+
+
+def encodeTerrain(voxels, compression):
+    """
+    Encode an array of voxels for sending with L{Terrain} or L{TerrainChunks}.
+
+    @param voxels: An L{numpy.array} of voxels.
+    @param compression: The name of a method in L{TERRAIN_COMPRESSION}, or
+        C{None} to leave the data uncompressed.
+
+    @rtype: L{EncodedTerrain}
+    """
+    if compression is None:
+        # This gathers a non-contiguous view straight into the string.
+        data = voxels.tostring()
+    else:
+        # Compress straight from the array's memory rather than a copy of it.
+        data = TERRAIN_COMPRESSION[compression][0](
+            buffer(numpy.ascontiguousarray(voxels)))
+    return EncodedTerrain(voxels.shape, str(voxels.dtype), data, compression)
+
+
+def _encoded(voxels, proto):
+    """
+    Return C{voxels} as an L{EncodedTerrain}, compressing it with the method
+    named by C{proto.terrainCompression} if it is not encoded already.
+    """
+    if isinstance(voxels, EncodedTerrain):
+        return voxels
+    return encodeTerrain(voxels, getattr(proto, 'terrainCompression', None))
+
+
+def _decompressTerrain(name, strings, data):
+    """
+    Decompress terrain data with the method recorded in C{strings}, if any.
+    """
+    compression = strings.get(name + "-compression")
+    if compression is None:
+        return data
+    return TERRAIN_COMPRESSION[compression][1](data)
 
 
 
 class Terrain(Argument):
     """
     Encode a L{numpy.array} into shape information and raw bytes which can be
-    used to reconstruct it.
+    used to reconstruct it.  The bytes are compressed if the protocol has a
+    C{terrainCompression} attribute naming one of L{TERRAIN_COMPRESSION}.  An
+    L{EncodedTerrain} may be given instead of an array and is sent as is.
     """
     def toBox(self, name, strings, objects, proto):
-        a = objects[name]
+        a = _encoded(objects[name], proto)
         strings[name + "-dx"] = str(a.shape[0])
         strings[name + "-dy"] = str(a.shape[1])
         strings[name + "-dz"] = str(a.shape[2])
-        strings[name + "-type"] = str(a.dtype)
-        strings[name + "-data"] = a.tostring()
+        strings[name + "-type"] = a.type
+        strings[name + "-data"] = a.data
+        if a.compression is not None:
+            strings[name + "-compression"] = a.compression
 
 
     def fromBox(self, name, strings, objects, proto):
@@ -72,8 +172,11 @@ class Terrain(Argument):
             int(strings[name + "-dx"]),
             int(strings[name + "-dy"]),
             int(strings[name + "-dz"]))
-        array = numpy.fromstring(
-            strings[name + "-data"], strings[name + "-type"]).reshape(shape)
+        # The array shares memory with the (immutable) string, so it is
+        # read-only.
+        data = _decompressTerrain(name, strings, strings[name + "-data"])
+        array = numpy.frombuffer(
+            data, strings[name + "-type"]).reshape(shape)
         objects[name] = array
 
 
@@ -102,6 +205,407 @@ class SetTerrain(Command):
 
 
 
+def batches(items, sizeOf, limit=MAX_VALUE_LENGTH):
+    """
+    Split a sequence into lists small enough to be encoded in one AMP value.
+
+    @param items: The sequence to split.
+    @param sizeOf: A one-argument callable returning the number of bytes an
+        element of C{items} takes up when encoded.
+    @param limit: The largest number of bytes to put in one list.  An element
+        which is larger than this on its own is put in a list by itself.
+
+    @return: An iterator of non-empty C{list}s, which together hold the
+        elements of C{items} in order.
+    """
+    batch = []
+    size = 0
+    for item in items:
+        itemSize = sizeOf(item)
+        if batch and size + itemSize > limit:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(item)
+        size += itemSize
+    if batch:
+        yield batch
+
+
+
+class Positions(Argument):
+    """
+    Encode a C{list} of three-tuples of integers as big-endian 32 bit
+    integers.
+    """
+    @classmethod
+    def size(cls, position):
+        """
+        Return the number of bytes C{position} takes up when encoded.
+        """
+        return 12
+
+
+    def toString(self, positions):
+        """
+        Convert the positions to bytes.
+        """
+        return numpy.array(positions, '>i4').tostring()
+
+
+    def fromString(self, encodedPositions):
+        """
+        Convert the positions from bytes.
+        """
+        coordinates = numpy.frombuffer(encodedPositions, '>i4').tolist()
+        return zip(coordinates[0::3], coordinates[1::3], coordinates[2::3])
+
+
+
+class TerrainChunks(Argument):
+    """
+    Encode a C{list} of four-tuples of the x, y, and z coordinates of some
+    terrain and an L{numpy.array} of its voxels.  Each is encoded as the
+    coordinates, the shape of the array and the length of its data, followed by
+    its data.  The data is compressed like that of L{Terrain}, and an
+    L{EncodedTerrain} may likewise be given instead of an array.
+    """
+    _header = "!iiiHHHI"
+
+    @classmethod
+    def size(cls, chunk):
+        """
+        Return the largest number of bytes C{chunk} may take up when encoded.
+        """
+        voxels = chunk[3]
+        if isinstance(voxels, EncodedTerrain):
+            size = len(voxels.data)
+        else:
+            # zlib's compressBound.
+            size = voxels.size
+            size += (size >> 12) + (size >> 14) + (size >> 25) + 13
+        return calcsize(cls._header) + size
+
+
+    def toString(self, chunks):
+        """
+        Convert the chunks to uncompressed bytes.
+        """
+        return self._encode(chunks, None)
+
+
+    def fromString(self, encodedChunks):
+        """
+        Convert the chunks from uncompressed bytes.
+        """
+        return self._decode(encodedChunks, None)
+
+
+    def toBox(self, name, strings, objects, proto):
+        compression = getattr(proto, 'terrainCompression', None)
+        strings[name] = self._encode(objects[name], compression)
+        if compression is not None:
+            strings[name + "-compression"] = compression
+
+
+    def fromBox(self, name, strings, objects, proto):
+        objects[name] = self._decode(
+            strings[name], strings.get(name + "-compression"))
+
+
+    def _encode(self, chunks, compression):
+        """
+        Convert the chunks to bytes, compressing the data of each with the
+        method named by C{compression}.
+
+        @raise ValueError: If one of the chunks is an L{EncodedTerrain}
+            compressed some other way.
+        """
+        encoded = []
+        for (x, y, z, voxels) in chunks:
+            if not isinstance(voxels, EncodedTerrain):
+                voxels = encodeTerrain(
+                    numpy.asarray(voxels, 'b'), compression)
+            elif voxels.compression != compression:
+                raise ValueError(
+                    "Chunk encoded with %r, not %r" % (
+                        voxels.compression, compression))
+            encoded.append(
+                pack(self._header, x, y, z,
+                     *(voxels.shape + (len(voxels.data),))))
+            encoded.append(voxels.data)
+        return ''.join(encoded)
+
+
+    def _decode(self, encodedChunks, compression):
+        """
+        Convert the chunks from bytes, decompressing the data of each with the
+        method named by C{compression}.  Uncompressed voxels are read-only
+        arrays sharing memory with C{encodedChunks}.
+        """
+        headerSize = calcsize(self._header)
+        chunks = []
+        offset = 0
+        while offset < len(encodedChunks):
+            x, y, z, dx, dy, dz, length = unpack(
+                self._header, encodedChunks[offset:offset + headerSize])
+            offset += headerSize
+            if compression is None:
+                voxels = numpy.frombuffer(encodedChunks, 'b', length, offset)
+            else:
+                voxels = numpy.frombuffer(TERRAIN_COMPRESSION[compression][1](
+                        buffer(encodedChunks, offset, length)), 'b')
+            offset += length
+            chunks.append((x, y, z, voxels.reshape((dx, dy, dz))))
+        return chunks
+
+
+
+class GetTerrainChunks(Command):
+    """
+    Request several chunks of terrain data from the server at once.  This
+    command has no response, but will cause the server to send one or more
+    L{SetTerrainChunks} soon.
+
+    @param positions: A C{list} of the coordinates of the chunks, which must
+        fit in one AMP value (see L{batches}).
+    """
+    arguments = [('positions', Positions())]
+
+    requiresAnswer = False
+
+
+
+class SetTerrainChunks(Command):
+    """
+    Specify the terrain data of several chunks at once.
+
+    @param chunks: A C{list} of four-tuples like the arguments of
+        L{SetTerrain}, which must fit in one AMP value (see L{batches}).
+    """
+    arguments = [('chunks', TerrainChunks())]
+
+    requiresAnswer = False
+
+
+
+class TerrainRequests(object):
+    """
+    Keep track of the requests for terrain which have been sent but not yet
+    answered, so that no more than one request for any chunk is outstanding at
+    a time.  A request which goes unanswered for too long is sent again, up to
+    a limit.  No more than C{limit} requests are outstanding at once; the rest
+    wait in a queue, in priority order, and are sent as earlier requests are
+    answered or given up on.  Requests sent at the same time are batched into
+    L{GetTerrainChunks} commands if the server supports them.
+
+    @ivar network: An object with a C{callRemote} method, like L{AMP}, to send
+        requests with, and a C{features} attribute like that of
+        L{NetworkController}.
+
+    @ivar clock: A provider of L{IReactorTime} used to time out requests.
+
+    @ivar timeout: The number of seconds to wait for an answer before sending a
+        request again.
+
+    @ivar attempts: The number of times to send a request for one chunk before
+        giving up on it.
+
+    @ivar limit: The maximum number of requests to have outstanding at once.
+
+    @ivar sent: The number of chunks which have been requested.
+
+    @ivar duplicates: The number of requests which were not sent because an
+        identical request was already outstanding.
+
+    @ivar retries: The number of requests which have been sent again after
+        timing out.
+
+    @ivar failures: The number of requests which were given up on after timing
+        out C{attempts} times, or because the command sending them failed.
+
+    @ivar completed: The number of requests which have been answered.
+
+    @ivar _pending: A C{dict} mapping the coordinates of each outstanding
+        request to a two-tuple of the number of times it has been sent and the
+        L{IDelayedCall} which will time it out.
+
+    @ivar _queue: A C{list} of the coordinates of requests which have not been
+        sent yet, most urgent first.
+    """
+    timeout = 10
+    attempts = 3
+    limit = 8
+
+    def __init__(self, network, terrain, clock):
+        self.network = network
+        self.clock = clock
+        self.sent = self.duplicates = self.retries = 0
+        self.failures = self.completed = 0
+        self._pending = {}
+        self._queue = []
+        # Forgetting a chunk answers nothing.
+        terrain.addObserver(self.terrainChanged, unloads=False)
+
+
+    def __len__(self):
+        """
+        Return the number of outstanding requests.
+        """
+        return len(self._pending)
+
+
+    def __contains__(self, position):
+        """
+        Return whether a request for the terrain at the three-tuple C{position}
+        is outstanding.
+        """
+        return position in self._pending
+
+
+    def request(self, x, y, z):
+        """
+        Ask the server for the chunk of terrain at the given coordinates, unless
+        it has already been asked and has not yet answered.  If C{limit}
+        requests are already outstanding, the request is queued behind any
+        others which are waiting.
+
+        @return: C{True} if a request was sent or queued, C{False} otherwise.
+        """
+        position = (x, y, z)
+        if position in self._pending or position in self._queue:
+            self.duplicates += 1
+            return False
+        self._queue.append(position)
+        self._sendQueued()
+        return True
+
+
+    def want(self, positions):
+        """
+        Replace the queue of requests waiting to be sent and send as many of
+        them as C{limit} allows.  Requests which were queued before but are not
+        in C{positions} are dropped.
+
+        @param positions: A sequence of three-tuples giving the coordinates of
+            chunks of terrain to request, most urgent first.
+        """
+        self._queue = []
+        for position in positions:
+            if position in self._pending:
+                self.duplicates += 1
+            else:
+                self._queue.append(position)
+        self._sendQueued()
+
+
+    def _sendQueued(self):
+        """
+        Send requests from the front of the queue until C{limit} requests are
+        outstanding or the queue is empty.
+        """
+        positions = []
+        while self._queue and len(self._pending) + len(positions) < self.limit:
+            positions.append(self._queue.pop(0))
+        self._send(positions, 1)
+
+
+    def _send(self, positions, attempt):
+        """
+        Request the chunks at C{positions}: several with as few
+        L{GetTerrainChunks} commands as will hold them if the server supports
+        L{TERRAIN_CHUNKS}, otherwise each with a L{GetTerrain} command.
+        """
+        features = getattr(self.network, 'features', ())
+        if len(positions) > 1 and TERRAIN_CHUNKS in features:
+            sent = [
+                (batch, self.network.callRemote(
+                        GetTerrainChunks, positions=batch))
+                for batch in batches(positions, Positions.size)]
+        else:
+            sent = [
+                ([(x, y, z)], self.network.callRemote(
+                        GetTerrain, x=x, y=y, z=z))
+                for (x, y, z) in positions]
+        for position in positions:
+            self.sent += 1
+            call = self.clock.callLater(self.timeout, self._timedOut, position)
+            self._pending[position] = (attempt, call)
+        # These commands need no answer, so callRemote only gives a Deferred
+        # when it cannot send them at all.
+        for batch, d in sent:
+            if d is not None:
+                d.addErrback(
+                    self._failed, [(p, self._pending[p]) for p in batch])
+
+
+    def _failed(self, reason, requests):
+        """
+        Give up on requests whose command failed, rather than waiting for them
+        to time out.
+
+        @param requests: A C{list} of two-tuples of the coordinates of a
+            request and the value in C{_pending} for it when it was sent.  A
+            request which has since been answered or sent again is left alone.
+        """
+        for position, pending in requests:
+            if self._pending.get(position) is pending:
+                del self._pending[position]
+                attempt, call = pending
+                call.cancel()
+                self.failures += 1
+        self._sendQueued()
+
+
+    def _timedOut(self, position):
+        """
+        Send a request again if it has not been sent too many times already, or
+        give up on it.
+        """
+        attempt, call = self._pending.pop(position)
+        if attempt < self.attempts:
+            self.retries += 1
+            self._send([position], attempt + 1)
+        else:
+            self.failures += 1
+            self._sendQueued()
+
+
+    def terrainChanged(self, position, shape):
+        """
+        Terrain observer which notices the answers to outstanding requests.  The
+        server answers with a L{SetTerrain} or L{SetTerrainChunks} entry for
+        each chunk, starting at the requested position, possibly with no voxels
+        if the request is beyond the edge of the world.  Queued requests which
+        the new terrain covers are dropped.
+        """
+        low = (position.x, position.y, position.z)
+        high = (
+            position.x + shape.x, position.y + shape.y, position.z + shape.z)
+        def covered(key):
+            return key == low or all(
+                l <= n < h for (l, n, h) in zip(low, key, high))
+        for key in self._pending.keys():
+            if covered(key):
+                attempt, call = self._pending.pop(key)
+                call.cancel()
+                self.completed += 1
+        self._queue = [key for key in self._queue if not covered(key)]
+        self._sendQueued()
+
+
+    def stop(self):
+        """
+        Forget about all outstanding and queued requests and stop timing them
+        out.
+        """
+        for attempt, call in self._pending.itervalues():
+            call.cancel()
+        self._pending.clear()
+        del self._queue[:]
+
+
+
 class NewPlayer(Command):
     """
     Notify someone that a L{Player} with the given C{identifier} is at
@@ -144,18 +648,25 @@ class SetMyDirection(Command):
     @param y: The direction the player is facing.
     @type y: L{Float}
 
+    @param sequence: A number identifying this command among those the client
+        sent, increasing with each one.
+    @type sequence: L{Integer}
+
     @return x: The x coordinate of the player at the time the server received
         the Command.
     @return y: Same as x, save for the y coordinate.
     @return z: Same as x, save for the z coordinate.
+    @return sequence: The C{sequence} of the command.
     """
 
     arguments = [('direction', Direction()),
-                 ('y', Float())]
+                 ('y', Float()),
+                 ('sequence', Integer(optional=True))]
 
     response = [('x', Float()),
                 ('y', Float()),
-                ('z', Float())]
+                ('z', Float()),
+                ('sequence', Integer(optional=True))]
 
 
 
@@ -184,6 +695,31 @@ class SetDirectionOf(Command):
                  ('orientation', Float())]
 
 
+
+class SetDirectionsOf(Command):
+    """
+    Set the position, orientation, and direction of several L{Player}s.
+
+    This is a server to client command which carries, in one message, what
+    would otherwise be sent as a L{SetDirectionOf} command for each of them.
+
+    @param updates: A C{list} of C{dict}s with the arguments of
+        L{SetDirectionOf}.
+
+    @ivar updateSize: The most bytes one element of C{updates} can take up
+        when encoded: the keys and their 12 length prefixes, an identifier of
+        up to 20 digits, two bytes of direction, four floats of up to 24
+        characters each and the terminating empty key.
+    """
+
+    arguments = [('updates', AmpList(SetDirectionOf.arguments))]
+
+    requiresAnswer = False
+
+    updateSize = 33 + 12 * 2 + 20 + 2 + 4 * 24 + 2
+
+
+
 class NetworkController(AMP):
     """
     A controller which responds to AMP commands to make state changes to local
@@ -193,13 +729,51 @@ class NetworkController(AMP):
 
     @ivar clock: A provider of L{IReactorTime} which will be used to
         update the model time.
+
+    @ivar terrainCompression: The name of the L{TERRAIN_COMPRESSION} method
+        agreed on in L{Introduce}, or C{None}.
+
+    @ivar features: The C{frozenset} of L{PROTOCOL_FEATURES} agreed on in
+        L{Introduce}.
+
+    @ivar turnInterval: The fewest seconds between two L{SetMyDirection}
+        commands for a model object which only turned.  Turns within that
+        time of the last command are sent together, with the orientation the
+        object has at the end of it.  Changes in direction of movement are
+        always sent at once.
+
+    @ivar correctionPeriod: The number of seconds over which a remote player
+        is shown moving from where it was predicted to be to where a
+        L{SetDirectionOf} command puts it.
+
+    @ivar _lastSent: A C{dict} mapping model objects to two-tuples of the
+        direction of movement and the time of the last L{SetMyDirection}
+        command sent for them.
+
+    @ivar _pendingTurns: A C{dict} mapping model objects to the delayed calls
+        which will send their turns.
+
+    @ivar _sequence: The C{sequence} of the last L{SetMyDirection} command.
+
+    @ivar _inputs: A C{dict} mapping model objects to C{list}s of the
+        L{SetMyDirection} commands sent for them which the server has not
+        answered yet, as four-tuples of the sequence number, the model time
+        the command was sent at, and the direction and orientation it set.
     """
 
     environment = None
+    terrainCompression = None
+    features = frozenset()
+    turnInterval = 0.1
+    correctionPeriod = 0.2
 
     def __init__(self, clock):
         self.modelObjects = {}
         self.clock = clock
+        self._lastSent = {}
+        self._pendingTurns = {}
+        self._sequence = 0
+        self._inputs = {}
 
 
     def addModelObject(self, identifier, modelObject):
@@ -216,9 +790,36 @@ class NetworkController(AMP):
 
         @param modelObject: The L{Player} whose direction has changed.
         """
+        direction, sent = self._lastSent.get(modelObject, (None, None))
+        if modelObject.direction != direction or sent is None:
+            self._sendDirection(modelObject)
+        elif modelObject not in self._pendingTurns:
+            delay = sent + self.turnInterval - self.clock.seconds()
+            if delay <= 0:
+                self._sendDirection(modelObject)
+            else:
+                self._pendingTurns[modelObject] = self.clock.callLater(
+                    delay, self._sendDirection, modelObject)
+
+
+    def _sendDirection(self, modelObject):
+        """
+        Send the direction of movement and orientation of a local model object
+        to the server with a L{SetMyDirection} command, replacing any pending
+        turn.
+        """
+        call = self._pendingTurns.pop(modelObject, None)
+        if call is not None and call.active():
+            call.cancel()
+        self._lastSent[modelObject] = (
+            modelObject.direction, self.clock.seconds())
+        self._sequence += 1
+        y = modelObject.orientation.y
+        self._inputs.setdefault(modelObject, []).append(
+            (self._sequence, modelObject.seconds(), modelObject.direction, y))
         d = self.callRemote(
             SetMyDirection,
-            direction=modelObject.direction, y=modelObject.orientation.y)
+            direction=modelObject.direction, y=y, sequence=self._sequence)
         d.addCallback(self._gotNewPosition, modelObject)
         # XXX Add an errback
 
@@ -227,11 +828,35 @@ class NetworkController(AMP):
         """
         Update a L{Player}'s position based on new data from the server.
 
+        The position is where the player was when the server carried out the
+        L{SetMyDirection} command with the given C{sequence}.  The commands
+        sent since then are replayed on top of it, so that the player ends up
+        where the server will put it once it has carried those out too,
+        rather than going back to where it was a round trip ago.  The answer
+        to a command older than one already answered is ignored.
+
         @param player: The L{Player} whose position to change.
-        @param position: Dict with C{x} and C{y} keys, whose values should be
-        integers specifying position.
+        @param position: Dict with C{x}, C{y} and C{z} keys, whose values
+            specify position, and optionally a C{sequence} key.
         """
-        player.setPosition(Vector(position['x'], position['y'], position['z']))
+        v = Vector(position['x'], position['y'], position['z'])
+        sequence = position.get('sequence')
+        if sequence is None:
+            self._inputs.pop(player, None)
+            player.setPosition(v)
+            return
+        inputs = self._inputs.get(player, [])
+        while inputs and inputs[0][0] < sequence:
+            del inputs[0]
+        if not inputs or inputs[0][0] != sequence:
+            return
+        (ignored, time, direction, y) = inputs.pop(0)
+        for (ignored, next, nextDirection, nextY) in inputs + [
+            (None, player.seconds(), None, None)]:
+            if direction is not None:
+                v += heading(direction, y) * (player.speed * (next - time))
+            time, direction, y = next, nextDirection, nextY
+        player.setPosition(v)
 
 
     def createInitialPlayer(self, environment, identifier, position,
@@ -250,8 +875,13 @@ class NetworkController(AMP):
         Greet the server and register the player model object which belongs to
         this client and remember the identifier with which it responds.
         """
-        d = self.callRemote(Introduce)
+        d = self.callRemote(
+            Introduce, compression=sorted(TERRAIN_COMPRESSION),
+            features=sorted(PROTOCOL_FEATURES))
         def cbIntroduce(box):
+            self.terrainCompression = box.get('compression')
+            self.features = PROTOCOL_FEATURES.intersection(
+                box.get('features') or [])
             granularity = box['granularity']
             position = Vector(box['x'], box['y'], box['z'])
             speed = box['speed']
@@ -293,7 +923,8 @@ class NetworkController(AMP):
 
     def setDirectionOf(self, identifier, direction, x, y, z, orientation):
         """
-        Set the direction of a local model object.
+        Set the direction of a local model object.  Its position is
+        corrected over C{correctionPeriod} seconds rather than at once.
 
         @type identifier: L{int}
         @type direction: One of the L{game.direction} direction constants
@@ -301,13 +932,25 @@ class NetworkController(AMP):
         @see: L{SetDirectionOf}
         """
         player = self.objectByIdentifier(identifier)
-        player.setDirection(direction)
-        player.setPosition(Vector(x, y, z))
         player.orientation.y = orientation
+        player.setDirection(direction)
+        player.correctPosition(Vector(x, y, z), self.correctionPeriod)
         return {}
     SetDirectionOf.responder(setDirectionOf)
 
 
+    def setDirectionsOf(self, updates):
+        """
+        Set the direction of several local model objects.
+
+        @see: L{SetDirectionsOf}
+        """
+        for update in updates:
+            self.setDirectionOf(**update)
+        return {}
+    SetDirectionsOf.responder(setDirectionsOf)
+
+
     def newPlayer(self, identifier, x, y, z, speed):
         """
         Add a new L{Player} object to the L{Environment} and start
@@ -352,3 +995,29 @@ class NetworkController(AMP):
         self.environment.terrain.set(x, y, z, voxels)
         return {}
     SetTerrain.responder(setTerrain)
+
+
+    def setTerrainChunks(self, chunks):
+        """
+        Add the terrain information for several chunks to the environment.
+
+        @param chunks: A C{list} of four-tuples of the arguments to
+            L{setTerrain}.
+        """
+        for (x, y, z, voxels) in chunks:
+            self.environment.terrain.set(x, y, z, voxels)
+        return {}
+    SetTerrainChunks.responder(setTerrainChunks)
+
+
+    def connectionLost(self, reason):
+        """
+        Stop waiting to send turns to the server, and forget the commands
+        sent for each model object.
+        """
+        for call in self._pendingTurns.values():
+            call.cancel()
+        self._pendingTurns.clear()
+        self._lastSent.clear()
+        self._inputs.clear()
+        AMP.connectionLost(self, reason)
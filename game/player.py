@@ -2,6 +2,8 @@
 
 from math import cos, sin, pi
 
+import numpy
+
 from game.vector import Vector
 from game.direction import FORWARD, BACKWARD, LEFT, RIGHT
 
@@ -9,10 +11,11 @@ class Player(object):
     """
     An object with a position.
 
-    # XXX Call this class Character.
+    The state of a player is kept in a row of a L{PlayerTable}, shared with
+    other players so that they can all be moved along together.  A player
+    created without a table gets one of its own.
 
-    @ivar _lastPosition: A L{Vector} instance, specifying the last computed
-        position of player.
+    # XXX Call this class Character.
 
     @ivar seconds: A no-argument callable which returns the current time in
         seconds.
@@ -24,30 +27,59 @@ class Player(object):
     @ivar speed: The distance which can be covered when the player is in motion
         (probably in something like cm/sec, if x and y are in cm).
 
+    @ivar orientation: A L{Vector} giving the rotations of the player about
+        each axis, in degrees.  The heading of the player in its table follows
+        this only when L{setDirection} or L{turn} is called.
+
     @ivar observers: A C{list} of objects notified about state changes of this
         object.
-    """
 
-    # XXX: This shouldn't be public. (make it a property without a setter?)
-    direction = None
+    @ivar _table: The L{PlayerTable} holding the state of this player, or
+        C{None} once it has been removed from it.
+
+    @ivar _row: The index of the row of C{_table} for this player.
 
-    def __init__(self, position, speed, seconds):
+    @ivar _position: The three-tuple of the position a removed player had
+        when it was removed, which it keeps from then on.
+    """
+    _position = None
+
+    def __init__(self, position, speed, seconds, table=None):
+        """
+        @param table: The L{PlayerTable} to keep the state of this player in,
+            which must use C{seconds} as its clock.
+        """
         assert isinstance(position, Vector)
-        self._lastPosition = position
-        self._lastDirectionChange = seconds()
-        self.orientation = Vector(0, 0, 0)
-        self.speed = speed
+        if table is None:
+            table = PlayerTable(seconds)
+        self._table = table
+        self._row = table.add(self)
+        table.setPosition(self._row, position)
+        table.speeds[self._row] = speed or 0
         self.seconds = seconds
+        self.orientation = Vector(0, 0, 0)
         self.observers = []
 
 
+    @property
+    def direction(self):
+        direction = self._table.directions[self._row]
+        if direction == 0:
+            return None
+        return complex(direction)
+
+
+    @property
+    def speed(self):
+        return float(self._table.speeds[self._row])
+
+
     def setPosition(self, position):
         """
         Absolutely reposition this player.
         """
         assert isinstance(position, Vector)
-        self._lastPosition = position
-        self._lastDirectionChange = self.seconds()
+        self._table.setPosition(self._row, position)
 
 
     offset = {
@@ -66,26 +98,47 @@ class Player(object):
 
         @return: A L{Vector} giving the current position of the player.
         """
-        v = self._lastPosition
+        if self._table is None:
+            return Vector(*self._position)
+        return Vector(*self._table.position(self._row))
 
-        movement = self.direction
-        if movement is None:
-            return v
 
-        now = self.seconds()
-        elapsedTime = now - self._lastDirectionChange
-        magnitude = elapsedTime * self.speed
+    def getSmoothedPosition(self):
+        """
+        Retrieve the position at which to show the player.  This is the
+        current position, save that after L{correctPosition} it is blended
+        from where the player appeared to be to where it is.
 
-        y = self.orientation.y / 180 * pi + self.offset[movement]
-        direction = Vector(sin(y), 0, -cos(y))
+        @return: A L{Vector}.
+        """
+        if self._table is None:
+            return Vector(*self._position)
+        return Vector(*self._table.smoothedPosition(self._row))
 
-        # Multiply by the magnitude to get the distance traveled and add to the
-        # current position to get the new position. XXX This may be the wrong
-        # time to update _lastPosition and _lastDirectionChange.
-        self._lastPosition = v + direction * magnitude
-        self._lastDirectionChange = self.seconds()
 
-        return self._lastPosition
+    def correctPosition(self, position, period):
+        """
+        Reposition this player to where it is known to be, to be shown moving
+        there from where it appeared to be over C{period} seconds rather than
+        jumping there.
+
+        @param position: A L{Vector} giving the new position.
+        @param period: The number of seconds over which to blend the old
+            position into the new one.
+        """
+        assert isinstance(position, Vector)
+        self._table.correctPosition(self._row, position, period)
+
+
+    def getVelocity(self):
+        """
+        Retrieve the current rate of movement.
+
+        @return: A L{Vector} giving the distance the player moves along each
+            axis per second.
+        """
+        table = self._table
+        return Vector(*(table.headings[self._row] * table.speeds[self._row]))
 
 
     def setDirection(self, direction):
@@ -97,9 +150,7 @@ class Player(object):
         @param direction: One of the constants C{FORWARD}, C{BACKWARD}, etc, or
             C{None} if there is no movement.
         """
-        self._lastPosition = self.getPosition()
-        self._lastDirectionChange = self.seconds()
-        self.direction = direction
+        self._table.setDirection(self._row, direction, self.orientation.y)
 
         for observer in self.observers:
             observer.directionChanged(self)
@@ -111,6 +162,7 @@ class Player(object):
         """
         self.orientation.x += x
         self.orientation.y += y
+        self._table.setDirection(self._row, self.direction, self.orientation.y)
 
         for observer in self.observers:
             observer.directionChanged(self)
@@ -122,3 +174,212 @@ class Player(object):
         in this player.
         """
         self.observers.append(observer)
+
+
+    def removeObserver(self, observer):
+        """
+        Stop notifying C{observer}, which was added with L{addObserver}, of
+        state changes in this player.
+        """
+        self.observers.remove(observer)
+
+
+
+def heading(direction, y):
+    """
+    Compute the unit L{Vector} along which a L{Player} moves when going in
+    C{direction} while facing C{y} degrees about the Y axis.
+    """
+    y = y / 180.0 * pi + Player.offset[direction]
+    return Vector(sin(y), 0, -cos(y))
+
+
+
+class PlayerTable(object):
+    """
+    The state of a group of L{Player}s, kept in numpy arrays with one row for
+    each so that all of them can be moved along in one step.
+
+    A row gives where its player was at some time, and where it is at any later
+    time follows from its heading and speed.  L{advance} brings every row up
+    to the current time, so that positions are computed from a short interval
+    and are available in C{positions} all together.
+
+    @ivar seconds: A no-argument callable which returns the current time in
+        seconds.
+
+    @ivar players: A C{list} of the L{Player} for each row.
+
+    @ivar positions: An array of shape C{(n, 3)} giving where each player was
+        at the time in C{times}.
+
+    @ivar times: An array giving the time at which each player was at its
+        position.
+
+    @ivar speeds: An array giving the speed of each player.
+
+    @ivar directions: A complex array giving the direction of movement of each
+        player, or zero for one which is not moving.
+
+    @ivar headings: An array of shape C{(n, 3)} giving the unit vector along
+        which each player is moving, or zeros for one which is not moving.
+
+    @ivar corrections: An array of shape C{(n, 3)} giving how far from its
+        position each player appeared to be when it was last corrected.
+
+    @ivar correctionEnds: An array giving the time at which each player's
+        correction will have been blended away.
+
+    @ivar correctionPeriods: An array giving the number of seconds over which
+        each player's correction is blended away.
+
+    The arrays have room for more rows than there are players; only the first
+    C{len(players)} rows are used.
+    """
+    _columns = [
+        ('positions', (3,), float),
+        ('times', (), float),
+        ('speeds', (), float),
+        ('directions', (), complex),
+        ('headings', (3,), float),
+        ('corrections', (3,), float),
+        ('correctionEnds', (), float),
+        ('correctionPeriods', (), float)]
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.players = []
+        for (name, shape, dtype) in self._columns:
+            setattr(self, name, numpy.zeros((1,) + shape, dtype))
+
+
+    def __len__(self):
+        return len(self.players)
+
+
+    def add(self, player):
+        """
+        Add a row for C{player}, which is stopped at the origin with no speed
+        and return its index.
+        """
+        row = len(self.players)
+        if row == len(self.times):
+            for (name, shape, dtype) in self._columns:
+                old = getattr(self, name)
+                new = numpy.zeros((2 * row,) + shape, dtype)
+                new[:row] = old
+                setattr(self, name, new)
+        else:
+            for (name, shape, dtype) in self._columns:
+                getattr(self, name)[row] = 0
+        self.players.append(player)
+        self.times[row] = self.seconds()
+        return row
+
+
+    def remove(self, player):
+        """
+        Remove the row of C{player}, moving the last row into its place.  The
+        player keeps the position it has now, but no longer moves.
+        """
+        if player._table is not self:
+            raise ValueError("%r is not in this table" % (player,))
+        row = player._row
+        player._position = self.position(row)
+        last = len(self.players) - 1
+        for (name, shape, dtype) in self._columns:
+            array = getattr(self, name)
+            array[row] = array[last]
+        moved = self.players.pop()
+        if moved is not player:
+            self.players[row] = moved
+            moved._row = row
+        player._table = player._row = None
+
+
+    def position(self, row):
+        """
+        Return the current position of the player in C{row} as a three-tuple.
+        """
+        x, y, z = self.positions[row]
+        dx, dy, dz = self.headings[row]
+        distance = self.speeds[row] * (self.seconds() - self.times[row])
+        return (x + dx * distance, y + dy * distance, z + dz * distance)
+
+
+    def smoothedPosition(self, row):
+        """
+        Return the position of the player in C{row} with what is left of its
+        last correction added, as a three-tuple.
+        """
+        x, y, z = self.position(row)
+        remaining = self.correctionEnds[row] - self.seconds()
+        if remaining <= 0:
+            return (x, y, z)
+        dx, dy, dz = (
+            self.corrections[row] * (remaining / self.correctionPeriods[row]))
+        return (x + dx, y + dy, z + dz)
+
+
+    def _settle(self, row):
+        """
+        Bring C{row} up to the current time, so its heading can be changed.
+        """
+        self.positions[row] = self.position(row)
+        self.times[row] = self.seconds()
+
+
+    def _head(self, row, y):
+        """
+        Compute the heading of C{row} from its direction and a rotation of
+        C{y} degrees about the Y axis.
+        """
+        direction = self.directions[row]
+        if direction == 0:
+            self.headings[row] = 0
+        else:
+            v = heading(complex(direction), y)
+            self.headings[row] = (v.x, v.y, v.z)
+
+
+    def setPosition(self, row, position):
+        """
+        Put the player in C{row} at the L{Vector} C{position}.
+        """
+        self.positions[row] = (position.x, position.y, position.z)
+        self.times[row] = self.correctionEnds[row] = self.seconds()
+
+
+    def correctPosition(self, row, position, period):
+        """
+        Put the player in C{row} at the L{Vector} C{position}, but have its
+        smoothed position move there from where it was over C{period} seconds.
+        """
+        x, y, z = self.smoothedPosition(row)
+        self.setPosition(row, position)
+        if period > 0:
+            self.corrections[row] = (
+                x - position.x, y - position.y, z - position.z)
+            self.correctionEnds[row] += period
+            self.correctionPeriods[row] = period
+
+
+    def setDirection(self, row, direction, y):
+        """
+        Set the direction of movement of the player in C{row}, or stop it if
+        C{direction} is C{None}, facing C{y} degrees about the Y axis.
+        """
+        self._settle(row)
+        self.directions[row] = direction or 0
+        self._head(row, y)
+
+
+    def advance(self):
+        """
+        Bring every row up to the current time.
+        """
+        count = len(self.players)
+        now = self.seconds()
+        distances = self.speeds[:count] * (now - self.times[:count])
+        self.positions[:count] += self.headings[:count] * distances[:, None]
+        self.times[:count] = now
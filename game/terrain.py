@@ -2,9 +2,9 @@
 Functionality related to the shape of the world.
 """
 
-from numpy import array, zeros, empty
-
-from twisted.python.log import err
+from numpy import (
+    array, zeros, empty, ones, arange, unique, rollaxis, where,
+    ravel_multi_index)
 
 from epsilon.structlike import record
 
@@ -59,107 +59,289 @@ def loadTerrainFromSurface(surface):
     @return: A L{Terrain} populated with terrain data from the surface.
     """
     result = Terrain()
-    # Force it to be large enough right away, instead of scaling it up in bits
-    # and pieces which is much slower and fragments memory much more.
-    unknown = zeros((1, 1, 1), 'b')
-    unknown[0, 0, 0] = UNKNOWN
-    result.set(
-        surface.get_width() - 1, 255, surface.get_height() - 1,
-        unknown)
-    for x in range(surface.get_width()):
-        for z in range(surface.get_height()):
+    width = surface.get_width()
+    height = surface.get_height()
+    if not width or not height:
+        return result
+
+    heights = empty((width, height), 'i')
+    for x in range(width):
+        for z in range(height):
             r, g, b, a = surface.get_at((x, z))
-            r = max(1, r)
-            voxels = empty((1, r, 1), 'b')
-            voxels[:] = MOUNTAIN
-            voxels[0, r - 1, 0] = GRASS
-            result.set(x, 0, z, voxels)
+            heights[x, z] = max(1, r)
+
+    # Build the whole map up front and hand it to the terrain in one piece, so
+    # each chunk is only written once.
+    voxels = empty((width, heights.max(), height), 'b')
+    voxels.fill(UNKNOWN)
+    for x in range(width):
+        for z in range(height):
+            r = heights[x, z]
+            voxels[x, :r - 1, z] = MOUNTAIN
+            voxels[x, r - 1, z] = GRASS
+    result.set(0, 0, 0, voxels)
     return result
 
 
+
 class Terrain(object):
     """
-    @ivar voxels:
-    @type voxels: L{numpy.array}
+    Sparse storage for voxel data.  Voxels are kept in fixed-size chunks of
+    C{CHUNK_GRANULARITY}, each of which is allocated the first time any voxel
+    inside it is written.  Voxels in chunks which have never been written are
+    L{UNKNOWN}.
+
+    @ivar shape: A three-tuple of ints giving the extent of the known terrain
+        along each axis, starting from the origin.
+
+    @ivar chunkShape: A three-tuple of ints giving the dimensions of a chunk.
 
-    @ivar _observers:
-    @type _observers: C{list}
+    @ivar _chunks: A C{dict} mapping the coordinates of the minimum corner of a
+        chunk to a L{numpy.array} of shape C{chunkShape} holding its voxels.
+
+    @ivar _observers: A C{list} of two-tuples of a callable to notify about
+        changes and a C{bool} indicating whether it is also notified when a
+        chunk is unloaded.
     """
+    chunkShape = (
+        int(CHUNK_GRANULARITY.x),
+        int(CHUNK_GRANULARITY.y),
+        int(CHUNK_GRANULARITY.z))
+
     def __init__(self):
-        self.voxels = array([[[UNKNOWN]]], ndmin=3, dtype='b')
+        self.shape = (1, 1, 1)
+        self._chunks = {}
         # XXX Seriously why do I implement this eleven times a day?
         self._observers = []
 
 
+    def _getVoxels(self):
+        return self.get(0, 0, 0, self.shape)
+
+
+    def _setVoxels(self, voxels):
+        self.shape = (1, 1, 1)
+        self._chunks = {}
+        self.set(0, 0, 0, voxels)
+
+    voxels = property(_getVoxels, _setVoxels, doc="""
+    A L{numpy.array} holding a copy of all voxel data from the origin to
+    C{shape}.  This is as expensive as the known terrain is large; prefer
+    L{get} or L{voxelAt} for anything performance sensitive.
+    """)
+
+
     def dict(self):
         """
         Return all voxel data as a dictionary.
         """
-        return dict(((x, y, z), self.voxels[x, y, z])
-                    for x in range(self.voxels.shape[0])
-                    for y in range(self.voxels.shape[1])
-                    for z in range(self.voxels.shape[2])
-                    if self.voxels[x, y, z] not in (EMPTY, UNKNOWN))
+        result = {}
+        for (cx, cy, cz), chunk in self._chunks.iteritems():
+            known = (chunk != EMPTY) & (chunk != UNKNOWN)
+            for x, y, z in zip(*known.nonzero()):
+                result[cx + int(x), cy + int(y), cz + int(z)] = chunk[x, y, z]
+        return result
+
+
+    def overlapping(self, x, y, z, shape):
+        """
+        Find the chunks which overlap a prism.
+
+        @return: An iterator of three-tuples.  The first element of each is the
+            key of a chunk in C{_chunks}, the second is a tuple of slices
+            selecting the overlapping voxels from that chunk, and the third is a
+            tuple of slices selecting the same voxels from an array of C{shape}
+            positioned at C{(x, y, z)}.
+        """
+        axes = []
+        for start, length, size in zip((x, y, z), shape, self.chunkShape):
+            start = int(start)
+            end = start + int(length)
+            axis = []
+            origin = start - start % size
+            while origin < end:
+                low = max(start, origin)
+                high = min(end, origin + size)
+                axis.append((
+                        origin,
+                        slice(low - origin, high - origin),
+                        slice(low - start, high - start)))
+                origin += size
+            axes.append(axis)
+
+        for ox, cx, vx in axes[0]:
+            for oy, cy, vy in axes[1]:
+                for oz, cz, vz in axes[2]:
+                    yield (ox, oy, oz), (cx, cy, cz), (vx, vy, vz)
+
+
+    def chunks(self, x, y, z, shape):
+        """
+        Find the chunks which overlap a prism, whether or not any voxels have
+        been set in them yet.
+
+        @return: A C{list} of three-tuples giving the minimum corner of each
+            chunk.
+        """
+        return [key for (key, _, _) in self.overlapping(x, y, z, shape)]
+
+
+    def get(self, x, y, z, shape):
+        """
+        Retrieve a copy of a prism of voxels, starting from C{(x, y, z)}.
+
+        @param shape: A three-tuple of ints giving the size of the prism.
+
+        @return: A L{numpy.array} of the given shape.  Voxels which have never
+            been set, including any at negative coordinates, are L{UNKNOWN}.
+        """
+        result = empty(tuple(int(n) for n in shape), 'b')
+        result.fill(UNKNOWN)
+        for key, inChunk, inResult in self.overlapping(x, y, z, shape):
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                result[inResult] = chunk[inChunk]
+        return result
+
+
+    def voxelAt(self, x, y, z):
+        """
+        Return the terrain type of the single voxel at C{(x, y, z)}.
+        """
+        sx, sy, sz = self.chunkShape
+        chunk = self._chunks.get((x - x % sx, y - y % sy, z - z % sz))
+        if chunk is None:
+            return UNKNOWN
+        return chunk[x % sx, y % sy, z % sz]
 
 
     def set(self, x, y, z, voxels):
         """
         Replace a chunk of voxels, starting from C{(x, y, z)}.
         """
-        existing = array(self.voxels.shape)
-        new = array(voxels.shape)
-        new[0] += x
-        new[1] += y
-        new[2] += z
-
-        if new[0] > existing[0] or new[1] > existing[1] or new[2] > existing[2]:
-            data = self.voxels.copy()
-            self.voxels = empty((
-                    max(existing[0], new[0]),
-                    max(existing[1], new[1]),
-                    max(existing[2], new[2])), 'b')
-            self.voxels.fill(UNKNOWN)
-            self.voxels[:existing[0],:existing[1],:existing[2]] = data
-
-        self.voxels[x:new[0],y:new[1],z:new[2]] = voxels
+        for key, inChunk, inVoxels in self.overlapping(x, y, z, voxels.shape):
+            chunk = self._chunks.get(key)
+            if chunk is None:
+                chunk = self._chunks[key] = empty(self.chunkShape, 'b')
+                chunk.fill(UNKNOWN)
+            chunk[inChunk] = voxels[inVoxels]
+
+        self.shape = tuple(
+            max(extent, int(start + length))
+            for (extent, start, length)
+            in zip(self.shape, (x, y, z), voxels.shape))
         self._notify(Vector(x, y, z), Vector(*voxels.shape))
 
 
-    def _notify(self, position, shape):
+    def loadedChunks(self):
+        """
+        Find the chunks which have had any voxels set in them.
+
+        @return: A C{list} of three-tuples giving the minimum corner of each
+            chunk, in no particular order.
+        """
+        return self._chunks.keys()
+
+
+    def unloadChunk(self, origin):
+        """
+        Forget the voxels in a chunk, so that they are L{UNKNOWN} again, and
+        notify the observers which asked to hear about unloads of the change.
+
+        @param origin: A three-tuple giving the minimum corner of the chunk.
+        """
+        if self._chunks.pop(origin, None) is not None:
+            self._notify(
+                Vector(*origin), Vector(*self.chunkShape), unload=True)
+
+
+    def _notify(self, position, shape, unload=False):
         """
-        Call all observers with the change information.
+        Call all observers with the change information, leaving out those not
+        interested in unloads if C{unload} is C{True}.
         """
-        for obs in self._observers:
-            obs(position, shape)
+        for obs, unloads in self._observers:
+            if unloads or not unload:
+                obs(position, shape)
 
 
-    def addObserver(self, observer):
+    def addObserver(self, observer, unloads=True):
         """
         Whenever this terrain changes, notify C{observer}.
 
         @param observer: A callable which will be invoked with a position
             L{Vector} and a shape L{Vector}.
+
+        @param unloads: A C{bool} indicating whether to notify C{observer} when
+            a chunk is forgotten by L{unloadChunk}, as well as when voxels are
+            set.
+        """
+        self._observers.append((observer, unloads))
+
+
+    def removeObserver(self, observer):
+        """
+        Stop notifying C{observer}, which was added with L{addObserver}, of
+        changes to this terrain.
         """
-        self._observers.append(observer)
+        for i, (obs, unloads) in enumerate(self._observers):
+            if obs == observer:
+                del self._observers[i]
+                return
 
 
 
-class SurfaceMeshVertices(record('update data important')):
+class SurfaceMeshVertices(record('update data important dirty', dirty=None)):
     """
     Represent some pre-allocated, contiguous storage for surface mesh vertex
     data.
 
-    @ivar update: A sequence-like object to which sequences of vertex position
-        and texture data may be assigned.  The shape should be (N * 6, 5).
+    @ivar update: The renderer's copy of the vertex data, such as a L{VBO}.
+        Before it is drawn, the ranges given by C{dirty} must be copied to it
+        from C{data}.
 
-    @ivar data: A sequence-like object from which sequences of vertex position
-        and texture data may be read.  That's right, you can't read from
-        C{update}; read from this instead.
+    @ivar data: A sequence-like object holding vertex position and texture
+        data.  The shape should be (N * 6, 5), or (N * 4, 6) for the packed
+        layout described by L{SurfaceMesh}.  Use L{write} to change it, so that
+        the change is recorded in C{dirty}.
 
     @ivar important: An index into C{update} and C{data} indicating the first
-        unused position.  When adding new data to C{update}, this should be
+        unused position.  When adding new data to C{data}, this should be
         updated accordingly.
+
+    @ivar dirty: C{None}, or a C{list} of C{(start, stop)} tuples giving the
+        ranges of C{data} which have been written since L{takeDirty} was last
+        called.
     """
+    def write(self, start, vertices):
+        """
+        Replace the vertices beginning at C{start} with C{vertices}, and record
+        that they have changed.
+        """
+        stop = start + len(vertices)
+        self.data[start:stop] = vertices
+        if self.dirty is None:
+            self.dirty = []
+        self.dirty.append((start, stop))
+
+
+    def takeDirty(self):
+        """
+        Forget about all of the changes recorded by L{write}.
+
+        @return: A sorted C{list} of C{(start, stop)} tuples giving the ranges
+            which have changed since the last call, with overlapping and
+            adjacent ranges merged.
+        """
+        ranges = sorted(self.dirty or [])
+        self.dirty = None
+        merged = []
+        for start, stop in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+            else:
+                merged.append((start, stop))
+        return merged
 
 
 
@@ -185,22 +367,146 @@ _back = array(map(_s, [3, 8, 7, 3, 4, 7]), 'f')
 _left = array(map(_s, [3, 1, 5, 3, 8, 5]), 'f')
 _right = array(map(_s, [2, 4, 7, 2, 6, 7]), 'f')
 
+# Each face above is two triangles sharing their first and third vertices.
+# These pick out the four distinct corners, and then the two triangles from the
+# corners.
+_CORNERS = [0, 1, 2, 4]
+_QUAD = array([0, 1, 2, 0, 3, 2], 'H')
+
+# Packed texture coordinates are scaled by this much.
+PACKED_TEXTURE_SCALE = 32767
+
+
+def quadIndices(count):
+    """
+    Build an index array for drawing packed surface mesh vertices as triangles.
+
+    @param count: The number of faces to cover.
+
+    @return: A L{numpy.array} of unsigned shorts giving the indexes of six
+        vertices for each face.
+    """
+    return (arange(count, dtype='H')[:, None] * 4 + _QUAD).ravel()
+
+
+def _shifted(voxels, dx, dy, dz, fill):
+    """
+    Return an array like C{voxels} in which each element is taken from the
+    element of C{voxels} which is C{(dx, dy, dz)} away from it.  Elements whose
+    neighbor lies outside of C{voxels} are set to C{fill}.
+    """
+    result = empty(voxels.shape, voxels.dtype)
+    result.fill(fill)
+    target = []
+    source = []
+    for delta, size in zip((dx, dy, dz), voxels.shape):
+        target.append(slice(max(0, -delta), min(size, size - delta)))
+        source.append(slice(max(0, delta), min(size, size + delta)))
+    result[tuple(target)] = voxels[tuple(source)]
+    return result
+
+
+def _greedyRectangles(labels):
+    """
+    Cover the non-zero elements of a two dimensional array with rectangles,
+    each of which covers elements of only a single value.  Rectangles are grown
+    greedily, first along rows and then down columns.
+
+    @param labels: A two dimensional L{numpy.array}.
+
+    @return: A C{list} of five-tuples giving the row and column of the first
+        element covered by a rectangle, its size in rows and in columns, and the
+        value of the elements it covers.
+    """
+    rows = labels.tolist()
+    height = len(rows)
+    width = len(labels[0]) if height else 0
+    used = [[False] * width for row in rows]
+    result = []
+    for u in range(height):
+        row = rows[u]
+        usedRow = used[u]
+        for v in range(width):
+            label = row[v]
+            if not label or usedRow[v]:
+                continue
+
+            dv = 1
+            while (v + dv < width and row[v + dv] == label and
+                   not usedRow[v + dv]):
+                dv += 1
+
+            du = 1
+            while u + du < height:
+                nextRow = rows[u + du]
+                nextUsed = used[u + du]
+                if any(nextRow[k] != label or nextUsed[k]
+                       for k in range(v, v + dv)):
+                    break
+                du += 1
+
+            for covered in used[u:u + du]:
+                covered[v:v + dv] = [True] * dv
+            result.append((u, v, du, dv, label))
+    return result
+
+
+
+# The axis perpendicular to each face.
+_NORMALS = {
+    TOP: 1, BOTTOM: 1,
+    FRONT: 2, BACK: 2,
+    LEFT: 0, RIGHT: 0}
+
+
+class _ChunkMesh(record('vertices index owners')):
+    """
+    The part of a surface mesh which belongs to a single terrain chunk.
+
+    Faces are stored in C{vertices} six (or, packed, four) vertices at a time.
+    The position of a face's vertices, divided by that number, is its I{slot}.
+
+    @ivar vertices: The L{SurfaceMeshVertices} holding the vertices of every
+        face in the chunk.
+
+    @ivar index: A L{numpy.array} of int32, indexed by the position of a voxel
+        relative to the chunk's minimum corner and by face, giving the slot of
+        that face, or C{-1} if the face is not part of the mesh.
+
+    @ivar owners: A one dimensional L{numpy.array} of int32 giving, for each
+        slot, the position in the flattened C{index} of the face in that slot.
+    """
+
+
 
 class SurfaceMesh(object):
     """
     A terrain change observer which constructs a surface mesh of the terrain
     from prism updates.
 
+    The mesh is kept in pieces, one for each terrain chunk with any exposed
+    faces, so that a change only touches the pieces for the chunks it overlaps
+    and a chunk can be dropped without disturbing any other.
+
+    Normally each face is two triangles of three vertices each, and each vertex
+    is five floats: its x, y, and z position and its s and t texture
+    coordinates.  When packed, each face is four vertices, to be drawn using
+    indexes from L{quadIndices}, and each vertex is six shorts: its position
+    relative to the minimum corner of its chunk, a padding zero, and its
+    texture coordinates multiplied by L{PACKED_TEXTURE_SCALE}.
+
     @ivar _surfaceFactory: A callable which will return an empty
-        L{SurfaceMeshVertices} instance.  Whenever an array is completely filled
-        with vertices, this is called to get a new one.
+        L{SurfaceMeshVertices} instance able to hold the number of vertices it
+        is called with.  This is called once for each chunk with any exposed
+        faces, and again whenever the faces of a chunk outgrow the storage it
+        has.
 
-    @ivar _surfaces: A list of L{SurfaceMeshVertices} instances holding the
-        triangle mesh of the exposed terrain which should be rendered
+    @ivar _chunks: A C{dict} mapping the minimum corner of each terrain chunk
+        with any exposed faces to the L{_ChunkMesh} for that chunk.
 
-    @ivar _voxelToSurface: A dictionary mapping the world position of a voxel to
-        a pair indicating a slice of C{surface} which is displaying a face of
-        that voxel.
+    @ivar _initialFaces: The number of faces to make room for in the storage
+        first allocated for a chunk.  Whenever that fills up, it is replaced
+        with storage at least twice as large.
 
     @ivar _textureOffsets: A dictionary mapping terrain types to arrays of
         texture coordinate (x, y) pairs.  These coordinates are the top-left
@@ -208,13 +514,28 @@ class SurfaceMesh(object):
 
     @ivar _textureExtent: A float indicating the distance between the sides of
         the textures.
+
+    @ivar _greedy: A C{bool} indicating whether adjacent coplanar faces of the
+        same terrain type are merged into larger quads.  When they are, the
+        mesh is rebuilt a whole chunk at a time, and the texture for a terrain
+        type is stretched across each quad rather than repeated once per
+        voxel, since texture coordinates beyond its extent would reach into
+        the textures of other terrain types sharing the same image.
+
+    @ivar _packed: A C{bool} indicating whether vertices use the packed layout.
+
+    @ivar _verticesPerFace: The number of vertices stored for each face.
     """
+    _initialFaces = 64
+
     def __init__(self, terrain, surfaceFactory, textureOffsets=None,
-                 textureExtent=None):
+                 textureExtent=None, greedy=False, packed=False):
         self._terrain = terrain
         self._surfaceFactory = surfaceFactory
-        self._surfaces = [surfaceFactory()]
-        self._voxelToSurface = {}
+        self._chunks = {}
+        self._greedy = greedy
+        self._packed = packed
+        self._verticesPerFace = 4 if packed else 6
         self._textureOffsets = textureOffsets
         self._textureExtent = textureExtent
 
@@ -242,8 +563,63 @@ class SurfaceMesh(object):
             RIGHT: (_right, righttex),
             }
 
+        # The same data, arranged for building many faces at once.
+        self._faceTemplates = array([
+                self._faces[face][0] + self._faces[face][1]
+                for face in FACES])
+        self._textureTable = zeros((UNKNOWN + 1, 2))
+        for textureType, offset in (textureOffsets or {}).iteritems():
+            self._textureTable[textureType] = offset
+
         # Do this last
-        self.changed(Vector(0, 0, 0), Vector(*self._terrain.voxels.shape))
+        self.changed(Vector(0, 0, 0), Vector(*self._terrain.shape))
+
+
+    def surfaces(self):
+        """
+        Return the pieces of the surface mesh.
+
+        @return: A C{list} of two-tuples of the minimum corner of a terrain
+            chunk and the L{SurfaceMeshVertices} holding the faces in that
+            chunk.
+        """
+        return [
+            (origin, chunk.vertices)
+            for (origin, chunk) in self._chunks.iteritems()]
+
+
+    def unloadChunk(self, origin):
+        """
+        Discard the part of the surface mesh belonging to one terrain chunk.
+
+        @param origin: A three-tuple giving the minimum corner of the chunk.
+        """
+        self._chunks.pop(origin, None)
+
+
+    def _chunkOrigin(self, x, y, z):
+        """
+        Return the minimum corner of the terrain chunk containing a voxel.
+        """
+        sx, sy, sz = self._terrain.chunkShape
+        return (x - x % sx, y - y % sy, z - z % sz)
+
+
+    def _chunk(self, origin):
+        """
+        Return the L{_ChunkMesh} for the terrain chunk at C{origin}, creating it
+        if necessary.
+        """
+        chunk = self._chunks.get(origin)
+        if chunk is None:
+            index = empty(self._terrain.chunkShape + (len(FACES),), 'i')
+            index.fill(-1)
+            chunk = self._chunks[origin] = _ChunkMesh(
+                self._surfaceFactory(
+                    self._initialFaces * self._verticesPerFace),
+                index,
+                zeros(index.size, 'i'))
+        return chunk
 
 
     def _makeFace(self, face, textureType, x, y, z):
@@ -260,166 +636,306 @@ class SurfaceMesh(object):
 
 
     def _append(self, key, vertices):
-        assert key not in self._voxelToSurface
-        surface = self._surfaces[-1]
-        pos = surface.important
-        # XXX Bounds checking needed here.
-        surface.update[pos:pos + len(vertices)] = vertices
-        self._voxelToSurface[key] = (pos, len(vertices))
-        surface.important += len(vertices)
-
-
-    def _compact(self, x, y, z, face, start, length):
-        surface = self._surfaces[-1]
-
-        # The surface mesh array will now end at this index.
-        end = surface.important - 6
-
-        if start == end:
-            # The vertices being removed by this compaction are at the end of
-            # the important part of the surface mesh array.  That means we can
-            # just subtract from the important marker instead of copying fresh
-            # data on top of these vertices.
-            surface.important -= length
-            return
+        x, y, z, face = key
+        self._appendMany(
+            self._chunkOrigin(x, y, z), array([[x, y, z]]), array([face]),
+            vertices)
 
-        # Find the voxel that owns the vertices at the end of the surface mesh
-        # array.
-        mx, my, mz = surface.data[end][:3]
-
-        possibilities = [
-            (mx - 1, my - 1, mz,     TOP),
-            (mx,     my - 1, mz - 1, FRONT),
-            (mx,     my,     mz - 1, BOTTOM),
-            (mx,     my,     mz,     BACK),
-            (mx,     my,     mz,     LEFT),
-            (mx - 1, my,     mz - 1, RIGHT),
-            ]
-        # Use knowledge about the location of the first vertex of the first to
-        # find the voxel which owns these vertices.
-        for key in possibilities:
-            if self._voxelToSurface.get(key) == (end, 6):
-                break
-        else:
-            err(Exception(
-                    "Could not find voxel owning vertices at end of surface "
-                    "mesh array."))
-            return
 
+    def _makeFaces(self, faces, textureTypes, positions, extents=None):
+        """
+        Build the vertices for many faces at once.
 
-        # Change the tracking data for the voxel which used to be stored at the
-        # end of the surface mesh.  Now it's stored wherever we're overwriting.
-        self._voxelToSurface[key] = (start, length)
-        # Actually overwrite.
-        surface.update[start:start + length] = surface.data[
-            end:surface.important]
-        # Note that the surface mesh is shorter now.
-        surface.important = end
+        @param faces: An array of face identifiers (like L{TOP}).
 
+        @param textureTypes: An array of the terrain type of the voxel each
+            face belongs to.
 
-    def _removeVoxel(self, x, y, z):
-        for face in FACES:
-            key = (x, y, z, face)
-            if key in self._voxelToSurface:
-                # Get rid of the vertices for this face of this voxel.
-                begin, length = self._voxelToSurface.pop(key)
-                self._compact(x, y, z, face, begin, length)
-            else:
-                # If the voxel is missing a face, that's because it has a
-                # neighbor!  Append vertices for that neighbor's revealed face.
-                # deltas to get to the neighbor of this face
-                dx, dy, dz, rface = NEIGHBORS[face]
-
-                # coordinates of the neighbor
-                nx, ny, nz = x + dx, y + dy, z + dz
-
-                # maximum coordinates of the voxel data
-                mx, my, mz = self._terrain.voxels.shape
-
-                # if the neighbor coordinates are out of bounds, we can't create
-                # a face
-                if (nx < 0 or ny < 0 or nz < 0 or
-                    nx >= mx or ny >= my or nz >= mz):
-                    continue
-
-                # There may actually be no neighbor at all, if _removeVoxel is
-                # only being called because we observed an EMPTY voxel for the
-                # first time ever.
-                terrainType = self._terrain.voxels[nx, ny, nz]
-                if terrainType in (EMPTY, UNKNOWN):
-                    continue
-
-                # Otherwise we can!
-                key = (nx, ny, nz, rface)
-                if key not in self._voxelToSurface:
-                    self._append(
-                        key,
-                        self._makeFace(
-                            rface,
-                            self._terrain.voxels[nx, ny, nz], nx, ny, nz))
+        @param positions: An array of shape C{(len(faces), 3)} giving the
+            coordinates of the voxel each face belongs to.
 
+        @param extents: C{None}, or an array like C{positions} giving the number
+            of voxels each face should span along each axis.
 
-    def _exposed(self, x, y, z, face):
-        voxels = self._terrain.voxels
-        mx, my, mz = voxels.shape
+        @return: An array of six vertices for each face, in the same order as
+            the inputs.  Without C{extents}, each face is equal to what
+            L{_makeFace} would produce for it.
+        """
+        offsets = zeros((len(faces), 1, 5))
+        offsets[:, 0, :3] = positions
+        offsets[:, 0, 3:] = self._textureTable[textureTypes]
+        templates = self._faceTemplates[faces]
+        if extents is not None:
+            templates[:, :, :3] *= extents[:, None, :]
+        result = templates + offsets
+        return result.reshape((len(faces) * 6, 5)).astype('f')
+
+
+    def _pack(self, origin, vertices):
+        """
+        Convert vertices built by L{_makeFaces} to the packed layout.
+
+        @param origin: The minimum corner of the chunk the vertices belong to.
+
+        @return: An array of shorts with four vertices for each face.
+        """
+        faces = vertices.reshape((-1, 6, 5))[:, _CORNERS].reshape((-1, 5))
+        result = zeros((len(faces), 6), 'h')
+        result[:, :3] = faces[:, :3] - origin
+        result[:, 4:] = (faces[:, 3:] * PACKED_TEXTURE_SCALE).round()
+        return result
+
+
+    def _appendMany(self, origin, positions, faces, vertices):
+        """
+        Like L{_append}, but for the vertices of many faces at once, all of
+        which belong to the terrain chunk at C{origin}.
+
+        @param positions: An array of shape C{(len(faces), 3)} giving the
+            coordinates of the voxel each face belongs to.
+
+        @param faces: An array of face identifiers (like L{TOP}).
+
+        @param vertices: An array with six vertices for each face, in the same
+            order, as built by L{_makeFaces}.
+        """
+        if self._packed:
+            vertices = self._pack(origin, vertices)
+        perFace = self._verticesPerFace
+        chunk = self._chunk(origin)
+        surface = chunk.vertices
+        first = surface.important // perFace
+        if surface.important + len(vertices) > len(surface.data):
+            surface = chunk.vertices = self._grow(
+                surface, surface.important + len(vertices))
+        slots = arange(first, first + len(faces))
+        local = (positions - origin).T
+        where = ravel_multi_index(
+            (local[0], local[1], local[2], faces), chunk.index.shape)
+        assert (chunk.index.flat[where] == -1).all()
+        chunk.index.flat[where] = slots
+        chunk.owners[slots] = where
+
+        surface.write(first * perFace, vertices)
+        surface.important = (first + len(faces)) * perFace
+
+
+    def _grow(self, surface, size):
+        """
+        Replace the storage for the surface mesh of a chunk with larger
+        storage, so that growth costs amortized constant time per vertex.
+
+        @type surface: L{SurfaceMeshVertices}
+
+        @param size: The number of vertices the new storage must be able to
+            hold.
+
+        @return: A new L{SurfaceMeshVertices} holding the same vertices as
+            C{surface}.
+        """
+        grown = self._surfaceFactory(max(size, len(surface.data) * 2))
+        grown.write(0, surface.data[:surface.important])
+        grown.important = surface.important
+        return grown
+
+
+    def _compact(self, chunk, slots):
+        """
+        Remove the vertices of some faces from the surface mesh of a chunk,
+        filling the holes they leave with the faces at the end of it.
+
+        @type chunk: L{_ChunkMesh}
+
+        @param slots: A sequence of the slots of the faces to remove.
+        """
+        slots = unique(slots)
+        if not len(slots):
+            return
 
+        perFace = self._verticesPerFace
+        surface = chunk.vertices
+        count = surface.important // perFace
+        # The surface mesh array will now end at this slot.
+        end = count - len(slots)
+
+        # Fill the holes before the new end with the faces after it which are
+        # being kept.
+        holes = slots[slots < end]
+        kept = ones(count - end, bool)
+        kept[slots[slots >= end] - end] = False
+        movers = arange(end, count)[kept]
+
+        chunk.index.flat[chunk.owners[slots]] = -1
+        for hole, mover in zip(holes, movers):
+            surface.write(
+                hole * perFace,
+                surface.data[mover * perFace:(mover + 1) * perFace])
+        chunk.owners[holes] = chunk.owners[movers]
+        chunk.index.flat[chunk.owners[holes]] = holes
+        surface.important = end * perFace
+
+
+    def _exposed(self, x, y, z, face):
         dx, dy, dz, _ = NEIGHBORS[face]
-        x += dx
-        y += dy
-        z += dz
+        return self._terrain.voxelAt(x + dx, y + dy, z + dz) in (EMPTY, UNKNOWN)
 
-        return (
-            x < 0 or y < 0 or z < 0 or
-            x >= mx or y >= my or z >= mz or
-            voxels[x, y, z] in (EMPTY, UNKNOWN))
 
+    def _exposure(self, voxels):
+        """
+        Determine which faces of a prism of voxels are exposed.
+
+        @param voxels: A three dimensional L{numpy.array} of terrain types.
 
-    def _addVoxel(self, x, y, z):
+        @return: A L{numpy.array} of C{bool} with one more dimension than
+            C{voxels}, indexed by face as well as by voxel.  The faces on the
+            outside of the prism are exposed if their voxel is solid, since
+            nothing is known about what lies beyond them.
+        """
+        solid = (voxels != EMPTY) & (voxels != UNKNOWN)
+        exposed = empty(voxels.shape + (len(FACES),), bool)
         for face in FACES:
-            key = (x, y, z, face)
-            if key not in self._voxelToSurface:
-                # If there's nothing there already, check to see if it is
-                # exposed.
-                if self._exposed(x, y, z, face):
-                    # If the neighbor is empty, it is exposed, add it.
-                    self._append(
-                        key,
-                        self._makeFace(
-                            face,
-                            self._terrain.voxels[x, y, z], x, y, z))
-                else:
-                    # If the neighbor is not empty, then one of *its* faces is
-                    # now obscured, remove it.
-                    dx, dy, dz, rface = NEIGHBORS[face]
-                    nx, ny, nz = x + dx, y + dy, z + dz
-                    try:
-                        start, length = self._voxelToSurface.pop((
-                                nx, ny, nz, rface))
-                    except KeyError:
-                        # Except the neighbor's is not in the surface mesh.
-                        # This happens when a bunch of voxels appear at once,
-                        # and we skipped adding the neighbor face because we saw
-                        # this voxel (the one at x, y, z) and knew we'd just
-                        # have to remove it.
-                        pass
-                    else:
-                        self._compact(nx, ny, nz, rface, start, length)
+            dx, dy, dz, rface = NEIGHBORS[face]
+            exposed[..., face] = solid & ~_shifted(solid, dx, dy, dz, False)
+        return exposed
+
+
+    def _remeshChunk(self, origin):
+        """
+        Replace all of the quads for one chunk of terrain with new ones,
+        merging adjacent coplanar faces of the same terrain type.
+
+        @param origin: A three-tuple giving the minimum corner of the chunk.
+        """
+        ox, oy, oz = origin
+        shape = self._terrain.chunkShape
+        voxels = self._terrain.get(
+            ox - 1, oy - 1, oz - 1, tuple(n + 2 for n in shape))
+        exposed = self._exposure(voxels)[1:-1, 1:-1, 1:-1]
+        if not exposed.any():
+            self.unloadChunk(origin)
+            return
+        voxels = voxels[1:-1, 1:-1, 1:-1]
+
+        faces = []
+        types = []
+        positions = []
+        extents = []
+        for face in FACES:
+            normal = _NORMALS[face]
+            rows, columns = [axis for axis in (0, 1, 2) if axis != normal]
+            labels = rollaxis(where(exposed[..., face], voxels, 0), normal)
+            for layer in range(len(labels)):
+                for u, v, du, dv, label in _greedyRectangles(labels[layer]):
+                    position = [0, 0, 0]
+                    position[normal] = layer
+                    position[rows] = u
+                    position[columns] = v
+                    extent = [1, 1, 1]
+                    extent[rows] = du
+                    extent[columns] = dv
+                    faces.append(face)
+                    types.append(label)
+                    positions.append(position)
+                    extents.append(extent)
+
+        faces = array(faces)
+        positions = array(positions) + origin
+        vertices = self._makeFaces(
+            faces, array(types), positions, array(extents))
+
+        # Start over with the same buffer.  Each quad is indexed by the voxel at
+        # its minimum corner.
+        chunk = self._chunk(origin)
+        chunk.vertices.important = 0
+        chunk.index.fill(-1)
+        self._appendMany(origin, positions, faces, vertices)
 
 
     def changed(self, position, shape):
         """
         Examine the terrain type at every changed voxel and determine if there
-        are any exposed faces.  If so, update the surface mesh array.
+        are any exposed faces.  If so, update the surface mesh of each chunk
+        the change touches.
+
+        The faces of the changed voxels, and the faces of their neighbors which
+        face into the changed region, are all considered at once using array
+        operations.  Only the faces of changed voxels and faces which have
+        become exposed or obscured cause work on the surface mesh.  When merging
+        faces, every chunk holding any of those faces is rebuilt instead.
         """
-        voxels = self._terrain.voxels
+        px, py, pz = int(position.x), int(position.y), int(position.z)
+        sx, sy, sz = int(shape.x), int(shape.y), int(shape.z)
+        if sx <= 0 or sy <= 0 or sz <= 0:
+            return
 
-        # Visit each voxel in the changed region and re-determine if it should
-        # now be part of the surface mesh.
-        for x in range(int(position.x), int(position.x + shape.x)):
-            for y in range(int(position.y), int(position.y + shape.y)):
-                for z in range(int(position.z), int(position.z + shape.z)):
+        # Everything in the changed region plus a one voxel border around it,
+        # since the border voxels' faces may be revealed or obscured too.
+        ox, oy, oz = px - 1, py - 1, pz - 1
+        padded = (sx + 2, sy + 2, sz + 2)
+
+        if self._greedy:
+            # Only a chunk holding a changed voxel, or one sharing a face with
+            # it, can have faces which were revealed or obscured.  Chunks which
+            # only meet the changed region at an edge or a corner are left
+            # alone.
+            origins = set()
+            for (dx, dy, dz) in ((1, 0, 0), (0, 1, 0), (0, 0, 1)):
+                origins.update(self._terrain.chunks(
+                        px - dx, py - dy, pz - dz,
+                        (sx + 2 * dx, sy + 2 * dy, sz + 2 * dz)))
+            for origin in origins:
+                self._remeshChunk(origin)
+            return
+
+        voxels = self._terrain.get(ox, oy, oz, padded)
+
+        # Which faces should be in the surface mesh.
+        exposed = self._exposure(voxels)
 
-                    if voxels[x, y, z] == EMPTY:
-                        self._removeVoxel(x, y, z)
-                    elif voxels[x, y, z] != UNKNOWN:
-                        self._addVoxel(x, y, z)
+        # The faces to consider: every face of a changed voxel, and the face of
+        # each border voxel which touches a changed voxel.
+        scope = zeros(exposed.shape, bool)
+        scope[1:-1, 1:-1, 1:-1] = True
+        for face in FACES:
+            dx, dy, dz, rface = NEIGHBORS[face]
+            border = []
+            for delta in (dx, dy, dz):
+                if delta > 0:
+                    border.append(-1)
+                elif delta < 0:
+                    border.append(0)
+                else:
+                    border.append(slice(1, -1))
+            scope[tuple(border) + (rface,)] = True
+
+        wanted = exposed & scope
+
+        inside = zeros(exposed.shape, bool)
+        inside[1:-1, 1:-1, 1:-1] = True
+
+        for origin, inChunk, inRegion in self._terrain.overlapping(
+            ox, oy, oz, padded):
+            chunkWanted = wanted[inRegion]
+            chunk = self._chunks.get(origin)
+            if chunk is not None:
+                # Drop the faces in scope which are present, except for the
+                # exposed faces of border voxels.  The faces of changed voxels
+                # are always replaced, since their terrain type may be different
+                # now.
+                slots = chunk.index[inChunk]
+                present = slots >= 0
+                keep = present & chunkWanted & ~inside[inRegion]
+                self._compact(chunk, slots[present & scope[inRegion] & ~keep])
+                chunkWanted = chunkWanted & ~keep
+
+            # Add all the newly exposed faces in this chunk in one go.
+            x, y, z, face = chunkWanted.nonzero()
+            if len(face):
+                rx, ry, rz = [piece.start for piece in inRegion]
+                positions = array([x + rx + ox, y + ry + oy, z + rz + oz]).T
+                vertices = self._makeFaces(
+                    face, voxels[x + rx, y + ry, z + rz], positions)
+                self._appendMany(origin, positions, face, vertices)
+            elif chunk is not None and not chunk.vertices.important:
+                # Nothing is left to draw here, so free the storage.
+                self.unloadChunk(origin)
@@ -9,6 +9,7 @@ from twisted.internet.task import Clock
 from game.environment import Environment, SimulationTime
 from game.test.util import ArrayMixin, PlayerVisibilityObserver
 from game.vector import Vector
+from game.direction import FORWARD
 
 
 class SimulationTimeTestsMixin(object):
@@ -187,6 +188,21 @@ class EnvironmentTests(TestCase, ArrayMixin):
         self.assertEqual(observer.createdPlayers, observer.removedPlayers)
 
 
+    def test_playerTable(self):
+        """
+        The players made by L{Environment.createPlayer} are kept in its
+        L{PlayerTable}, which advances along with it, until they are removed.
+        """
+        player = self.environment.createPlayer(Vector(1, 2, 3), 20)
+        self.assertEqual(self.environment.playerTable.players, [player])
+        player.setDirection(FORWARD)
+        self.environment.advance(1)
+        self.assertEqual(
+            self.environment.playerTable.positions[0].tolist(), [1, 2, -17])
+        self.environment.removePlayer(player)
+        self.assertEqual(len(self.environment.playerTable), 0)
+
+
     def test_setInitialPlayer(self):
         """
         L{Environment.setInitialPlayer} should change the environment's
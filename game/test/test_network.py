@@ -5,18 +5,28 @@ Tests for L{game.network} (Network support for Game).
 import numpy
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, fail
 from twisted.internet.task import Clock
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 
 from game.test.util import (
-    ArrayMixin, PlayerCreationMixin, PlayerVisibilityObserver)
+    ArrayMixin, PlayerCreationMixin, PlayerVisibilityObserver,
+    requestedTerrain)
 from game.environment import Environment
 from game.network import (Direction, Introduce, SetDirectionOf,
+                          SetDirectionsOf,
                           NetworkController, NewPlayer, SetMyDirection,
-                          RemovePlayer, GetTerrain, SetTerrain, Terrain)
+                          RemovePlayer, GetTerrain, SetTerrain, Terrain,
+                          TerrainRequests, Positions, TerrainChunks,
+                          GetTerrainChunks, SetTerrainChunks, batches,
+                          TERRAIN_COMPRESSION, TERRAIN_CHUNKS,
+                          PROTOCOL_FEATURES, encodeTerrain)
 from game.direction import FORWARD, BACKWARD, LEFT, RIGHT
 from game.terrain import (
     WATER, GRASS, DESERT, MOUNTAIN, loadTerrainFromString)
+from game.terrain import Terrain as TerrainModel
 from game.vector import Vector
 
 
@@ -144,10 +154,15 @@ class IntroduceCommandTests(CommandTestMixin, TestCase):
         'speed': 12,
         'x': -3.5,
         'y': 2.5,
-        'z': 0.5}
+        'z': 0.5,
+        'compression': 'zlib',
+        'features': ['terrain-chunks']}
     responseStrings = stringifyDictValues(responseObjects)
+    responseStrings['features'] = '\x00\x0eterrain-chunks'
 
-    argumentObjects = argumentStrings = {}
+    argumentObjects = {'compression': ['zlib'], 'features': ['terrain-chunks']}
+    argumentStrings = {
+        'compression': '\x00\x04zlib', 'features': '\x00\x0eterrain-chunks'}
 
 
 
@@ -217,6 +232,44 @@ class TerrainArgumentTests(TestCase):
         self.assertTrue((objects["voxels"] == self.array).all())
 
 
+    def test_compressed(self):
+        """
+        If the protocol has a C{terrainCompression} attribute, L{Terrain.toBox}
+        compresses the data with that method from L{TERRAIN_COMPRESSION} and
+        records the method in a C{I{name}-compression} key, which
+        L{Terrain.fromBox} uses to decompress it.
+        """
+        class Protocol(object):
+            terrainCompression = "zlib"
+
+        array = numpy.zeros((8, 2, 8), 'b')
+        strings = {}
+        Terrain().toBox("voxels", strings, {"voxels": array}, Protocol())
+        self.assertEquals(strings["voxels-compression"], "zlib")
+        self.assertTrue(len(strings["voxels-data"]) < array.size / 4)
+
+        objects = {}
+        Terrain().fromBox("voxels", strings, objects, None)
+        self.assertEquals(objects["voxels"].shape, array.shape)
+        self.assertTrue((objects["voxels"] == array).all())
+
+
+    def test_encoded(self):
+        """
+        L{Terrain.toBox} sends an L{EncodedTerrain} as is, whatever the
+        protocol's compression.
+        """
+        encoded = encodeTerrain(self.array, "zlib")
+        strings = {}
+        Terrain().toBox("voxels", strings, {"voxels": encoded}, None)
+        self.assertEquals(strings["voxels-data"], encoded.data)
+        self.assertEquals(strings["voxels-compression"], "zlib")
+
+        objects = {}
+        Terrain().fromBox("voxels", strings, objects, None)
+        self.assertTrue((objects["voxels"] == self.array).all())
+
+
 
 class GetTerrainCommandTests(CommandTestMixin, TestCase):
     """
@@ -281,6 +334,427 @@ class SetTerrainCommandTests(CommandTestMixin, TestCase):
 
 
 
+class BatchesTests(TestCase):
+    """
+    Tests for L{batches}.
+    """
+    def test_batches(self):
+        """
+        L{batches} splits a sequence into lists whose elements' sizes add up to
+        no more than the limit.
+        """
+        self.assertEquals(
+            list(batches([1, 2, 3, 4, 1], lambda n: n, 5)),
+            [[1, 2], [3], [4, 1]])
+
+
+    def test_oversized(self):
+        """
+        An element larger than the limit is put in a list by itself.
+        """
+        self.assertEquals(
+            list(batches([1, 7, 1], lambda n: n, 5)), [[1], [7], [1]])
+
+
+    def test_empty(self):
+        """
+        L{batches} generates nothing for an empty sequence.
+        """
+        self.assertEquals(list(batches([], len)), [])
+
+
+
+class PositionsArgumentTests(TestCase):
+    """
+    Tests for L{Positions}, an AMP argument serializer for lists of
+    coordinates.
+    """
+    def test_toString(self):
+        """
+        L{Positions.toString} encodes each coordinate as a big-endian 32 bit
+        integer.
+        """
+        self.assertEquals(
+            Positions().toString([(1, 2, -3)]),
+            '\x00\x00\x00\x01\x00\x00\x00\x02\xff\xff\xff\xfd')
+
+
+    def test_roundTrip(self):
+        """
+        L{Positions.fromString} reverses L{Positions.toString}.
+        """
+        positions = [(8, 0, 16), (0, 2, 8), (123456, 7, 0)]
+        argument = Positions()
+        encoded = argument.toString(positions)
+        self.assertEquals(len(encoded), sum(map(Positions.size, positions)))
+        self.assertEquals(argument.fromString(encoded), positions)
+
+
+
+class TerrainChunksArgumentTests(TestCase, ArrayMixin):
+    """
+    Tests for L{TerrainChunks}, an AMP argument serializer for the voxels of
+    several chunks of terrain.
+    """
+    def test_roundTrip(self):
+        """
+        L{TerrainChunks.fromString} reverses L{TerrainChunks.toString}, for
+        arrays of any shape, including empty ones.
+        """
+        chunks = [
+            (8, 0, 16, loadTerrainFromString("GD\nMW\nDG")),
+            (0, 0, 0, numpy.zeros((0, 0, 0), 'b')),
+            (16, 2, 8, numpy.arange(24, dtype='b').reshape((2, 3, 4)))]
+        argument = TerrainChunks()
+        encoded = argument.toString(chunks)
+        self.assertTrue(len(encoded) <= sum(map(TerrainChunks.size, chunks)))
+        decoded = argument.fromString(encoded)
+        self.assertEquals(len(decoded), len(chunks))
+        for (expected, actual) in zip(chunks, decoded):
+            self.assertEquals(expected[:3], actual[:3])
+            self.assertArraysEqual(expected[3], actual[3])
+
+
+
+    def test_compressed(self):
+        """
+        L{TerrainChunks} compresses its value like L{Terrain} does.
+        """
+        class Protocol(object):
+            terrainCompression = "zlib"
+
+        chunks = [(8, 0, 16, numpy.zeros((8, 2, 8), 'b'))]
+        strings = {}
+        TerrainChunks().toBox("chunks", strings, {"chunks": chunks}, Protocol())
+        self.assertEquals(strings["chunks-compression"], "zlib")
+        self.assertTrue(len(strings["chunks"]) < TerrainChunks.size(chunks[0]))
+
+        objects = {}
+        TerrainChunks().fromBox("chunks", strings, objects, None)
+        [(x, y, z, voxels)] = objects["chunks"]
+        self.assertEquals((x, y, z), (8, 0, 16))
+        self.assertArraysEqual(voxels, chunks[0][3])
+
+
+
+    def test_zeroCopy(self):
+        """
+        L{TerrainChunks.fromString} does not copy the voxels out of the string
+        it is given, so the arrays it returns are read-only.
+        """
+        argument = TerrainChunks()
+        chunks = [(0, 0, 0, numpy.arange(24, dtype='b').reshape((2, 3, 4)))]
+        [(x, y, z, voxels)] = argument.fromString(argument.toString(chunks))
+        self.assertFalse(voxels.flags.owndata)
+        self.assertFalse(voxels.flags.writeable)
+
+
+    def test_encodeView(self):
+        """
+        L{TerrainChunks.toString} accepts non-contiguous views of a larger
+        array.
+        """
+        voxels = numpy.arange(64, dtype='b').reshape((4, 4, 4))[::2, 1:3, ::2]
+        argument = TerrainChunks()
+        for compression in [None, "zlib"]:
+            [(x, y, z, decoded)] = argument._decode(
+                argument._encode([(0, 0, 0, voxels)], compression),
+                compression)
+            self.assertArraysEqual(decoded, voxels)
+
+
+    def test_encoded(self):
+        """
+        L{TerrainChunks} sends the data of an L{EncodedTerrain} as is, but
+        refuses one compressed differently from the rest of the value.
+        """
+        voxels = numpy.zeros((8, 2, 8), 'b')
+        chunks = [(0, 0, 0, encodeTerrain(voxels, None))]
+        argument = TerrainChunks()
+        [(x, y, z, decoded)] = argument.fromString(argument.toString(chunks))
+        self.assertArraysEqual(decoded, voxels)
+
+        chunks = [(0, 0, 0, encodeTerrain(voxels, 'zlib'))]
+        self.assertRaises(ValueError, argument.toString, chunks)
+
+
+
+class TerrainChunksCommandTests(TestCase):
+    """
+    Tests for L{GetTerrainChunks} and L{SetTerrainChunks}.
+    """
+    def test_noAnswer(self):
+        """
+        Neither command has a response.
+        """
+        self.assertFalse(GetTerrainChunks.requiresAnswer)
+        self.assertFalse(SetTerrainChunks.requiresAnswer)
+
+
+
+class TerrainRequestsTests(TestCase):
+    """
+    Tests for L{TerrainRequests}.
+    """
+    def setUp(self):
+        self.calls = []
+        self.results = []
+        self.clock = Clock()
+        self.features = frozenset([TERRAIN_CHUNKS])
+        self.terrain = TerrainModel()
+        self.requests = TerrainRequests(self, self.terrain, self.clock)
+
+
+    def callRemote(self, command, **kw):
+        """
+        Record a command.  Like L{AMP.callRemote} for a command which needs no
+        answer, return C{None}, unless C{results} has been given a Deferred to
+        return.
+        """
+        self.calls.append((command, kw))
+        if self.results:
+            return self.results.pop(0)
+
+
+    def test_request(self):
+        """
+        L{TerrainRequests.request} sends a L{GetTerrain} command and remembers
+        that it is outstanding.
+        """
+        self.assertTrue(self.requests.request(8, 0, 16))
+        self.assertEquals(
+            self.calls, [(GetTerrain, {'x': 8, 'y': 0, 'z': 16})])
+        self.assertIn((8, 0, 16), self.requests)
+        self.assertEquals(len(self.requests), 1)
+        self.assertEquals(self.requests.sent, 1)
+
+
+    def test_duplicate(self):
+        """
+        While a request is outstanding, L{TerrainRequests.request} does not send
+        it again, and counts the duplicate it avoided.
+        """
+        self.requests.request(8, 0, 16)
+        self.assertFalse(self.requests.request(8, 0, 16))
+        self.assertEquals(len(self.calls), 1)
+        self.assertEquals(self.requests.duplicates, 1)
+
+
+    def test_answered(self):
+        """
+        A request is no longer outstanding once terrain is set at the position
+        it asked for, even if no voxels are set, and it may then be sent again.
+        """
+        self.requests.request(8, 0, 16)
+        self.requests.request(0, 0, 0)
+        self.terrain.set(8, 0, 16, loadTerrainFromString("G"))
+        self.terrain.set(0, 0, 0, numpy.zeros((0, 0, 0), 'b'))
+        self.assertEquals(len(self.requests), 0)
+        self.assertEquals(self.requests.completed, 2)
+        self.assertEquals(self.clock.calls, [])
+
+        self.assertTrue(self.requests.request(8, 0, 16))
+
+
+    def test_unloadIsNotAnswer(self):
+        """
+        Forgetting a chunk of terrain with L{Terrain.unloadChunk} does not
+        answer a request for it.
+        """
+        self.terrain.set(8, 0, 16, loadTerrainFromString("G"))
+        self.requests.request(8, 0, 16)
+        self.terrain.unloadChunk((8, 0, 16))
+        self.assertIn((8, 0, 16), self.requests)
+        self.assertEquals(self.requests.completed, 0)
+
+
+    def test_commandFailed(self):
+        """
+        If the command sending a request fails, the request is given up on
+        without waiting for it to time out, and a queued request takes its
+        place.
+        """
+        self.requests.limit = 1
+        result = Deferred()
+        self.results.append(result)
+        self.requests.request(8, 0, 16)
+        self.requests.request(0, 0, 0)
+        result.errback(ConnectionDone())
+        self.assertNotIn((8, 0, 16), self.requests)
+        self.assertIn((0, 0, 0), self.requests)
+        self.assertEquals(self.requests.failures, 1)
+        self.assertEquals(len(self.clock.calls), 1)
+        self.assertEquals(
+            self.calls[-1], (GetTerrain, {'x': 0, 'y': 0, 'z': 0}))
+
+
+    def test_sendFailed(self):
+        """
+        If the command sending a request cannot be sent at all, as when the
+        connection is already lost, the request is given up on at once.
+        """
+        self.results.append(fail(ConnectionDone()))
+        self.requests.request(8, 0, 16)
+        self.assertEquals(len(self.requests), 0)
+        self.assertEquals(self.requests.failures, 1)
+        self.assertEquals(self.clock.calls, [])
+
+
+    def test_staleFailure(self):
+        """
+        The failure of a command sending a request which has since timed out
+        and been sent again does not affect the new request.
+        """
+        result = Deferred()
+        self.results.append(result)
+        self.requests.request(8, 0, 16)
+        self.clock.advance(self.requests.timeout)
+        result.errback(ConnectionDone())
+        self.assertIn((8, 0, 16), self.requests)
+        self.assertEquals(self.requests.failures, 0)
+
+
+    def test_answeredByLargerRegion(self):
+        """
+        A request is no longer outstanding once terrain is set in a region
+        including the position it asked for.
+        """
+        self.requests.request(1, 0, 1)
+        self.terrain.set(0, 0, 0, loadTerrainFromString("GG\nGG"))
+        self.assertEquals(len(self.requests), 0)
+
+
+    def test_retry(self):
+        """
+        A request which is not answered within L{TerrainRequests.timeout}
+        seconds is sent again, until it has been sent
+        L{TerrainRequests.attempts} times, after which it is forgotten.
+        """
+        self.requests.timeout = 5
+        self.requests.attempts = 2
+        self.requests.request(8, 0, 16)
+        self.clock.advance(5)
+        self.assertEquals(len(self.calls), 2)
+        self.assertEquals(self.requests.retries, 1)
+        self.assertIn((8, 0, 16), self.requests)
+
+        self.clock.advance(5)
+        self.assertEquals(len(self.calls), 2)
+        self.assertEquals(self.requests.failures, 1)
+        self.assertNotIn((8, 0, 16), self.requests)
+
+
+    def test_stop(self):
+        """
+        L{TerrainRequests.stop} forgets all outstanding requests and cancels
+        their timeouts.
+        """
+        self.requests.request(8, 0, 16)
+        self.requests.stop()
+        self.assertEquals(len(self.requests), 0)
+        self.assertEquals(self.clock.calls, [])
+
+
+    def positions(self):
+        """
+        Return the coordinates of the chunks requested so far.
+        """
+        return requestedTerrain(self.calls)
+
+
+    def test_batch(self):
+        """
+        Requests sent at the same time are batched into a L{GetTerrainChunks}
+        command if the server supports L{TERRAIN_CHUNKS}, while a request sent
+        alone uses L{GetTerrain}.
+        """
+        self.requests.want([(0, 0, 0), (8, 0, 0), (16, 0, 0)])
+        self.assertEquals(
+            self.calls,
+            [(GetTerrainChunks,
+              {'positions': [(0, 0, 0), (8, 0, 0), (16, 0, 0)]})])
+        self.assertEquals(self.requests.sent, 3)
+        self.assertEquals(len(self.requests), 3)
+
+        self.requests.request(0, 0, 8)
+        self.assertEquals(
+            self.calls[-1], (GetTerrain, {'x': 0, 'y': 0, 'z': 8}))
+
+
+    def test_noBatchesWithoutSupport(self):
+        """
+        Requests sent at the same time to a server which does not support
+        L{TERRAIN_CHUNKS} are each sent with a L{GetTerrain} command.
+        """
+        self.features = frozenset()
+        self.requests.want([(0, 0, 0), (8, 0, 0)])
+        self.assertEquals(
+            self.calls,
+            [(GetTerrain, {'x': 0, 'y': 0, 'z': 0}),
+             (GetTerrain, {'x': 8, 'y': 0, 'z': 0})])
+        self.assertEquals(len(self.requests), 2)
+
+
+    def test_limit(self):
+        """
+        No more than L{TerrainRequests.limit} requests are outstanding at once.
+        Further requests are queued and sent, in order, as earlier ones are
+        answered.
+        """
+        self.requests.limit = 2
+        for x in range(4):
+            self.assertTrue(self.requests.request(x, 0, 0))
+        self.assertEquals(self.positions(), [(0, 0, 0), (1, 0, 0)])
+        self.assertFalse(self.requests.request(3, 0, 0))
+
+        self.terrain.set(1, 0, 0, loadTerrainFromString("G"))
+        self.assertEquals(
+            self.positions(), [(0, 0, 0), (1, 0, 0), (2, 0, 0)])
+        self.assertEquals(len(self.requests), 2)
+
+
+    def test_want(self):
+        """
+        L{TerrainRequests.want} replaces the queue of requests waiting to be
+        sent, skipping those which are already outstanding, and sends as many as
+        the limit allows.
+        """
+        self.requests.limit = 2
+        self.requests.want([(0, 0, 0), (1, 0, 0), (2, 0, 0)])
+        self.requests.want([(1, 0, 0), (4, 0, 0), (3, 0, 0)])
+        self.assertEquals(self.requests.duplicates, 1)
+
+        self.terrain.set(0, 0, 0, loadTerrainFromString("G"))
+        self.terrain.set(1, 0, 0, loadTerrainFromString("G"))
+        self.assertEquals(
+            self.positions(),
+            [(0, 0, 0), (1, 0, 0), (4, 0, 0), (3, 0, 0)])
+
+
+    def test_sendQueuedAfterFailure(self):
+        """
+        When an outstanding request is given up on, the next queued request is
+        sent in its place.
+        """
+        self.requests.limit = 1
+        self.requests.attempts = 1
+        self.requests.want([(0, 0, 0), (1, 0, 0)])
+        self.clock.advance(self.requests.timeout)
+        self.assertEquals(self.positions(), [(0, 0, 0), (1, 0, 0)])
+
+
+    def test_queuedAnswered(self):
+        """
+        A queued request is dropped if terrain covering its position arrives
+        before it is sent.
+        """
+        self.requests.limit = 1
+        self.requests.want([(0, 0, 0), (1, 0, 0), (2, 0, 0)])
+        self.terrain.set(0, 0, 0, loadTerrainFromString("GG"))
+        self.assertEquals(self.positions(), [(0, 0, 0), (2, 0, 0)])
+
+
+
 class RemovePlayerCommandTests(CommandTestMixin, TestCase):
     """
     Tests for L{RemovePlayer}.
@@ -301,12 +775,13 @@ class SetMyDirectionTests(CommandTestMixin, TestCase):
     """
     command = SetMyDirection
 
-    argumentObjects = {'direction': RIGHT, 'y': 1.5}
+    argumentObjects = {'direction': RIGHT, 'y': 1.5, 'sequence': 7}
     argumentStrings = {
         'direction': Direction().toString(RIGHT),
-        'y': '1.5'}
+        'y': '1.5',
+        'sequence': '7'}
 
-    responseObjects = {'x': 32.5, 'y': 939.5, 'z': 5.5}
+    responseObjects = {'x': 32.5, 'y': 939.5, 'z': 5.5, 'sequence': 7}
     responseStrings = stringifyDictValues(responseObjects)
 
 
@@ -333,6 +808,52 @@ class SetDirectionOfTests(CommandTestMixin, TestCase):
 
 
 
+class SetDirectionsOfTests(TestCase):
+    """
+    Tests for L{SetDirectionsOf}.
+    """
+    updates = [SetDirectionOfTests.argumentObjects,
+               dict(SetDirectionOfTests.argumentObjects, identifier=3,
+                    direction=None)]
+
+    def test_roundTrip(self):
+        """
+        The updates are each encoded like the arguments of L{SetDirectionOf}
+        and can be parsed back.
+        """
+        from twisted.protocols.amp import _objectsToStrings, _stringsToObjects
+        strings = _objectsToStrings(
+            {'updates': self.updates}, SetDirectionsOf.arguments, {}, None)
+        self.assertEqual(
+            _stringsToObjects(strings, SetDirectionsOf.arguments, None),
+            {'updates': self.updates})
+
+
+    def test_updateSize(self):
+        """
+        No update takes up more than L{SetDirectionsOf.updateSize} bytes.
+        """
+        from twisted.protocols.amp import _objectsToStrings
+        update = {
+            'identifier': 2 ** 64 - 1,
+            'direction': FORWARD + LEFT,
+            'x': -1.2345678901234567e+300,
+            'y': -1.2345678901234567e-300,
+            'z': -1.2345678901234567e+100,
+            'orientation': -1.2345678901234567e+100}
+        strings = _objectsToStrings(
+            {'updates': [update]}, SetDirectionsOf.arguments, {}, None)
+        self.assertEqual(
+            len(strings['updates']), SetDirectionsOf.updateSize)
+
+
+    def test_noAnswer(self):
+        """
+        The command has no response.
+        """
+        self.assertFalse(SetDirectionsOf.requiresAnswer)
+
+
 class ControllerTests(TestCase, PlayerCreationMixin, ArrayMixin):
     """
     L{NetworkController} takes network input and makes local changes to model
@@ -442,6 +963,44 @@ class ControllerTests(TestCase, PlayerCreationMixin, ArrayMixin):
         return d
 
 
+    def test_setDirectionsOf(self):
+        """
+        When L{SetDirectionsOf} is issued, each L{Player}'s direction,
+        position, and orientation should be set.
+        """
+        self.controller.addModelObject(self.identifier, self.player)
+        other = self.makePlayer(Vector(0, 0, 0))
+        self.controller.addModelObject(self.identifier + 1, other)
+
+        self.controller.setDirectionsOf([
+                {'identifier': self.identifier, 'direction': FORWARD,
+                 'x': 1.5, 'y': 2.5, 'z': 3.5, 'orientation': 90.0},
+                {'identifier': self.identifier + 1, 'direction': None,
+                 'x': -1.5, 'y': 0.0, 'z': 4.0, 'orientation': 45.0}])
+        self.assertEquals(self.player.direction, FORWARD)
+        self.assertEquals(self.player.getPosition(), Vector(1.5, 2.5, 3.5))
+        self.assertEquals(self.player.orientation.y, 90.0)
+        self.assertIdentical(other.direction, None)
+        self.assertEquals(other.getPosition(), Vector(-1.5, 0.0, 4.0))
+        self.assertEquals(other.orientation.y, 45.0)
+
+
+    def test_setDirectionOfSmoothed(self):
+        """
+        A L{Player} moved by L{SetDirectionOf} is shown moving from where it
+        was to its new position over L{NetworkController.correctionPeriod}
+        seconds.
+        """
+        self.controller.addModelObject(self.identifier, self.player)
+        self.controller.correctionPeriod = 2
+        self.controller.setDirectionOf(
+            self.identifier, None, 1, 2, 7, 0)
+        self.assertEquals(self.player.getPosition(), Vector(1, 2, 7))
+        self.assertEquals(self.player.getSmoothedPosition(), Vector(1, 2, 3))
+        self.advanceTime(1)
+        self.assertEquals(self.player.getSmoothedPosition(), Vector(1, 2, 5))
+
+
     def _assertThingsAboutPlayerCreation(self, environment, position, speed):
         player = self.controller.modelObjects[self.identifier]
         self.assertEqual(player.getPosition(), position)
@@ -485,7 +1044,10 @@ class ControllerTests(TestCase, PlayerCreationMixin, ArrayMixin):
         self.assertEqual(len(self.calls), 1)
         result, command, kw = self.calls.pop()
         self.assertIdentical(command, Introduce)
-        self.assertEqual(kw, {})
+        self.assertEqual(
+            kw,
+            {'compression': sorted(TERRAIN_COMPRESSION),
+             'features': sorted(PROTOCOL_FEATURES)})
         self.assertEqual(self.controller.modelObjects, {})
         self.assertIdentical(self.controller.environment, None)
 
@@ -494,8 +1056,13 @@ class ControllerTests(TestCase, PlayerCreationMixin, ArrayMixin):
                          'speed': speed,
                          'x': x,
                          'y': y,
-                         'z': z})
+                         'z': z,
+                         'compression': 'zlib',
+                         'features': [TERRAIN_CHUNKS, 'bogus']})
 
+        self.assertEquals(self.controller.terrainCompression, 'zlib')
+        self.assertEquals(
+            self.controller.features, frozenset([TERRAIN_CHUNKS]))
         self._assertThingsAboutPlayerCreation(
             self.controller.environment, Vector(x, y, z), speed)
         self.assertIsInstance(self.controller.environment, Environment)
@@ -519,7 +1086,7 @@ class ControllerTests(TestCase, PlayerCreationMixin, ArrayMixin):
         self.assertEqual(len(self.calls), 1)
         result, command, kw = self.calls.pop(0)
         self.assertIdentical(command, SetMyDirection)
-        self.assertEqual(kw, {"direction": FORWARD, "y": 2.0})
+        self.assertEqual(kw, {"direction": FORWARD, "y": 2.0, "sequence": 1})
 
 
     def test_orientationDirectionChanged(self):
@@ -532,7 +1099,7 @@ class ControllerTests(TestCase, PlayerCreationMixin, ArrayMixin):
         self.assertEqual(len(self.calls), 1)
         result, command, kw = self.calls.pop(0)
         self.assertIdentical(command, SetMyDirection)
-        self.assertEqual(kw, {"direction": None, "y": 1.5})
+        self.assertEqual(kw, {"direction": None, "y": 1.5, "sequence": 1})
 
 
     def test_directionChangedResponse(self):
@@ -548,6 +1115,101 @@ class ControllerTests(TestCase, PlayerCreationMixin, ArrayMixin):
         self.assertEqual(self.player.getPosition(), Vector(x, y, z))
 
 
+    def test_reconcile(self):
+        """
+        When the server answers a L{SetMyDirection} command, the L{Player} is
+        put where the server says it was when it carried out the command,
+        moved on by the commands sent since then.
+        """
+        self.controller.addModelObject(self.identifier, self.player)
+        self.player.setDirection(FORWARD)
+        self.advanceTime(1)
+        self.player.setDirection(RIGHT)
+        self.advanceTime(1)
+        self.player.setDirection(None)
+        self.advanceTime(1)
+        self.assertEqual(self.player.getPosition(), Vector(2, 2, 2))
+        self.assertEqual(
+            [kw["sequence"] for (d, command, kw) in self.calls], [1, 2, 3])
+
+        # The server had the player a little further back when it started.
+        self.calls[0][0].callback({"x": 1, "y": 2, "z": 5, "sequence": 1})
+        self.assertEqual(self.player.getPosition(), Vector(2, 2, 4))
+
+        # Older answers are ignored once a later one has been applied.
+        self.calls[2][0].callback({"x": 2, "y": 2, "z": 3, "sequence": 3})
+        self.assertEqual(self.player.getPosition(), Vector(2, 2, 3))
+        self.calls[1][0].callback({"x": 9, "y": 9, "z": 9, "sequence": 2})
+        self.assertEqual(self.player.getPosition(), Vector(2, 2, 3))
+
+
+    def test_unsequencedAnswer(self):
+        """
+        An answer to a L{SetMyDirection} command without a C{sequence} puts
+        the L{Player} where it says and forgets the commands waiting for one.
+        """
+        self.controller.addModelObject(self.identifier, self.player)
+        self.player.setDirection(FORWARD)
+        self.player.setDirection(RIGHT)
+        self.calls[0][0].callback({"x": 1, "y": 2, "z": 3})
+        self.assertEqual(self.player.getPosition(), Vector(1, 2, 3))
+        self.assertEqual(self.controller._inputs, {})
+
+
+    def test_turnsCoalesced(self):
+        """
+        Turns within L{NetworkController.turnInterval} of the last
+        L{SetMyDirection} command are sent together in one command, with the
+        latest orientation, once that interval has passed.
+        """
+        self.controller.addModelObject(self.identifier, self.player)
+        self.player.turn(0, 1)
+        self.player.turn(0, 2)
+        self.player.turn(0, 3)
+        self.assertEqual([kw for (d, command, kw) in self.calls],
+                         [{"direction": None, "y": 1.0, "sequence": 1}])
+
+        self.clock.advance(self.controller.turnInterval)
+        self.assertEqual([kw for (d, command, kw) in self.calls[1:]],
+                         [{"direction": None, "y": 6.0, "sequence": 2}])
+        self.clock.advance(self.controller.turnInterval)
+        self.assertEqual(len(self.calls), 2)
+
+        self.player.turn(0, 1)
+        self.assertEqual(len(self.calls), 3)
+
+
+    def test_movementNotDelayed(self):
+        """
+        A change in direction of movement is sent at once, even soon after a
+        turn, and with it any turn waiting to be sent.
+        """
+        self.controller.addModelObject(self.identifier, self.player)
+        self.player.turn(0, 1)
+        self.player.turn(0, 2)
+        self.player.setDirection(FORWARD)
+        self.assertEqual([kw for (d, command, kw) in self.calls],
+                         [{"direction": None, "y": 1.0, "sequence": 1},
+                          {"direction": FORWARD, "y": 3.0, "sequence": 2}])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_connectionLostCancelsTurns(self):
+        """
+        Turns waiting to be sent are dropped when the connection is lost, and
+        so are the commands already sent.
+        """
+        self.controller.addModelObject(self.identifier, self.player)
+        self.player.turn(0, 1)
+        self.player.turn(0, 2)
+        self.controller.makeConnection(StringTransport())
+        self.controller.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.controller._pendingTurns, {})
+        self.assertEqual(self.controller._lastSent, {})
+        self.assertEqual(self.controller._inputs, {})
+
+
     def test_newPlayer(self):
         """
         L{NetworkController} should respond to L{NewPlayer} commands
@@ -635,6 +1297,26 @@ class ControllerTests(TestCase, PlayerCreationMixin, ArrayMixin):
         return d
 
 
+    def test_setTerrainChunks(self):
+        """
+        L{NetworkController} responds to the L{SetTerrainChunks} command by
+        updating its terrain model with the data for each chunk.
+        """
+        environment = self.controller.environment = Environment(10, self.clock)
+        responder = self.controller.lookupFunction(
+            SetTerrainChunks.commandName)
+        chunks = [
+            (0, 0, 0, loadTerrainFromString('G')),
+            (8, 0, 0, loadTerrainFromString('W'))]
+        d = responder(SetTerrainChunks.makeArguments({'chunks': chunks}, None))
+        def gotResult(ignored):
+            self.assertEquals(
+                environment.terrain.dict(),
+                {(0, 0, 0): GRASS, (8, 0, 0): WATER})
+        d.addCallback(gotResult)
+        return d
+
+
     def test_overwriteTerrain(self):
         """
         When L{NetworkController} receives a L{SetTerrain} which overlaps with
@@ -3,6 +3,7 @@ from twisted.trial import unittest
 from game.direction import FORWARD, BACKWARD, LEFT, RIGHT
 from game.test.util import PlayerCreationMixin
 from game.vector import Vector
+from game.player import Player, PlayerTable
 
 # Expedient hack until I switch to decimals
 _epsilon = 0.0001
@@ -160,6 +161,23 @@ class PlayerTests(unittest.TestCase, PlayerCreationMixin):
         self.assertEqual(player.getPosition(), Vector(x + 1, 0, y))
 
 
+    def test_getVelocity(self):
+        """
+        L{Player.getVelocity} returns the distance the player covers per second
+        along each axis, which depends on its direction, orientation and speed.
+        """
+        player = self.makePlayer(Vector(0, 0, 0), speed=3)
+        self.assertEqual(player.getVelocity(), Vector(0, 0, 0))
+
+        player.setDirection(FORWARD)
+        self.assertEqual(player.getVelocity(), Vector(0, 0, -3))
+
+        player.turn(0, 90)
+        velocity = player.getVelocity()
+        self.assertTrue(abs(velocity.x - 3) < _epsilon)
+        self.assertTrue(abs(velocity.z) < _epsilon)
+
+
     def test_observeDirection(self):
         """
         Setting the player's direction should notify any observers registered
@@ -173,6 +191,19 @@ class PlayerTests(unittest.TestCase, PlayerCreationMixin):
         self.assertEqual(observer.changes, [(player, position, FORWARD)])
 
 
+    def test_removeObserver(self):
+        """
+        An observer removed with L{Player.removeObserver} is no longer told
+        about changes of direction.
+        """
+        player = self.makePlayer(Vector(0, 0, 0))
+        observer = DirectionObserver()
+        player.addObserver(observer)
+        player.removeObserver(observer)
+        player.setDirection(FORWARD)
+        self.assertEqual(observer.changes, [])
+
+
     def test_getPositionInsideObserver(self):
         """
         L{Player.getPosition} should return an accurate value when called
@@ -231,3 +262,168 @@ class PlayerTests(unittest.TestCase, PlayerCreationMixin):
         self.assertTrue(abs(p.y) < _epsilon)
         self.assertTrue(abs(p.z) < _epsilon)
 
+
+    def test_setOrientation(self):
+        """
+        Setting a component of L{Player.orientation} does not change the way
+        the player moves behind the back of its observers; it takes effect at
+        the next L{Player.setDirection}, which notifies them.
+        """
+        player = self.makePlayer(Vector(0, 0, 0))
+        changes = []
+        class Observer(object):
+            def directionChanged(self, player):
+                changes.append(player.getPosition())
+        player.addObserver(Observer())
+        player.setDirection(FORWARD)
+        self.advanceTime(1)
+        player.orientation.y = 90
+        self.assertEquals(player.orientation, Vector(0, 90, 0))
+        self.advanceTime(1)
+        self.assertEquals(player.getPosition(), Vector(0, 0, -2))
+        self.assertEquals(changes, [Vector(0, 0, 0)])
+
+        player.setDirection(FORWARD)
+        self.assertEquals(changes, [Vector(0, 0, 0), Vector(0, 0, -2)])
+        self.advanceTime(1)
+        p = player.getPosition()
+        self.assertTrue(abs(p.x - 1) < _epsilon)
+        self.assertTrue(abs(p.z + 2) < _epsilon)
+
+
+
+    def test_correctPosition(self):
+        """
+        L{Player.correctPosition} moves a player at once, but its smoothed
+        position is blended from where it was to where it is over the given
+        number of seconds.
+        """
+        player = self.makePlayer(Vector(0, 0, 0))
+        player.setDirection(RIGHT)
+        self.assertEqual(player.getSmoothedPosition(), Vector(0, 0, 0))
+        player.correctPosition(Vector(0, 0, 4), 2)
+        self.assertEqual(player.getPosition(), Vector(0, 0, 4))
+        self.assertEqual(player.getSmoothedPosition(), Vector(0, 0, 0))
+
+        self.advanceTime(1)
+        self.assertEqual(player.getPosition(), Vector(1, 0, 4))
+        self.assertEqual(player.getSmoothedPosition(), Vector(1, 0, 2))
+        self.advanceTime(1)
+        self.assertEqual(player.getSmoothedPosition(), Vector(2, 0, 4))
+        self.advanceTime(1)
+        self.assertEqual(player.getSmoothedPosition(), player.getPosition())
+
+
+    def test_correctPositionAgain(self):
+        """
+        A correction made while another is being blended away starts from the
+        smoothed position.
+        """
+        player = self.makePlayer(Vector(0, 0, 0))
+        player.correctPosition(Vector(0, 0, 4), 2)
+        self.advanceTime(1)
+        player.correctPosition(Vector(0, 0, 8), 2)
+        self.assertEqual(player.getSmoothedPosition(), Vector(0, 0, 2))
+        self.advanceTime(1)
+        self.assertEqual(player.getSmoothedPosition(), Vector(0, 0, 5))
+
+
+    def test_setPositionNotSmoothed(self):
+        """
+        L{Player.setPosition} and a correction over no time move the smoothed
+        position at once, dropping any correction still being blended away.
+        """
+        player = self.makePlayer(Vector(0, 0, 0))
+        player.correctPosition(Vector(0, 0, 4), 2)
+        player.setPosition(Vector(1, 0, 0))
+        self.assertEqual(player.getSmoothedPosition(), Vector(1, 0, 0))
+        player.correctPosition(Vector(2, 0, 0), 0)
+        self.assertEqual(player.getSmoothedPosition(), Vector(2, 0, 0))
+
+
+class PlayerTableTests(unittest.TestCase, PlayerCreationMixin):
+    """
+    Tests for L{PlayerTable}.
+    """
+    def setUp(self):
+        self.table = PlayerTable(lambda: self.currentSeconds)
+
+
+    def makePlayer(self, position, speed=1):
+        """
+        Create a new L{Player} in C{self.table}.
+        """
+        return Player(
+            position, speed, self.table.seconds, self.table)
+
+
+    def test_rows(self):
+        """
+        Each L{Player} created with a L{PlayerTable} has a row of its arrays.
+        """
+        first = self.makePlayer(Vector(1, 2, 3), speed=4)
+        second = self.makePlayer(Vector(5, 6, 7), speed=8)
+        second.setDirection(LEFT)
+        self.assertEquals(len(self.table), 2)
+        self.assertEquals(self.table.players, [first, second])
+        self.assertEquals(
+            self.table.positions[:2].tolist(), [[1, 2, 3], [5, 6, 7]])
+        self.assertEquals(self.table.speeds[:2].tolist(), [4, 8])
+        self.assertEquals(self.table.directions[:2].tolist(), [0, LEFT])
+
+
+    def test_grow(self):
+        """
+        The arrays of a L{PlayerTable} grow to hold as many players as are
+        added.
+        """
+        players = [self.makePlayer(Vector(i, 0, 0)) for i in range(10)]
+        self.assertEquals(len(self.table), 10)
+        self.assertEquals(
+            [player.getPosition() for player in players],
+            [Vector(i, 0, 0) for i in range(10)])
+
+
+    def test_advance(self):
+        """
+        L{PlayerTable.advance} moves every row to where its player is at the
+        current time, without changing where the players are.
+        """
+        moving = self.makePlayer(Vector(1, 0, 0), speed=2)
+        still = self.makePlayer(Vector(3, 0, 0))
+        moving.setDirection(FORWARD)
+        self.advanceTime(2)
+        self.table.advance()
+        self.assertEquals(
+            self.table.positions[:2].tolist(), [[1, 0, -4], [3, 0, 0]])
+        self.assertEquals(self.table.times[:2].tolist(), [17, 17])
+        self.assertEquals(moving.getPosition(), Vector(1, 0, -4))
+        self.advanceTime(1)
+        self.assertEquals(moving.getPosition(), Vector(1, 0, -6))
+        self.assertEquals(still.getPosition(), Vector(3, 0, 0))
+
+
+    def test_remove(self):
+        """
+        L{PlayerTable.remove} drops the row of a player and moves the last row
+        into its place.  The removed player stays where it was.
+        """
+        first = self.makePlayer(Vector(1, 0, 0))
+        second = self.makePlayer(Vector(2, 0, 0))
+        third = self.makePlayer(Vector(3, 0, 0))
+        first.setDirection(FORWARD)
+        third.turn(0, 90)
+        third.setDirection(FORWARD)
+        self.table.remove(first)
+        self.assertEquals(self.table.players, [third, second])
+        self.assertIdentical(first._table, None)
+
+        self.advanceTime(1)
+        self.assertEquals(first.getPosition(), Vector(1, 0, 0))
+        self.assertEquals(first.getSmoothedPosition(), Vector(1, 0, 0))
+        self.assertEquals(third.orientation, Vector(0, 90, 0))
+        self.assertTrue(abs(third.getPosition().x - 4) < _epsilon)
+        self.assertEquals(second.getPosition(), Vector(2, 0, 0))
+
+        self.assertRaises(ValueError, self.table.remove, first)
+
@@ -3,7 +3,7 @@
 Tests for L{game.terrain}.
 """
 
-from numpy import zeros, array, concatenate
+from numpy import zeros, array, concatenate, ravel_multi_index, dtype
 
 from pygame import Surface
 
@@ -12,11 +12,11 @@ from twisted.trial.unittest import TestCase
 from game.test.util import ArrayMixin
 from game.vector import Vector
 from game.terrain import (
-    LEFT, RIGHT, TOP, BOTTOM, FRONT, BACK,
+    LEFT, RIGHT, TOP, BOTTOM, FRONT, BACK, FACES,
     UNKNOWN, EMPTY, GRASS, MOUNTAIN, DESERT, WATER,
-    Terrain, SurfaceMesh, SurfaceMeshVertices, loadTerrainFromString,
-    loadTerrainFromSurface,
-    _top, _front, _bottom, _back, _left, _right)
+    PACKED_TEXTURE_SCALE, Terrain, SurfaceMesh, SurfaceMeshVertices,
+    loadTerrainFromString, loadTerrainFromSurface, quadIndices,
+    _top, _front, _bottom, _back, _left, _right, _greedyRectangles)
 
 
 class LoadTerrainFromStringTests(TestCase, ArrayMixin):
@@ -116,14 +116,124 @@ class TerrainTests(TestCase, ArrayMixin):
     """
     def test_initial(self):
         """
-        When L{Terrain} is instantiated, it allocates storage only for the voxel
-        at (0, 0, 0) and indicates that the terrain type for that voxel is
+        When L{Terrain} is instantiated, its extent covers only the voxel at
+        (0, 0, 0) and it indicates that the terrain type for that voxel is
         unknown.
         """
         terrain = Terrain()
+        self.assertEquals(terrain.shape, (1, 1, 1))
         self.assertArraysEqual(terrain.voxels, array([[[UNKNOWN]]], 'b'))
 
 
+    def test_sparse(self):
+        """
+        L{Terrain.set} only allocates storage for the chunks which the new
+        voxels overlap, no matter how far they are from the origin.
+        """
+        terrain = Terrain()
+        x, y, z = terrain.chunkShape
+        terrain.set(x * 1000, y * 1000, z * 1000, loadTerrainFromString("G"))
+        self.assertEquals(
+            terrain._chunks.keys(), [(x * 1000, y * 1000, z * 1000)])
+        self.assertEquals(
+            terrain.shape, (x * 1000 + 1, y * 1000 + 1, z * 1000 + 1))
+
+
+    def test_setAcrossChunks(self):
+        """
+        Voxels passed to L{Terrain.set} which straddle a chunk boundary are
+        split between the chunks they overlap.
+        """
+        terrain = Terrain()
+        x, y, z = terrain.chunkShape
+        voxels = loadTerrainFromString("GM\nDW")
+        terrain.set(x - 1, 0, z - 1, voxels)
+        self.assertEquals(
+            sorted(terrain._chunks.keys()),
+            [(0, 0, 0), (0, 0, z), (x, 0, 0), (x, 0, z)])
+        self.assertArraysEqual(terrain.get(x - 1, 0, z - 1, (2, 1, 2)), voxels)
+
+
+    def test_overlapping(self):
+        """
+        L{Terrain.overlapping} gives the origin of each chunk a prism overlaps,
+        with the slices selecting the shared voxels from the chunk and from
+        the prism.
+        """
+        terrain = Terrain()
+        x, y, z = terrain.chunkShape
+        self.assertEquals(
+            list(terrain.overlapping(x - 1, 0, 0, (2, 1, 1))),
+            [((0, 0, 0),
+              (slice(x - 1, x), slice(0, 1), slice(0, 1)),
+              (slice(0, 1), slice(0, 1), slice(0, 1))),
+             ((x, 0, 0),
+              (slice(0, 1), slice(0, 1), slice(0, 1)),
+              (slice(1, 2), slice(0, 1), slice(0, 1)))])
+
+
+    def test_get(self):
+        """
+        L{Terrain.get} returns the voxels in the requested prism, with any
+        voxels which have never been set reported as L{UNKNOWN}.
+        """
+        terrain = Terrain()
+        terrain.set(1, 0, 0, loadTerrainFromString("GM"))
+        self.assertArraysEqual(
+            terrain.get(-1, 0, 0, (5, 1, 1)),
+            array([[[UNKNOWN]], [[UNKNOWN]], [[GRASS]], [[MOUNTAIN]],
+                   [[UNKNOWN]]], 'b'))
+
+
+    def test_voxelAt(self):
+        """
+        L{Terrain.voxelAt} returns the terrain type of a single voxel, or
+        L{UNKNOWN} if it has never been set.
+        """
+        terrain = Terrain()
+        terrain.set(3, 4, 5, loadTerrainFromString("W"))
+        self.assertEquals(terrain.voxelAt(3, 4, 5), WATER)
+        self.assertEquals(terrain.voxelAt(3, 4, 6), UNKNOWN)
+        self.assertEquals(terrain.voxelAt(-3, -4, -5), UNKNOWN)
+
+
+    def test_unloadChunk(self):
+        """
+        L{Terrain.unloadChunk} forgets the voxels of a chunk, so they are
+        L{UNKNOWN} again, and notifies observers about the change.
+        """
+        terrain = Terrain()
+        x, y, z = terrain.chunkShape
+        terrain.set(x - 1, 0, 0, loadTerrainFromString("GM"))
+        events = []
+        terrain.addObserver(lambda position, shape: events.append(
+                (position, shape)))
+        terrain.unloadChunk((x, 0, 0))
+        self.assertEquals(terrain.voxelAt(x - 1, 0, 0), GRASS)
+        self.assertEquals(terrain.voxelAt(x, 0, 0), UNKNOWN)
+        self.assertEquals(terrain.loadedChunks(), [(0, 0, 0)])
+        self.assertEquals(events, [(Vector(x, 0, 0), Vector(x, y, z))])
+
+        # Unloading it again does nothing.
+        terrain.unloadChunk((x, 0, 0))
+        self.assertEquals(len(events), 1)
+
+
+    def test_unloadsNotObserved(self):
+        """
+        An observer added with C{unloads=False} is notified about voxels being
+        set but not about chunks being unloaded.
+        """
+        terrain = Terrain()
+        events = []
+        terrain.addObserver(
+            lambda position, shape: events.append((position, shape)),
+            unloads=False)
+        terrain.set(0, 0, 0, loadTerrainFromString("G"))
+        terrain.unloadChunk((0, 0, 0))
+        self.assertEquals(events, [(Vector(0, 0, 0), Vector(1, 1, 1))])
+
+
     def test_dict(self):
         """
         L{Terrain.dict} returns a C{dict} containing all of the terrain data,
@@ -153,6 +263,20 @@ class TerrainTests(TestCase, ArrayMixin):
         self.assertEquals(events, [(Vector(4, 5, 6), Vector(3, 1, 2))])
 
 
+    def test_removeObserver(self):
+        """
+        An observer removed with L{Terrain.removeObserver} is no longer
+        notified of changes.
+        """
+        terrain = Terrain()
+        events = []
+        observer = lambda position, shape: events.append(position)
+        terrain.addObserver(observer)
+        terrain.removeObserver(observer)
+        terrain.set(0, 0, 0, loadTerrainFromString("G"))
+        self.assertEquals(events, [])
+
+
     def test_unknownTerrain(self):
         """
         When there is a gap in known terrain left by L{Terrain.set} calls, the
@@ -167,22 +291,65 @@ class TerrainTests(TestCase, ArrayMixin):
 
 
 
+class SurfaceMeshVerticesTests(TestCase, ArrayMixin):
+    """
+    Tests for L{SurfaceMeshVertices}.
+    """
+    def setUp(self):
+        self.data = zeros((12, 5), 'f')
+        self.vertices = SurfaceMeshVertices(self.data, self.data, 0)
+
+
+    def test_write(self):
+        """
+        L{SurfaceMeshVertices.write} copies vertices into C{data} and records
+        the range it changed.
+        """
+        vertices = array([[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]], 'f')
+        self.vertices.write(3, vertices)
+        self.assertArraysEqual(self.data[3:5], vertices)
+        self.assertEquals(self.vertices.takeDirty(), [(3, 5)])
+
+
+    def test_takeDirty(self):
+        """
+        L{SurfaceMeshVertices.takeDirty} returns the ranges changed since it
+        was last called, sorted, with overlapping and adjacent ranges merged.
+        """
+        self.vertices.write(8, zeros((2, 5), 'f'))
+        self.vertices.write(0, zeros((2, 5), 'f'))
+        self.vertices.write(1, zeros((2, 5), 'f'))
+        self.vertices.write(3, zeros((1, 5), 'f'))
+        self.assertEquals(self.vertices.takeDirty(), [(0, 4), (8, 10)])
+        self.assertEquals(self.vertices.takeDirty(), [])
+
+
+
 class SurfaceMeshTests(TestCase, ArrayMixin):
     """
     Tests for L{terrain.SurfaceMesh}.
     """
-    def surfaceFactory(self):
+    def surfaceFactory(self, size):
         """
-        Give back a single pre-created array for the surface mesh to populate.
-        The array is initialized in C{setUp}.
+        Create an array for the surface mesh of one terrain chunk to populate,
+        and record its size in C{self.sizes}.
         """
-        if self.surfaceArray is None:
-            raise Exception(
-                "Already gave out the only surface - "
-                "these tests should only require one.")
-        surfaceArray = self.surfaceArray
-        self.surfaceArray = None
-        return surfaceArray
+        self.sizes.append(size)
+        vertices = zeros((size, 5), 'f')
+        return SurfaceMeshVertices(vertices, vertices, 0)
+
+
+    def vertices(self, surface=None):
+        """
+        Return the vertices of every chunk of C{surface}, or C{self.surface} if
+        it is not given, as a single array.
+        """
+        if surface is None:
+            surface = self.surface
+        pieces = [
+            vertices.data[:vertices.important]
+            for (origin, vertices) in sorted(surface.surfaces())]
+        return concatenate([zeros((0, 5), 'f')] + pieces)
 
 
     def setUp(self):
@@ -202,9 +369,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
             MOUNTAIN: (0.5, 0.75),
             GRASS: (0.25, 0.5),
             }
-        vertices = zeros((1000, 5), 'f')
-        self.surfaceArray = self.mesh = SurfaceMeshVertices(
-            vertices, vertices, 0)
+        self.sizes = []
         self.terrain = Terrain()
         self.surface = SurfaceMesh(
             self.terrain, self.surfaceFactory, self.texCoords, self.e)
@@ -271,119 +436,211 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
         self.assertFalse(self.surface._exposed(0, 0, 2, BACK))
 
 
-    def _compactTest(self, face, vertices):
-
-        if face == BACK:
-            other = FRONT
-        else:
-            other = BACK
+    def _twoFaces(self):
+        """
+        Add the back and then the front face of one voxel to the surface mesh.
 
+        @return: The L{_ChunkMesh} holding the faces and the position of the
+            voxel within it.
+        """
         x, y, z = 3, 5, 7
-        # Make something to overwrite.
         self.surface._append(
-            (x, y, z, other), self.surface._makeFace(other, GRASS, x, y, z))
-
-        # Put some front-face vertices at the end of the array.
+            (x, y, z, BACK), self.surface._makeFace(BACK, GRASS, x, y, z))
         self.surface._append(
-            (x, y, z, face), self.surface._makeFace(face, GRASS, x, y, z))
+            (x, y, z, FRONT), self.surface._makeFace(FRONT, GRASS, x, y, z))
+        return self.surface._chunks[0, 4, 0], (x, 1, z)
 
-        # Overwrite that something from above.
-        start, length = self.surface._voxelToSurface[x, y, z, other]
-        self.surface._compact(x, y, z, other, start, length)
 
-        # There should just be the front vertices left, in the place we told it
-        # to overwrite.
-        texture = self.textureBase
-        s, t = self.texCoords[GRASS]
-        self.assertArraysEqual(
-            self.mesh.data[:self.mesh.important],
-            array([x, y, z, s, t], 'f') + array(vertices + texture, 'f'))
-
-        # And it should know where they are.
+    def test_append(self):
+        """
+        L{SurfaceMesh._append} adds the vertices of a face to the surface mesh
+        of the chunk containing its voxel and records the slot they are in.
+        """
+        chunk, (x, y, z) = self._twoFaces()
+        self.assertEquals(chunk.index[x, y, z, BACK], 0)
+        self.assertEquals(chunk.index[x, y, z, FRONT], 1)
+        self.assertEquals((chunk.index >= 0).sum(), 2)
         self.assertEquals(
-            self.surface._voxelToSurface[x, y, z, face], (start, length))
+            list(chunk.owners[:2]),
+            [ravel_multi_index((x, y, z, face), chunk.index.shape)
+             for face in (BACK, FRONT)])
 
 
-    def test_compactTop(self):
+    def test_compact(self):
         """
-        If the vertices at the end of the surface mesh array represent the top
-        face of a voxel, they are identified as such by L{SurfaceMesh._compact},
-        relocated, and the tracking dictionary updated to refer to their new
-        location.
+        L{SurfaceMesh._compact} removes the vertices of a face from the surface
+        mesh of its chunk by moving the vertices from the end of the chunk's
+        array on top of them, and updates the index for the moved face.
         """
-        self._compactTest(TOP, _top)
+        chunk, (x, y, z) = self._twoFaces()
+        self.surface._compact(chunk, [chunk.index[x, y, z, BACK]])
 
+        self.assertArraysEqual(
+            self.vertices(), self.surface._makeFace(FRONT, GRASS, 3, 5, 7))
+        self.assertEquals(chunk.index[x, y, z, BACK], -1)
+        self.assertEquals(chunk.index[x, y, z, FRONT], 0)
+        self.assertEquals((chunk.index >= 0).sum(), 1)
 
-    def test_compactFront(self):
+
+    def test_compactLast(self):
         """
-        If the vertices at the end of the surface mesh array represent the front
-        face of a voxel, they are identified as such by L{SurfaceMesh._compact},
-        relocated, and the tracking dictionary updated to refer to their new
-        location.
+        When the face removed by L{SurfaceMesh._compact} is the last one in its
+        chunk's array, no other vertices are moved.
         """
-        self._compactTest(FRONT, _front)
+        chunk, (x, y, z) = self._twoFaces()
+        self.surface._compact(chunk, [chunk.index[x, y, z, FRONT]])
+
+        self.assertArraysEqual(
+            self.vertices(), self.surface._makeFace(BACK, GRASS, 3, 5, 7))
+        self.assertEquals(chunk.index[x, y, z, BACK], 0)
+        self.assertEquals(chunk.index[x, y, z, FRONT], -1)
 
 
-    def test_compactBottom(self):
+    def test_compactMany(self):
         """
-        If the vertices at the end of the surface mesh array represent the
-        bottom face of a voxel, they are identified as such by
-        L{SurfaceMesh._compact}, relocated, and the tracking dictionary updated
-        to refer to their new location.
+        L{SurfaceMesh._compact} can remove many faces at once, filling the
+        holes before the new end of the array with the faces after it which are
+        being kept.
         """
-        self._compactTest(BOTTOM, _bottom)
+        faces = [
+            (x, 0, 0, face) for x in range(3) for face in (TOP, BOTTOM)]
+        for key in faces:
+            self.surface._append(key, self.surface._makeFace(
+                    key[3], GRASS, *key[:3]))
+        chunk = self.surface._chunks[0, 0, 0]
+        self.surface._compact(chunk, [0, 3, 5])
+
+        remaining = [faces[1], faces[2], faces[4]]
+        self.assertVertices(
+            self.vertices(),
+            [(face, self.surface._makeFace(face, GRASS, x, y, z))
+             for (x, y, z, face) in remaining],
+            18)
+        self.assertEquals((chunk.index >= 0).sum(), 3)
+        for x, y, z, face in remaining:
+            slot = chunk.index[x, y, z, face]
+            self.assertArraysEqual(
+                self.vertices()[slot * 6:slot * 6 + 6],
+                self.surface._makeFace(face, GRASS, x, y, z))
+
+
+    def test_grow(self):
+        """
+        When the faces of a chunk no longer fit in the storage allocated for
+        it, L{SurfaceMesh} allocates storage twice as large and copies the
+        existing vertices into it.
+        """
+        initial = self.surface._initialFaces
+        x, y, z = self.terrain.chunkShape
+        faces = [
+            (vx, vy, vz, face)
+            for vx in range(x) for vy in range(y) for vz in range(z)
+            for face in FACES][:initial + 1]
+        for key in faces:
+            self.surface._append(key, self.surface._makeFace(
+                    key[3], GRASS, *key[:3]))
+
+        self.assertEquals(self.sizes, [initial * 6, initial * 12])
+        [(origin, vertices)] = self.surface.surfaces()
+        self.assertEquals(len(vertices.data), initial * 12)
+        self.assertArraysEqual(
+            vertices.data[:vertices.important],
+            concatenate([
+                    self.surface._makeFace(face, GRASS, vx, vy, vz)
+                    for (vx, vy, vz, face) in faces]))
 
 
-    def test_compactBack(self):
+    def test_growMany(self):
         """
-        If the vertices at the end of the surface mesh array represent the back
-        face of a voxel, they are identified as such by L{SurfaceMesh._compact},
-        relocated, and the tracking dictionary updated to refer to their new
-        location.
+        When more faces are added to a chunk at once than twice its storage can
+        hold, L{SurfaceMesh} allocates storage large enough for all of them.
         """
-        self._compactTest(BACK, _back)
+        x, y, z = self.terrain.chunkShape
+        self.terrain.set(
+            0, 0, 0, loadTerrainFromString(
+                "\n\n".join(["\n".join(["G_" * (x / 2)] * z)] * y)))
+        vertices = len(self.vertices())
+        self.assertTrue(vertices > self.surface._initialFaces * 12)
+        self.assertEquals(
+            self.sizes, [self.surface._initialFaces * 6, vertices])
 
 
-    def test_compactLeft(self):
+    def test_dirtyRanges(self):
         """
-        If the vertices at the end of the surface mesh array represent the left
-        face of a voxel, they are identified as such by L{SurfaceMesh._compact},
-        relocated, and the tracking dictionary updated to refer to their new
-        location.
+        After a voxel is removed, only the vertices of the faces which were
+        moved to fill the holes it left are recorded as changed.
         """
-        self._compactTest(LEFT, _left)
+        self.terrain.set(0, 0, 0, loadTerrainFromString("M_G_M"))
+        [(origin, vertices)] = self.surface.surfaces()
+        vertices.takeDirty()
+
+        self.terrain.set(2, 0, 0, loadTerrainFromString("_"))
+        dirty = vertices.takeDirty()
+        self.assertEquals(
+            sum(stop - start for (start, stop) in dirty), 6 * 6)
+        self.assertTrue(all(stop <= 12 * 6 for (start, stop) in dirty))
 
 
-    def test_compactRight(self):
+    def test_separateChunks(self):
         """
-        If the vertices at the end of the surface mesh array represent the right
-        face of a voxel, they are identified as such by L{SurfaceMesh._compact},
-        relocated, and the tracking dictionary updated to refer to their new
-        location.
+        The faces of voxels in different terrain chunks are kept in different
+        L{SurfaceMeshVertices}, one for each chunk.
         """
-        self._compactTest(RIGHT, _right)
+        x, y, z = self.terrain.chunkShape
+        self.terrain.set(x - 1, 0, 0, loadTerrainFromString("MG"))
+        surfaces = dict(self.surface.surfaces())
+        self.assertEquals(sorted(surfaces), [(0, 0, 0), (x, 0, 0)])
+        self.assertVertices(
+            surfaces[0, 0, 0].data,
+            [(face, self.surface._makeFace(face, MOUNTAIN, x - 1, 0, 0))
+             for face in (TOP, FRONT, BOTTOM, BACK, LEFT)],
+            surfaces[0, 0, 0].important)
+        self.assertVertices(
+            surfaces[x, 0, 0].data,
+            [(face, self.surface._makeFace(face, GRASS, x, 0, 0))
+             for face in (TOP, FRONT, BOTTOM, BACK, RIGHT)],
+            surfaces[x, 0, 0].important)
+
+
+    def test_changeAcrossChunks(self):
+        """
+        When a change reveals a face in a neighboring chunk, that chunk's
+        surface mesh is updated.  The surface mesh of a chunk left with nothing
+        to draw is discarded.
+        """
+        x, y, z = self.terrain.chunkShape
+        self.terrain.set(x - 1, 0, 0, loadTerrainFromString("MG"))
+        self.terrain.set(x - 1, 0, 0, loadTerrainFromString("_"))
+        surfaces = dict(self.surface.surfaces())
+        self.assertNotIn((0, 0, 0), surfaces)
+        self.assertEquals(surfaces[x, 0, 0].important, 36)
 
 
-    def test_compactFailure(self):
+    def test_unloadTerrain(self):
         """
-        If the vertices at the end of the surface mesh array cannot be
-        associated with a face, an error is logged and the array is not changed.
+        When a chunk of terrain is unloaded, its surface mesh is discarded and
+        the faces of neighboring voxels which touched it are exposed.
         """
-        # Stick some nice vertices in there
-        first = self.surface._makeFace(FRONT, GRASS, 1, 2, 3)
-        self.surface._append((1, 2, 3, FRONT), first)
+        x, y, z = self.terrain.chunkShape
+        self.terrain.set(x - 1, 0, 0, loadTerrainFromString("MG"))
+        self.terrain.unloadChunk((0, 0, 0))
+        self.assertEquals(
+            [origin for (origin, vertices) in self.surface.surfaces()],
+            [(x, 0, 0)])
+        self.assertEquals(len(self.vertices()), 36)
 
-        second = self.surface._makeFace(BACK, GRASS, 3, 2, 1)
-        # Mangle it so it won't be recognized - this is probably a simulation of
-        # a bug somewhere in the terrain module.
-        second[0] = [10, 11, 12, 13, 14]
-        self.surface._append((3, 2, 1, BACK), second)
 
-        self.surface._compact(1, 2, 3, FRONT, 0, 6)
-        self.assertEquals(len(self.flushLoggedErrors()), 1)
-        self.assertArraysEqual(self.mesh.data[:6], first)
-        self.assertArraysEqual(self.mesh.data[6:12], second)
-        self.assertEquals(self.mesh.important, 12)
+    def test_unloadChunk(self):
+        """
+        L{SurfaceMesh.unloadChunk} discards the surface mesh of one chunk,
+        leaving the others alone.
+        """
+        x, y, z = self.terrain.chunkShape
+        self.terrain.set(x - 1, 0, 0, loadTerrainFromString("MG"))
+        self.surface.unloadChunk((0, 0, 0))
+        self.assertEquals(
+            [origin for (origin, vertices) in self.surface.surfaces()],
+            [(x, 0, 0)])
 
 
     def test_oneVoxel(self):
@@ -399,7 +656,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
 
         texture = self.textureBase
         self.assertArraysEqual(
-            self.mesh.data[:self.mesh.important],
+            self.vertices(),
             array([x, y, z, s, t], 'f') + array(
                 list(_top + texture) + list(_front + texture) +
                 list(_bottom + texture) +list(_back + texture) +
@@ -407,7 +664,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
                 'f'))
 
         # Six vertices per face, six faces
-        self.assertEquals(self.mesh.important, 36)
+        self.assertEquals(len(self.vertices()), 36)
 
 
     def test_unchangedVoxel(self):
@@ -419,6 +676,22 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
         self.test_oneVoxel()
 
 
+    def test_changedType(self):
+        """
+        When a voxel changes from one non-empty terrain type to another, the
+        vertices for its faces are replaced with ones using the texture for the
+        new type.
+        """
+        self.test_oneVoxel()
+        self.terrain.set(self.x, self.y, self.z, loadTerrainFromString("G"))
+        self.assertVertices(
+            self.vertices(),
+            [(face, self.surface._makeFace(
+                        face, GRASS, self.x, self.y, self.z))
+             for face in FACES],
+            36)
+
+
     def test_removeSingleVoxel(self):
         """
         When a previously non-empty voxel becomes empty, its vertexes are
@@ -427,7 +700,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
         self.test_oneVoxel()
         self.terrain.set(self.x, self.y, self.z, loadTerrainFromString("_"))
 
-        self.assertEquals(self.mesh.important, 0)
+        self.assertEquals(len(self.vertices()), 0)
 
 
     def test_twoVoxels(self):
@@ -445,7 +718,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
 
         texture = self.textureBase
         self.assertArraysEqual(
-            self.mesh.data[:self.mesh.important],
+            self.vertices(),
             concatenate((
                     # mountain
                     array([x, y, z, ms, mt], 'f') + array(
@@ -458,7 +731,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
                         list(_bottom + texture) + list(_back + texture) +
                         list(_right + texture), 'f'))))
         # Six vertices per face, ten faces
-        self.assertEquals(self.mesh.important, 60)
+        self.assertEquals(len(self.vertices()), 60)
 
 
     def test_removeSecondVoxel(self):
@@ -475,7 +748,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
         s, t = self.texCoords[GRASS]
         offset = array([x + 2, y, z, s, t], 'f') + self.textureBase
         self.assertVertices(
-            self.mesh.data,
+            self.vertices(),
             [(RIGHT, _right + offset),
              (LEFT, _left + offset),
              (BACK, _back + offset),
@@ -493,14 +766,13 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
         x, y, z = 3, 2, 1
         terrain = Terrain()
         terrain.set(x, y, z, loadTerrainFromString("M"))
-        self.surfaceArray = self.mesh
-        SurfaceMesh(
+        surface = SurfaceMesh(
             terrain, self.surfaceFactory, self.texCoords, self.e)
         s, t = self.texCoords[MOUNTAIN]
 
         offset = array([x, y, z, s, t], 'f') + self.textureBase
         self.assertVertices(
-            self.mesh.data,
+            self.vertices(surface),
             [(TOP, _top + offset),
              (FRONT, _front + offset),
              (BOTTOM, _bottom + offset),
@@ -536,6 +808,47 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
                 "    pieces = %r\n" % (notFound, pieces))
 
 
+    def test_makeFaces(self):
+        """
+        L{SurfaceMesh._makeFaces} builds the vertices for several faces at once,
+        exactly as L{SurfaceMesh._makeFace} would build them one at a time.
+        """
+        faces = array([TOP, LEFT, BACK])
+        types = array([GRASS, MOUNTAIN, GRASS])
+        positions = array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        self.assertArraysEqual(
+            self.surface._makeFaces(faces, types, positions),
+            concatenate([
+                    self.surface._makeFace(face, textureType, x, y, z)
+                    for (face, textureType, (x, y, z))
+                    in zip(faces, types, positions)]))
+
+
+    def test_solidPrism(self):
+        """
+        When a solid prism of voxels is set, only the faces on its outside
+        become part of the surface mesh array.
+        """
+        x, y, z = 2, 3, 4
+        self.terrain.set(
+            x, y, z, loadTerrainFromString("MMM\nMMM\n\nMMM\nMMM"))
+
+        expected = []
+        for vx in range(3):
+            for vy in range(2):
+                for vz in range(2):
+                    for face in (TOP, BOTTOM, LEFT, RIGHT, FRONT, BACK):
+                        if self.surface._exposed(x + vx, y + vy, z + vz, face):
+                            expected.append((face, self.surface._makeFace(
+                                        face, MOUNTAIN,
+                                        x + vx, y + vy, z + vz)))
+
+        # The surface area of a 3x2x2 prism.
+        self.assertEquals(len(expected), 2 * (3 * 2 + 3 * 2 + 2 * 2))
+        self.assertVertices(
+            self.vertices(), expected, len(self.vertices()))
+
+
     def test_revealedFace(self):
         """
         When a voxel becomes empty and was adjacent to another voxel, the
@@ -549,7 +862,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
         s, t = self.texCoords[MOUNTAIN]
         offset = array([x + 1, y, z, s, t], 'f') + self.textureBase
         self.assertVertices(
-            self.mesh.data,
+            self.vertices(),
             [(TOP, _top + offset),
              (FRONT, _front + offset),
              (BOTTOM, _bottom + offset),
@@ -574,7 +887,7 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
         goffset = array([x, y, z, gs, gt], 'f') + self.textureBase
         moffset = array([x + 1, y, z, ms, mt], 'f') + self.textureBase
         self.assertVertices(
-            self.mesh.data,
+            self.vertices(),
             [(TOP, _top + goffset),
              (FRONT, _front + goffset),
              (BOTTOM, _bottom + goffset),
@@ -590,6 +903,231 @@ class SurfaceMeshTests(TestCase, ArrayMixin):
 
 
 
+class PackedSurfaceMeshTests(TestCase, ArrayMixin):
+    """
+    Tests for L{terrain.SurfaceMesh} when it is using the packed vertex layout.
+    """
+    def setUp(self):
+        self.e = 0.125
+        self.texCoords = {
+            MOUNTAIN: (0.5, 0.75),
+            GRASS: (0.25, 0.5),
+            }
+        self.terrain = Terrain()
+        self.packed = self.createMesh(packed=True)
+        self.unpacked = self.createMesh(packed=False)
+
+
+    def createMesh(self, **kw):
+        """
+        Create a L{SurfaceMesh} observing C{self.terrain}.
+        """
+        def surfaceFactory(size):
+            if kw['packed']:
+                vertices = zeros((size, 6), 'h')
+            else:
+                vertices = zeros((size, 5), 'f')
+            return SurfaceMeshVertices(vertices, vertices, 0)
+        surface = SurfaceMesh(
+            self.terrain, surfaceFactory, self.texCoords, self.e, **kw)
+        self.terrain.addObserver(surface.changed)
+        return surface
+
+
+    def triangles(self, surface):
+        """
+        Return every triangle of C{surface} as a sorted C{list} of C{list}s of
+        three vertices, with packed vertices converted back to world
+        coordinates and floating point texture coordinates.
+        """
+        result = []
+        for origin, vertices in surface.surfaces():
+            data = vertices.data[:vertices.important]
+            if surface._packed:
+                data = data[quadIndices(len(data) // 4)]
+                unpacked = zeros((len(data), 5), 'f')
+                unpacked[:, :3] = data[:, :3] + origin
+                unpacked[:, 3:] = data[:, 4:] / float(PACKED_TEXTURE_SCALE)
+                data = unpacked
+            result.extend(data.round(3).reshape((-1, 3, 5)).tolist())
+        return sorted(result)
+
+
+    def test_quadIndices(self):
+        """
+        L{quadIndices} gives the indexes of two triangles for each face, using
+        four vertices per face.
+        """
+        self.assertArraysEqual(
+            quadIndices(2), array([0, 1, 2, 0, 3, 2, 4, 5, 6, 4, 7, 6], 'H'))
+
+
+    def test_oneVoxel(self):
+        """
+        A packed face is four vertices of shorts, positioned relative to the
+        minimum corner of their chunk, with texture coordinates scaled by
+        L{PACKED_TEXTURE_SCALE}.
+        """
+        self.terrain.set(9, 3, 1, loadTerrainFromString("M"))
+        [(origin, vertices)] = self.packed.surfaces()
+        self.assertEquals(origin, (8, 2, 0))
+        self.assertEquals(vertices.important, 6 * 4)
+        self.assertEquals(vertices.data.dtype, dtype('h'))
+        s, t = self.texCoords[MOUNTAIN]
+        self.assertArraysEqual(
+            vertices.data[:4],
+            (array([
+                    [2, 2, 1, 0, s + self.e, t],
+                    [1, 2, 1, 0, s, t],
+                    [1, 2, 2, 0, s, t + self.e],
+                    [2, 2, 2, 0, s + self.e, t + self.e]])
+            * array([1, 1, 1, 1, PACKED_TEXTURE_SCALE, PACKED_TEXTURE_SCALE])
+            ).round().astype('h'))
+
+
+    def test_sameTriangles(self):
+        """
+        Drawn with L{quadIndices}, packed vertices make the same triangles as
+        unpacked ones, even as faces are added and removed.
+        """
+        self.terrain.set(
+            6, 0, 6, loadTerrainFromString("MGM\nGMG\n\nG_G\nMMM"))
+        self.terrain.set(7, 1, 7, loadTerrainFromString("_"))
+        self.terrain.set(6, 0, 7, loadTerrainFromString("_"))
+        self.assertEquals(
+            self.triangles(self.packed), self.triangles(self.unpacked))
+
+
+
+class GreedyRectanglesTests(TestCase):
+    """
+    Tests for L{_greedyRectangles}.
+    """
+    def test_rectangles(self):
+        """
+        L{_greedyRectangles} covers runs of equal non-zero values with as large
+        a rectangle as it can, growing first along rows and then down columns.
+        """
+        labels = array([
+                [1, 1, 0, 2],
+                [1, 1, 0, 2],
+                [1, 3, 3, 2]])
+        self.assertEquals(
+            _greedyRectangles(labels),
+            [(0, 0, 2, 2, 1), (0, 3, 3, 1, 2), (2, 0, 1, 1, 1),
+             (2, 1, 1, 2, 3)])
+
+
+    def test_empty(self):
+        """
+        L{_greedyRectangles} returns no rectangles for an array of zeros.
+        """
+        self.assertEquals(_greedyRectangles(zeros((3, 2), 'b')), [])
+
+
+
+class GreedySurfaceMeshTests(TestCase, ArrayMixin):
+    """
+    Tests for L{terrain.SurfaceMesh} when it is merging faces into larger
+    quads.
+    """
+    def setUp(self):
+        self.e = 0.125
+        self.texCoords = {
+            MOUNTAIN: (0.5, 0.75),
+            GRASS: (0.25, 0.5),
+            }
+        self.terrain = Terrain()
+        self.surface = self.createMesh()
+        self.terrain.addObserver(self.surface.changed)
+
+
+    def createMesh(self):
+        """
+        Create a greedy L{SurfaceMesh} for C{self.terrain}.
+        """
+        def surfaceFactory(size):
+            vertices = zeros((size, 5), 'f')
+            return SurfaceMeshVertices(vertices, vertices, 0)
+        return SurfaceMesh(
+            self.terrain, surfaceFactory, self.texCoords, self.e, greedy=True)
+
+
+    def quads(self, surface):
+        """
+        Return the vertices of every chunk of C{surface} as a sorted C{list} of
+        quads, each a C{list} of six vertices.
+        """
+        result = []
+        for origin, vertices in surface.surfaces():
+            result.extend(
+                vertices.data[:vertices.important].reshape((-1, 6, 5)).tolist())
+        return sorted(result)
+
+
+    def test_plane(self):
+        """
+        A plane of a single terrain type filling a chunk is covered by one quad
+        per side, with the terrain texture stretched over each.
+        """
+        x, y, z = self.terrain.chunkShape
+        self.terrain.set(
+            0, 0, 0, loadTerrainFromString("\n".join(["G" * x] * z)))
+
+        self.assertEquals(len(self.quads(self.surface)), 6)
+        s, t = self.texCoords[GRASS]
+        texture = array([
+                [0, 0, 0, self.e, 0],
+                [0, 0, 0, 0, 0],
+                [0, 0, 0, 0, self.e],
+                [0, 0, 0, self.e, 0],
+                [0, 0, 0, self.e, self.e],
+                [0, 0, 0, 0, self.e]], 'f')
+        top = _top * array([x, 1, z, 1, 1], 'f') + texture + array(
+            [0, 0, 0, s, t], 'f')
+        self.assertIn(top.tolist(), self.quads(self.surface))
+
+
+    def test_differentTypes(self):
+        """
+        Faces of different terrain types are not merged.
+        """
+        self.terrain.set(0, 0, 0, loadTerrainFromString("GM"))
+        # Everything but the touching faces.
+        self.assertEquals(len(self.quads(self.surface)), 10)
+
+
+    def test_incremental(self):
+        """
+        When terrain changes, the quads for the chunks it touches are rebuilt,
+        leaving the mesh just as it would be if it were built from scratch.
+        """
+        x, y, z = self.terrain.chunkShape
+        plane = "\n".join(["G" * (x * 2)] * z)
+        self.terrain.set(0, 0, 0, loadTerrainFromString(plane))
+        self.terrain.set(x, 0, 1, loadTerrainFromString("_"))
+        self.terrain.set(x - 1, 0, 1, loadTerrainFromString("M"))
+
+        self.assertEquals(
+            self.quads(self.surface), self.quads(self.createMesh()))
+
+
+    def test_faceNeighbors(self):
+        """
+        A change at the corner of a chunk rebuilds that chunk and the chunks
+        sharing a face with the changed voxels, but not the chunks which only
+        share an edge or a corner with them.
+        """
+        remeshed = []
+        self.surface._remeshChunk = remeshed.append
+        x, y, z = self.terrain.chunkShape
+        self.terrain.set(x - 1, y - 1, z - 1, loadTerrainFromString("G"))
+        self.assertEquals(
+            sorted(remeshed),
+            [(0, 0, 0), (0, 0, z), (0, y, 0), (x, 0, 0)])
+
+
+
 class LoadTerrainFromSurfaceTests(TestCase):
     """
     Tests for L{loadTerrainFromSurface}.
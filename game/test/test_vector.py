@@ -1,6 +1,9 @@
+import numpy
+
 from twisted.trial.unittest import TestCase
 
-from game.vector import Vector
+from game.vector import Vector, VectorArray
+from game.test.util import ArrayMixin
 
 class VectorTests(TestCase):
     """
@@ -66,6 +69,56 @@ class VectorTests(TestCase):
         self.assertFalse(v1 == v3)
 
 
+    def test_inequality(self):
+        """
+        Two L{Vector} instances with different components are not equal to
+        each other, and a L{Vector} is not equal to anything else.
+        """
+        self.assertTrue(Vector(1, 2, 3) != Vector(1, 2, 4))
+        self.assertFalse(Vector(1, 2, 3) != Vector(1, 2, 3))
+        self.assertTrue(Vector(1, 2, 3) != (1, 2, 3))
+        self.assertFalse(Vector(1, 2, 3) == (1, 2, 3))
+
+
+    def test_unhashable(self):
+        """
+        L{Vector} instances can be changed in place, so they cannot be hashed
+        and used as dictionary keys.
+        """
+        self.assertRaises(TypeError, hash, Vector(1, 2, 3))
+        self.assertRaises(TypeError, set, [Vector(1, 2, 3)])
+
+
+    def test_slots(self):
+        """
+        L{Vector} instances have no attributes besides their components.
+        """
+        self.assertRaises(AttributeError, setattr, Vector(1, 2, 3), 'w', 4)
+
+
+    def test_inPlaceAddition(self):
+        """
+        Adding a L{Vector} to another in place changes the components of the
+        first one.
+        """
+        v1 = Vector(1, 2, 3)
+        original = v1
+        v1 += Vector(2, -1, 5)
+        self.assertIdentical(v1, original)
+        self.assertEquals(v1, Vector(3, 1, 8))
+
+
+    def test_inPlaceMultiplication(self):
+        """
+        Multiplying a L{Vector} by a number in place changes its components.
+        """
+        v = Vector(1, 2, 3)
+        original = v
+        v *= 2.5
+        self.assertIdentical(v, original)
+        self.assertEquals(v, Vector(2.5, 5, 7.5))
+
+
     def test_unit(self):
         """
         L{Vector.unit} returns a L{Vector} in the same direction as the
@@ -75,3 +128,95 @@ class VectorTests(TestCase):
         u = v.unit()
         scale = (1 ** 2 + 2 ** 2 + 3 ** 2) ** 0.5
         self.assertEquals(u, Vector(1 / scale, 2 / scale, 3 / scale))
+
+
+
+class VectorArrayTests(TestCase, ArrayMixin):
+    """
+    Tests for L{VectorArray}.
+    """
+    def setUp(self):
+        self.vectors = VectorArray([[1, 2, 3], [0, -3, 4]])
+
+
+    def test_array(self):
+        """
+        L{VectorArray.array} is a C{float} array of the given coordinates, which
+        is not copied if it is already one.
+        """
+        self.assertArraysEqual(
+            self.vectors.array, numpy.array([[1, 2, 3], [0, -3, 4]], float))
+        array = numpy.zeros((2, 3))
+        self.assertIdentical(VectorArray(array).array, array)
+
+
+    def test_shape(self):
+        """
+        L{VectorArray} raises L{ValueError} when given coordinates which are
+        not of three components each.
+        """
+        self.assertRaises(ValueError, VectorArray, [1, 2, 3])
+        self.assertRaises(ValueError, VectorArray, [[1, 2]])
+
+
+    def test_fromVectors(self):
+        """
+        L{VectorArray.fromVectors} makes a L{VectorArray} of the components of
+        some L{Vector}s, which it gives back as L{Vector}s.
+        """
+        vectors = [Vector(1, 2, 3), Vector(0, -3, 4)]
+        array = VectorArray.fromVectors(vectors)
+        self.assertArraysEqual(array.array, self.vectors.array)
+        self.assertEquals(len(array), 2)
+        self.assertEquals(array[1], vectors[1])
+        self.assertEquals(list(array), vectors)
+
+
+    def test_addition(self):
+        """
+        Adding a L{Vector} to a L{VectorArray} adds it to each coordinate, and
+        adding two L{VectorArray}s adds their coordinates pairwise.
+        """
+        self.assertEquals(
+            list(self.vectors + Vector(1, 1, 1)),
+            [Vector(2, 3, 4), Vector(1, -2, 5)])
+        self.assertEquals(
+            list(self.vectors + self.vectors),
+            [Vector(2, 4, 6), Vector(0, -6, 8)])
+
+
+    def test_multiplication(self):
+        """
+        Multiplying a L{VectorArray} by a number scales each coordinate by it,
+        and multiplying by a sequence scales each by the corresponding number.
+        """
+        self.assertEquals(
+            list(self.vectors * 2), [Vector(2, 4, 6), Vector(0, -6, 8)])
+        self.assertEquals(
+            list(self.vectors * [2, -1]), [Vector(2, 4, 6), Vector(0, 3, -4)])
+
+
+    def test_inPlace(self):
+        """
+        In place addition and multiplication change the array of the
+        L{VectorArray}.
+        """
+        array = self.vectors.array
+        self.vectors += Vector(1, 1, 1)
+        self.vectors *= [1, 2]
+        self.assertIdentical(self.vectors.array, array)
+        self.assertEquals(
+            list(self.vectors), [Vector(2, 3, 4), Vector(2, -4, 10)])
+
+
+    def test_unit(self):
+        """
+        L{VectorArray.lengths} gives the magnitude of each coordinate, and
+        L{VectorArray.unit} the unit vectors in their directions.
+        """
+        scale = 14 ** 0.5
+        self.assertEquals(list(self.vectors.lengths()), [scale, 5])
+        self.assertEquals(
+            list(self.vectors.unit()),
+            [Vector(1, 2, 3).unit(), Vector(0, -3, 4).unit()])
+
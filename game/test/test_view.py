@@ -4,6 +4,10 @@ Unit tests for the basic functionality of view objects.
 More thorough tests are in L{game.functional}.
 """
 
+from math import radians, tan
+
+from numpy import array, dtype, identity, zeros
+
 from twisted.trial.unittest import TestCase
 
 from twisted.internet.task import Clock
@@ -13,14 +17,17 @@ import pygame
 from pygame.event import Event
 
 from game import __file__ as gameFile
-from game.terrain import GRASS, MOUNTAIN, DESERT, WATER, loadTerrainFromString
+from game.terrain import (
+    UNKNOWN, GRASS, MOUNTAIN, DESERT, WATER, SurfaceMeshVertices,
+    loadTerrainFromString)
 from game.view import (
-    Color, Scene, loadImage, quantize,
+    Color, Scene, loadImage, quantize, frustumPlanes, visibleBoxes,
     Viewport, Window, TerrainView, PlayerView)
-from game.test.util import MockSurface
+from game.test.util import MockSurface, requestedTerrain
 from game.controller import K_LEFT
 from game.environment import Environment
-from game.network import GetTerrain
+from game.direction import FORWARD
+from game.network import GetTerrain, TerrainRequests
 from game.player import Player
 from game.vector import Vector
 
@@ -113,6 +120,79 @@ class QuantizeTests(TestCase):
 
 
 
+def perspective(fovy, aspect, near, far):
+    """
+    Compute the same matrix as C{gluPerspective}, in the column-major order
+    OpenGL uses.
+    """
+    f = 1 / tan(radians(fovy) / 2)
+    return array([
+            [f / aspect, 0, 0, 0],
+            [0, f, 0, 0],
+            [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+            [0, 0, -1, 0]]).T
+
+
+
+class FrustumTests(TestCase):
+    """
+    Tests for L{frustumPlanes} and L{visibleBoxes}.
+    """
+    def setUp(self):
+        self.projection = perspective(45.0, 1.0, 0.5, 1000.0)
+
+
+    def visible(self, modelview, *boxes):
+        planes = frustumPlanes(self.projection, modelview)
+        low = array([box[0] for box in boxes])
+        high = array([box[1] for box in boxes])
+        return list(visibleBoxes(planes, low, high))
+
+
+    def test_inFront(self):
+        """
+        A box in front of the camera is visible, as is one which only partly
+        overlaps the view.
+        """
+        self.assertEquals(
+            self.visible(
+                identity(4),
+                ((-1, -1, -10), (1, 1, -8)),
+                ((3, 3, -10), (20, 20, -8))),
+            [True, True])
+
+
+    def test_outside(self):
+        """
+        Boxes behind, beside, above, or beyond the far plane of the camera are
+        not visible.
+        """
+        self.assertEquals(
+            self.visible(
+                identity(4),
+                ((-1, -1, 5), (1, 1, 7)),
+                ((-100, -1, -10), (-98, 1, -8)),
+                ((-1, 50, -10), (1, 52, -8)),
+                ((-1, -1, -1100), (1, 1, -1050))),
+            [False, False, False, False])
+
+
+    def test_modelview(self):
+        """
+        The modelview matrix moves the visible volume around.
+        """
+        # Like glTranslate(0, 0, -20), in column-major order.
+        modelview = identity(4)
+        modelview[3, 2] = -20
+        self.assertEquals(
+            self.visible(
+                modelview,
+                ((-1, -1, 5), (1, 1, 7)),
+                ((-1, -1, 25), (1, 1, 27))),
+            [True, False])
+
+
+
 class ViewportTests(TestCase):
     """
     Tests for L{Viewport}.
@@ -356,6 +436,7 @@ class CheckTerrainTests(TestCase):
         quantized chunks adjacent to the player's position if the terrain in
         those chunks is marked as L{UNKNOWN}.
         """
+        self.patch(TerrainRequests, 'limit', 3 ** 3)
         self.window.CHUNK_GRANULARITY = Vector(2, 1, 3)
         self.window.CHUNK_OFFSET = Vector(1, 1, 1)
         pos = Vector(3, 4, 5)
@@ -368,9 +449,56 @@ class CheckTerrainTests(TestCase):
                  for x in (0, 2, 4)
                  for y in (3, 4, 5)
                  for z in (0, 3, 6)]),
-            set([(c['x'], c['y'], c['z']) for (cmd, c) in self.calls]))
+            set(requestedTerrain(self.calls)))
+
+        self.assertEquals(len(requestedTerrain(self.calls)), 3 ** 3)
 
-        self.assertEquals(len(self.calls), 3 ** 3)
+
+    def firstRequests(self, player, count):
+        """
+        Let L{Window._checkTerrain} send only C{count} requests for the chunks
+        around C{player} and return their coordinates.
+        """
+        self.patch(TerrainRequests, 'limit', count)
+        self.window.CHUNK_GRANULARITY = Vector(8, 2, 8)
+        self.window.CHUNK_OFFSET = Vector(1, 0, 1)
+        self.window._checkTerrain(player)
+        return requestedTerrain(self.calls)
+
+
+    def test_requestNearestFirst(self):
+        """
+        L{Window._checkTerrain} requests the chunk the player is in before any
+        of the chunks around it, and holds the rest back until earlier requests
+        are answered.
+        """
+        player = Player(Vector(12, 1, 12), None, self.clock.seconds)
+        self.assertEquals(self.firstRequests(player, 1), [(8, 0, 8)])
+        self.environment.terrain.set(8, 0, 8, loadTerrainFromString("G"))
+        self.assertEquals(len(self.calls), 2)
+
+
+    def test_requestFacingFirst(self):
+        """
+        Of the chunks around the player, L{Window._checkTerrain} requests the
+        one the player is facing first.
+        """
+        player = Player(Vector(12, 1, 12), None, self.clock.seconds)
+        player.turn(0, 90)
+        self.assertEquals(
+            self.firstRequests(player, 2), [(8, 0, 8), (16, 0, 8)])
+
+
+    def test_requestAheadFirst(self):
+        """
+        L{Window._checkTerrain} requests the chunks a moving player is heading
+        into before the one it is in, including chunks beyond
+        L{Window.CHUNK_OFFSET} of its current position.
+        """
+        player = Player(Vector(12, 1, 20), 4, self.clock.seconds)
+        player.setDirection(FORWARD)
+        self.assertEquals(
+            self.firstRequests(player, 2), [(8, 0, 0), (8, 0, 8)])
 
 
 
@@ -399,6 +527,89 @@ class CheckTerrainTests(TestCase):
         self.assertEquals(self.calls, [])
 
 
+    def test_outstandingRequests(self):
+        """
+        L{Window._checkTerrain} does not request terrain again while a request
+        for it is outstanding.
+        """
+        player = Player(Vector(1, 2, 3), None, self.clock.seconds)
+        self.window._checkTerrain(player)
+        self.window._checkTerrain(player)
+        self.assertEquals(len(self.calls), 1)
+        self.assertEquals(self.window.terrainRequests.duplicates, 1)
+
+
+    def test_unloadDistantTerrain(self):
+        """
+        L{Window._checkTerrain} forgets about terrain chunks which are further
+        than L{Window.RESIDENCY_RADIUS} from the player.
+        """
+        terrain = self.environment.terrain
+        x, y, z = terrain.chunkShape
+        self.window.RESIDENCY_RADIUS = x * 2
+        terrain.set(0, 0, 0, loadTerrainFromString("G"))
+        terrain.set(x * 4, 0, 0, loadTerrainFromString("G"))
+        player = Player(Vector(1, 0, 1), None, self.clock.seconds)
+
+        self.window._checkTerrain(player)
+
+        self.assertEquals(terrain.loadedChunks(), [(0, 0, 0)])
+        self.assertEquals(terrain.voxelAt(x * 4, 0, 0), UNKNOWN)
+
+
+    def test_unloadFurthest(self):
+        """
+        L{Window._checkTerrain} forgets at most L{Window.MAX_UNLOADS} chunks at
+        a time, beginning with the ones furthest from the player.
+        """
+        terrain = self.environment.terrain
+        x, y, z = terrain.chunkShape
+        self.window.RESIDENCY_RADIUS = x * 2
+        self.window.MAX_UNLOADS = 1
+        for cx in (4, 8, 0):
+            terrain.set(cx * x, 0, 0, loadTerrainFromString("G"))
+
+        player = Player(Vector(1, 0, 1), None, self.clock.seconds)
+        self.window._checkTerrain(player)
+        self.assertEquals(
+            sorted(terrain.loadedChunks()), [(0, 0, 0), (x * 4, 0, 0)])
+        self.window._checkTerrain(player)
+        self.assertEquals(terrain.loadedChunks(), [(0, 0, 0)])
+
+
+    def test_unloadIgnoresHeight(self):
+        """
+        L{Window._checkTerrain} measures the distance to terrain chunks across
+        the ground, so chunks far above or below the player are kept.
+        """
+        terrain = self.environment.terrain
+        x, y, z = terrain.chunkShape
+        self.window.RESIDENCY_RADIUS = x * 2
+        terrain.set(0, y * 100, 0, loadTerrainFromString("G"))
+        self.window._checkTerrain(
+            Player(Vector(1, 0, 1), None, self.clock.seconds))
+        self.assertEquals(terrain.loadedChunks(), [(0, y * 100, 0)])
+
+
+    def test_rerequestUnloadedTerrain(self):
+        """
+        When the player returns to terrain which has been forgotten, it is
+        requested from the server again.
+        """
+        terrain = self.environment.terrain
+        x, y, z = terrain.chunkShape
+        self.window.RESIDENCY_RADIUS = x * 2
+        terrain.set(0, 0, 0, loadTerrainFromString("G"))
+        self.window._checkTerrain(
+            Player(Vector(x * 4, 0, 1), None, self.clock.seconds))
+        del self.calls[:]
+
+        self.window._checkTerrain(
+            Player(Vector(1, 0, 1), None, self.clock.seconds))
+        self.assertEquals(
+            self.calls, [(GetTerrain, {'x': 0, 'y': 0, 'z': 0})])
+
+
 
 class MockEventSource(object):
     """
@@ -515,6 +726,64 @@ class TerrainViewTests(TestCase):
         self._imageForTerrainTest(WATER, "water.png")
 
 
+    def test_surfaceFactory(self):
+        """
+        L{TerrainView._surfaceFactory} creates an empty L{SurfaceMeshVertices}
+        with room for the requested number of vertices.
+        """
+        view = TerrainView(None, loadImage)
+        surface = view._surfaceFactory(12)
+        self.assertEquals(surface.data.shape, (12, 6))
+        self.assertEquals(surface.data.dtype, dtype('h'))
+        self.assertEquals(surface.important, 0)
+
+
+    def test_packed(self):
+        """
+        L{TerrainView} uses the packed vertex layout for its L{SurfaceMesh}.
+        """
+        view = TerrainView(Environment(1, Clock()), loadImage)
+        self.assertTrue(view._surface._packed)
+
+
+    def test_greedy(self):
+        """
+        L{TerrainView} passes its C{greedy} flag on to the L{SurfaceMesh} it
+        creates.
+        """
+        environment = Environment(1, Clock())
+        self.assertFalse(
+            TerrainView(environment, loadImage)._surface._greedy)
+        self.assertTrue(
+            TerrainView(environment, loadImage, greedy=True)._surface._greedy)
+
+
+    def test_releaseBuffers(self):
+        """
+        L{TerrainView._releaseBuffers} deletes the buffer of each surface which
+        was passed to it last time but not this time, as happens when a chunk
+        is unloaded or its storage grows.
+        """
+        deleted = []
+        class Buffer(object):
+            def delete(self):
+                deleted.append(self)
+
+        view = TerrainView(None, loadImage)
+        first, second, grown = Buffer(), Buffer(), Buffer()
+        data = zeros((4, 6), 'h')
+        view._releaseBuffers([
+                ((0, 0, 0), SurfaceMeshVertices(first, data, 0)),
+                ((16, 0, 0), SurfaceMeshVertices(second, data, 0))])
+        self.assertEquals(deleted, [])
+
+        view._releaseBuffers([((0, 0, 0), SurfaceMeshVertices(grown, data, 0))])
+        self.assertEquals(set(deleted), set([first, second]))
+
+        view._releaseBuffers([((0, 0, 0), SurfaceMeshVertices(grown, data, 0))])
+        self.assertEquals(len(deleted), 2)
+
+
 
 class ColorTests(TestCase):
     """
@@ -5,6 +5,7 @@ Assorted utility code for tests.
 """
 
 from game.player import Player
+from game.network import GetTerrain, GetTerrainChunks
 
 
 class ArrayMixin:
@@ -86,3 +87,19 @@ class MockSurface(object):
     def __init__(self, label, size, depth=None):
         self.label = label
         self.size = size
+
+
+
+def requestedTerrain(calls):
+    """
+    Return the coordinates of the chunks requested by the L{GetTerrain} and
+    L{GetTerrainChunks} commands in C{calls}, a C{list} of two-tuples of a
+    command and a C{dict} of its arguments, in the order they were requested.
+    """
+    positions = []
+    for (command, kw) in calls:
+        if command is GetTerrain:
+            positions.append((kw['x'], kw['y'], kw['z']))
+        elif command is GetTerrainChunks:
+            positions.extend(kw['positions'])
+    return positions
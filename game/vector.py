@@ -1,10 +1,14 @@
-from twisted.python.util import FancyEqMixin, FancyStrMixin
+import numpy
 
-class Vector(FancyEqMixin, FancyStrMixin):
+
+class Vector(object):
     """
     A coordinate in three dimensional space.
+
+    Vectors compare by the values of their components.  Since they can be
+    changed in place, they cannot be hashed.
     """
-    showAttributes = compareAttributes = ['x', 'y', 'z']
+    __slots__ = ('x', 'y', 'z')
 
     def __init__(self, x, y, z):
         self.x = float(x)
@@ -12,6 +16,26 @@ class Vector(FancyEqMixin, FancyStrMixin):
         self.z = float(z)
 
 
+    def __repr__(self):
+        return '<%s x=%r y=%r z=%r>' % (
+            self.__class__.__name__, self.x, self.y, self.z)
+
+
+    def __eq__(self, other):
+        if not isinstance(other, Vector):
+            return NotImplemented
+        return self.x == other.x and self.y == other.y and self.z == other.z
+
+
+    def __ne__(self, other):
+        if not isinstance(other, Vector):
+            return NotImplemented
+        return self.x != other.x or self.y != other.y or self.z != other.z
+
+
+    __hash__ = None
+
+
     def __add__(self, other):
         return Vector(
             self.x + other.x,
@@ -19,6 +43,16 @@ class Vector(FancyEqMixin, FancyStrMixin):
             self.z + other.z)
 
 
+    def __iadd__(self, other):
+        """
+        Add the components of C{other} to those of this vector.
+        """
+        self.x += other.x
+        self.y += other.y
+        self.z += other.z
+        return self
+
+
     def __mul__(self, other):
         """
         Implement multiplication by a scalar in the conventional manner.
@@ -32,9 +66,147 @@ class Vector(FancyEqMixin, FancyStrMixin):
             self.z * other)
 
 
+    def __imul__(self, other):
+        """
+        Multiply the components of this vector by the scalar C{other}.
+        """
+        self.x *= other
+        self.y *= other
+        self.z *= other
+        return self
+
+
     def unit(self):
         """
         Return a unit vector in the same direction as this vector.
         """
         length = (self.x ** 2 + self.y ** 2 + self.z ** 2) ** 0.5
         return self * (1.0 / length)
+
+
+
+class VectorArray(object):
+    """
+    A sequence of coordinates in three dimensional space, kept in one numpy
+    array so that arithmetic on all of them is done in a single step.
+
+    @ivar array: A C{float} array of shape C{(n, 3)}, with one row for each
+        coordinate.
+    """
+    __slots__ = ('array',)
+
+    def __init__(self, array):
+        """
+        @param array: Anything of shape C{(n, 3)} which can be made into a
+            C{float} array.  An array which already is one is not copied, so
+            changes to the L{VectorArray} are made to it.
+
+        @raise ValueError: If C{array} is not of that shape.
+        """
+        array = numpy.asarray(array, float)
+        if array.ndim != 2 or array.shape[1] != 3:
+            raise ValueError("Expected shape (n, 3), got %r" % (array.shape,))
+        self.array = array
+
+
+    @classmethod
+    def fromVectors(cls, vectors):
+        """
+        Make a L{VectorArray} holding the components of a sequence of
+        L{Vector}s.
+        """
+        array = numpy.empty((len(vectors), 3))
+        for i, v in enumerate(vectors):
+            array[i] = (v.x, v.y, v.z)
+        return cls(array)
+
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.array.tolist())
+
+
+    def __len__(self):
+        return len(self.array)
+
+
+    def __getitem__(self, index):
+        """
+        Return the coordinate at C{index} as a L{Vector}.
+        """
+        return Vector(*self.array[index])
+
+
+    def __iter__(self):
+        for (x, y, z) in self.array:
+            yield Vector(x, y, z)
+
+
+    def _operand(self, other):
+        """
+        Return C{other} as something which can be added to C{array}: the
+        array of a L{VectorArray} or the components of a L{Vector}.
+        """
+        if isinstance(other, Vector):
+            return (other.x, other.y, other.z)
+        return other.array
+
+
+    def _scalars(self, other):
+        """
+        Return C{other} as something C{array} can be multiplied by: a number,
+        or a column of one number for each coordinate.
+        """
+        if numpy.ndim(other):
+            return numpy.asarray(other, float)[:, None]
+        return other
+
+
+    def __add__(self, other):
+        """
+        Add a L{Vector} to each coordinate, or the coordinates of another
+        L{VectorArray} of the same length pairwise.
+
+        @rtype: L{VectorArray}
+        """
+        return VectorArray(self.array + self._operand(other))
+
+
+    def __iadd__(self, other):
+        """
+        Like L{__add__}, but change this L{VectorArray}.
+        """
+        self.array += self._operand(other)
+        return self
+
+
+    def __mul__(self, other):
+        """
+        Multiply each coordinate by a scalar, or by the corresponding element
+        of a sequence of them.
+
+        @rtype: L{VectorArray}
+        """
+        return VectorArray(self.array * self._scalars(other))
+
+
+    def __imul__(self, other):
+        """
+        Like L{__mul__}, but change this L{VectorArray}.
+        """
+        self.array *= self._scalars(other)
+        return self
+
+
+    def lengths(self):
+        """
+        Return an array of the magnitude of each coordinate.
+        """
+        return numpy.sqrt((self.array ** 2).sum(axis=1))
+
+
+    def unit(self):
+        """
+        Return a L{VectorArray} of unit vectors in the same directions as
+        these.
+        """
+        return self * (1.0 / self.lengths())
@@ -6,7 +6,9 @@ View code!
 
 from __future__ import division
 
-from numpy import zeros
+from math import cos, pi, sin, sqrt
+
+from numpy import array, dot, where, zeros
 
 from OpenGL.GL import (
     GL_PROJECTION, GL_MODELVIEW, GL_RGBA, GL_UNSIGNED_BYTE,
@@ -20,8 +22,10 @@ from OpenGL.GL import (
     glLoadIdentity, glPushMatrix, glPopMatrix,
     glEnable, glClear, glColor, glLight,
     glTranslate, glRotate, glBegin, glEnd, glVertex3f,
-    glEnableClientState, glDisableClientState, glVertexPointer, glDrawArrays,
-    GL_FLOAT, GL_VERTEX_ARRAY, glTexCoordPointer)
+    glEnableClientState, glDisableClientState, glVertexPointer,
+    GL_VERTEX_ARRAY, glTexCoordPointer, GL_ARRAY_BUFFER, glBufferSubData,
+    GL_SHORT, GL_UNSIGNED_SHORT, GL_TEXTURE, glScale, glDrawElements,
+    GL_PROJECTION_MATRIX, GL_MODELVIEW_MATRIX, glGetFloatv)
 from OpenGL.GLU import (
     gluPerspective, gluNewQuadric, gluSphere)
 from OpenGL.arrays.vbo import VBO
@@ -38,8 +42,8 @@ from game import __file__ as gameFile
 from game.vector import Vector
 from game.terrain import (
     UNKNOWN, GRASS, MOUNTAIN, DESERT, WATER, CHUNK_GRANULARITY,
-    SurfaceMesh, SurfaceMeshVertices)
-from game.network import GetTerrain
+    PACKED_TEXTURE_SCALE, SurfaceMesh, SurfaceMeshVertices, quadIndices)
+from game.network import TerrainRequests
 
 
 def loadImage(path):
@@ -74,6 +78,52 @@ def quantize(quantization, value):
 
 
 
+def frustumPlanes(projection, modelview):
+    """
+    Find the planes bounding the volume which is visible through a camera.
+
+    @param projection: The projection matrix, as a 4x4 array in the
+        column-major order OpenGL uses (for example, as returned by
+        C{glGetFloatv(GL_PROJECTION_MATRIX)}).
+
+    @param modelview: The modelview matrix, in the same form.
+
+    @return: An array of shape C{(6, 4)}.  Each row C{(a, b, c, d)} is a plane
+        in model coordinates; a point C{(x, y, z)} can only be visible if
+        C{a * x + b * y + c * z + d >= 0} for every plane.
+    """
+    clip = dot(modelview, projection).T
+    return array([
+            clip[3] + clip[0], clip[3] - clip[0],
+            clip[3] + clip[1], clip[3] - clip[1],
+            clip[3] + clip[2], clip[3] - clip[2]])
+
+
+
+def visibleBoxes(planes, low, high):
+    """
+    Determine which of some axis-aligned boxes might be visible.
+
+    @param planes: The planes bounding the visible volume, as returned by
+        L{frustumPlanes}.
+
+    @param low: An array of shape C{(N, 3)} giving the minimum corner of each
+        box.
+
+    @param high: An array of the same shape giving the maximum corner of each
+        box.
+
+    @return: An array of N C{bool}s, C{False} for each box which lies entirely
+        outside the visible volume.  A box near a corner of the volume may be
+        reported as visible even though it is not.
+    """
+    normals = planes[:, :3]
+    # The corner of each box which is furthest along the normal of each plane.
+    corners = where(normals >= 0, high[:, None, :], low[:, None, :])
+    return ((corners * normals).sum(axis=2) + planes[:, 3] >= 0).all(axis=1)
+
+
+
 class Sphere(record("center radius color")):
     """
     A renderer for a sphere.
@@ -296,12 +346,16 @@ class Window(object):
     @ivar _terrainCheck: A L{LoopingCall} to check check for missing terrain and
         request it from the server.
 
+    @ivar terrainRequests: C{None} until terrain is first requested, then the
+        L{TerrainRequests} keeping track of outstanding requests.
+
     @ivar _playerViews: A mapping from known L{Player} instances to
         corresponding L{PlayerView} instances which have been added to the
         scene.
     """
     screen = None
     _terrainCheck = None
+    terrainRequests = None
 
     CHUNK_GRANULARITY = CHUNK_GRANULARITY
 
@@ -370,22 +424,60 @@ class Window(object):
     # position for more missing terrain to request.
     CHUNK_OFFSET = Vector(2, 0, 2)
 
+    # The distance from the player beyond which terrain chunks are forgotten,
+    # and the largest number of chunks to forget at each check.  The radius
+    # must leave room for all of the chunks within CHUNK_OFFSET, or they will be
+    # forgotten as soon as they arrive.
+    RESIDENCY_RADIUS = 64
+    MAX_UNLOADS = 32
+
+    # How many seconds ahead of a moving player to look for missing terrain,
+    # and how much closer (in voxels) a chunk in the direction the player is
+    # facing is treated as being than one behind it.
+    LOOKAHEAD = 2 * TERRAIN_CHECK_INTERVAL
+    FACING_BIAS = 4
+
     def _checkTerrain(self, player):
         """
         Examine the player's position and the currently known terrain data and
-        sometimes request more terrain data from the server.
+        sometimes request more terrain data from the server.  Missing chunks
+        are requested nearest first, measured from where the player will be
+        C{LOOKAHEAD} seconds from now and favoring the way it is facing.
         """
         terrain = self.environment.terrain
         network = self.environment.network
         if network is None:
             return
 
+        if self.terrainRequests is None:
+            self.terrainRequests = TerrainRequests(network, terrain, self.clock)
+
         s = player.getPosition()
+        ahead = s + player.getVelocity() * self.LOOKAHEAD
+        centers = [s]
+        if ahead != s:
+            centers.append(ahead)
 
+        missing = set()
+        for center in centers:
+            for position in self._nearbyChunks(center):
+                if terrain.voxelAt(*position) == UNKNOWN:
+                    missing.add(position)
+
+        self.terrainRequests.want(
+            self._prioritize(missing, s, ahead, player.orientation))
+        self._unloadTerrain(s)
+
+
+    def _nearbyChunks(self, position):
+        """
+        Generate the origins of the chunks within C{CHUNK_OFFSET} of
+        C{position}, as three-tuples.
+        """
         g = self.CHUNK_GRANULARITY
-        x = int(quantize(g.x, s.x))
-        y = int(quantize(g.y, s.y))
-        z = int(quantize(g.z, s.z))
+        x = int(quantize(g.x, position.x))
+        y = int(quantize(g.y, position.y))
+        z = int(quantize(g.z, position.z))
 
         dx = int(self.CHUNK_OFFSET.x * g.x)
         dy = int(self.CHUNK_OFFSET.y * g.y)
@@ -393,16 +485,64 @@ class Window(object):
         for px in range(x - dx, x + dx + 1, int(g.x)):
             for py in range(y - dy, y + dy + 1, int(g.y)):
                 for pz in range(z - dz, z + dz + 1, int(g.z)):
+                    if px >= 0 and py >= 0 and pz >= 0:
+                        yield (px, py, pz)
+
+
+    def _prioritize(self, origins, position, ahead, orientation):
+        """
+        Sort chunk origins by how soon the player is likely to need them.
+
+        @param origins: An iterable of three-tuples giving chunk origins.
+        @param position: A L{Vector} giving the player's position.
+        @param ahead: A L{Vector} giving the position the player is moving
+            towards.
+        @param orientation: A L{Vector} giving the player's orientation, in
+            degrees.
+
+        @return: A C{list} of the elements of C{origins}, most urgent first.
+        """
+        g = self.CHUNK_GRANULARITY
+        y = orientation.y / 180 * pi
+        fx, fz = sin(y), -cos(y)
 
-                    if px < 0 or py < 0 or pz < 0:
-                        continue
+        def priority(origin):
+            cx = origin[0] + g.x / 2
+            cy = origin[1] + g.y / 2
+            cz = origin[2] + g.z / 2
+            distance = sqrt(
+                (cx - ahead.x) ** 2 + (cy - ahead.y) ** 2 + (cz - ahead.z) ** 2)
+            ox, oz = cx - position.x, cz - position.z
+            length = sqrt(ox ** 2 + oz ** 2)
+            if length:
+                distance -= self.FACING_BIAS * (ox * fx + oz * fz) / length
+            return (distance, origin)
 
-                    if px >= terrain.voxels.shape[0] or \
-                            py >= terrain.voxels.shape[1] or \
-                            pz >= terrain.voxels.shape[2] or \
-                            terrain.voxels[px, py, pz] == UNKNOWN:
-                        # XXX Add an errback
-                        network.callRemote(GetTerrain, x=px, y=py, z=pz)
+        return sorted(origins, key=priority)
+
+
+    def _unloadTerrain(self, position):
+        """
+        Forget about terrain chunks further than C{RESIDENCY_RADIUS} from
+        C{position}, measured across the ground and ignoring height, furthest
+        first.  If the player comes back, L{_checkTerrain} will find the
+        forgotten terrain L{UNKNOWN} and request it again.
+        """
+        terrain = self.environment.terrain
+        limit = self.RESIDENCY_RADIUS ** 2
+        sx, sy, sz = terrain.chunkShape
+        # Measure from the player to the center of each chunk.
+        px = position.x - sx / 2
+        pz = position.z - sz / 2
+        distant = []
+        for origin in terrain.loadedChunks():
+            x, y, z = origin
+            distance = (x - px) ** 2 + (z - pz) ** 2
+            if distance > limit:
+                distant.append((distance, origin))
+        distant.sort(reverse=True)
+        for distance, origin in distant[:self.MAX_UNLOADS]:
+            terrain.unloadChunk(origin)
 
 
     def submitTo(self, controller):
@@ -447,6 +587,8 @@ class Window(object):
         """
         if self._terrainCheck is not None:
             self._terrainCheck.stop()
+        if self.terrainRequests is not None:
+            self.terrainRequests.stop()
         self._inputCall.stop()
 
 
@@ -479,6 +621,17 @@ class TerrainView(object):
     @ivar _images: A cache of L{pygame.Surface} instances, keyed on terrain
         types.  These images are the source for texture data for each type of
         terrain.
+
+    @ivar greedy: A C{bool} indicating whether the surface mesh should merge
+        adjacent faces of the same terrain type.  See L{SurfaceMesh}.
+
+    @ivar _indices: C{None} or a L{VBO} of indexes from L{quadIndices}, shared
+        by every chunk of the surface mesh.  It is replaced with a larger one
+        when a chunk has more faces than it covers.
+
+    @ivar _buffers: A C{list} of the L{VBO} of each chunk of the surface mesh
+        when it was last painted, so that the buffers of chunks which are gone
+        can be deleted.
     """
     _files = {
         GRASS: 'grass.png',
@@ -488,27 +641,51 @@ class TerrainView(object):
         }
 
     _texture = None
+    _indices = None
+    _buffers = ()
 
     _datapath = FilePath(gameFile).sibling('data')
 
-    def __init__(self, environment, loader):
+    def __init__(self, environment, loader, greedy=False):
         self._images = {}
         self.loader = loader
-        self._vbos = []
+        self.greedy = greedy
         if environment is not None:
             self._coord, self._ext = self._getTextureForTerrain()
             self.environment = environment
             self._surface = SurfaceMesh(
                 environment.terrain, self._surfaceFactory, self._coord,
-                self._ext)
+                self._ext, greedy, packed=True)
             self.environment.terrain.addObserver(self._surface.changed)
 
 
-    def _surfaceFactory(self):
-        data = zeros((1000000, 5), 'f')
-        result = SurfaceMeshVertices(VBO(data), data, 0)
-        self._vbos.append(result)
-        return result
+    def _surfaceFactory(self, size):
+        """
+        Create storage for the packed surface mesh of one terrain chunk, backed
+        by a L{VBO}.
+
+        @param size: The number of vertices to make room for.
+        """
+        data = zeros((size, 6), 'h')
+        return SurfaceMeshVertices(VBO(data), data, 0)
+
+
+    def _releaseBuffers(self, surfaces):
+        """
+        Delete the buffer of each chunk which has been dropped from the surface
+        mesh, or whose storage has been replaced with larger storage, since
+        the last call.
+
+        @param surfaces: The pieces of the surface mesh, as returned by
+            L{SurfaceMesh.surfaces}.
+        """
+        live = dict(
+            (id(surface.update), surface.update)
+            for (origin, surface) in surfaces)
+        for buffer in self._buffers:
+            if id(buffer) not in live:
+                buffer.delete()
+        self._buffers = live.values()
 
 
     def _getImageForTerrain(self, terrainType):
@@ -583,23 +760,74 @@ class TerrainView(object):
     def paint(self):
         """
         For all of the known terrain, render whatever faces are exposed.
+        Chunks of terrain which lie outside of the current view frustum are
+        skipped.
         """
         if self._texture is None:
             self._texture = self._createTexture()
 
+        surfaces = self._surface.surfaces()
+        self._releaseBuffers(surfaces)
+        if surfaces:
+            # Skip the chunks which are out of sight.
+            planes = frustumPlanes(
+                glGetFloatv(GL_PROJECTION_MATRIX),
+                glGetFloatv(GL_MODELVIEW_MATRIX))
+            low = array([origin for (origin, surface) in surfaces])
+            high = low + self.environment.terrain.chunkShape
+            surfaces = [
+                piece for (piece, visible)
+                in zip(surfaces, visibleBoxes(planes, low, high))
+                if visible]
+        faces = max([surface.important // 4 for (origin, surface) in surfaces]
+                    or [0])
+        if self._indices is None or len(self._indices) < faces * 6:
+            if self._indices is not None:
+                self._indices.delete()
+            self._indices = VBO(
+                quadIndices(max(faces, 1) * 2),
+                target='GL_ELEMENT_ARRAY_BUFFER')
+
         glBindTexture(GL_TEXTURE_2D, self._texture)
+        # Texture coordinates are stored as shorts; scale them back down.
+        glMatrixMode(GL_TEXTURE)
+        glPushMatrix()
+        glLoadIdentity()
+        glScale(1 / PACKED_TEXTURE_SCALE, 1 / PACKED_TEXTURE_SCALE, 1)
+        glMatrixMode(GL_MODELVIEW)
+
         glEnableClientState(GL_VERTEX_ARRAY)
         glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-        for surface in self._vbos:
+        self._indices.bind()
+        for origin, surface in surfaces:
             vbo = surface.update
             length = surface.important
+            # The first bind uploads everything.  After that, only what has
+            # changed needs to be sent.
+            copied = vbo.copied
             vbo.bind()
-            glVertexPointer(3, GL_FLOAT, 4 * 5, vbo)
-            glTexCoordPointer(2, GL_FLOAT, 4 * 5, vbo + (4 * 3))
-            glDrawArrays(GL_TRIANGLES, 0, length)
+            dirty = surface.takeDirty()
+            if copied:
+                for start, stop in dirty:
+                    glBufferSubData(
+                        GL_ARRAY_BUFFER, start * 2 * 6, (stop - start) * 2 * 6,
+                        surface.data[start:stop])
+            # Positions are relative to the chunk.
+            glPushMatrix()
+            glTranslate(*origin)
+            glVertexPointer(3, GL_SHORT, 2 * 6, vbo)
+            glTexCoordPointer(2, GL_SHORT, 2 * 6, vbo + (2 * 4))
+            glDrawElements(
+                GL_TRIANGLES, length // 4 * 6, GL_UNSIGNED_SHORT, self._indices)
+            glPopMatrix()
             vbo.unbind()
+        self._indices.unbind()
         glDisableClientState(GL_VERTEX_ARRAY)
         glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+
+        glMatrixMode(GL_TEXTURE)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
         glBindTexture(GL_TEXTURE_2D, 0)
 
 
@@ -611,7 +839,7 @@ class PlayerView(record('player')):
     def paint(self):
         glPushMatrix()
 
-        position = self.player.getPosition()
+        position = self.player.getSmoothedPosition()
         glTranslate(position.x, position.y, position.z)
         glRotate(self.player.orientation.y, 0.0, 1.0, 0.0)
         # Slide back because the pyramid below is centered at 0.5, 0, 0.5
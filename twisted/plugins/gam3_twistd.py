@@ -29,6 +29,10 @@ class _Gam3Plugin(object):
              'Directory to which to log protocol traffic.'),
             ('terrain', None, None,
              'Filename containing the terrain data to use.')]
+        optFlags = [
+            ('batch-updates', None,
+             'Send the players which changed direction to each client once '
+             'per tick, instead of as each changes.')]
 
     description = "Gam3 MMO server"
 
@@ -63,7 +67,8 @@ class _Gam3Plugin(object):
 
         service = MultiService()
 
-        factory = Gam3Factory(world)
+        factory = Gam3Factory(
+            world, batchUpdates=bool(options.get('batch-updates')))
         if options['log-directory'] is not None:
             factory = TrafficLoggingFactory(
                 factory, join(options['log-directory'], 'gam3'))